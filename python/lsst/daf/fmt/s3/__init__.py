@@ -27,5 +27,22 @@ __path__ = pkgutil.extend_path(__path__, __name__)
 
 
 from .version import *   # generated by sconsUtils unless you tell it not to
+from .s3StorageConfig import *
+from .bulk import *
+from .clientPool import *
+from .compression import *
+from .existenceCache import *
+from .fitsIndex import *
+from .keyIndex import *
+from .localFileCache import *
+from .manifest import *
+from .objectCache import *
+from .prefetch import *
+from .repositoryCfgCache import *
+from .singleFlight import *
+from .stats import *
+from .streams import *
+from .throttle import *
+from .writeBehind import *
 from .s3Storage import *
 from .fmtRepositoryCfg import *
@@ -0,0 +1,479 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Benchmarks of S3Storage against a local S3 stand-in.
+
+Run ``s3Benchmark.py --help`` for the command line. The benchmarks measure
+
+- write and read throughput of objects of several sizes at several concurrency levels,
+- the rate of ``exists`` and ``instanceSearch`` calls on a bucket holding many keys, and of deleting those
+  keys with ``purge``,
+- the cost of reading a RepositoryCfg with ``getMapperClass``, as Butler does when it is constructed, both
+  cold (new process state) and warm,
+- the time to import the package in a new interpreter, and to construct a storage and make its first
+  request, cold and warm.
+
+Results are written as JSON and can be compared to the results of an earlier run to catch regressions.
+Requests can be delayed by a fixed time to emulate the round trip to a remote server, which a local
+stand-in does not have.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import uuid
+import warnings
+
+import lsst.daf.persistence as dafPersist
+from .clientPool import ClientPool
+from .s3Storage import S3Storage
+from .s3StorageConfig import S3StorageConfig
+
+__all__ = ['BenchmarkObject', 'injectLatency', 'benchmarkReadWrite', 'benchmarkExists',
+           'benchmarkGetMapperClass', 'benchmarkStartup', 'runBenchmarks', 'compareToBaseline', 'main']
+
+DEFAULT_SIZES = (1024, 64 * 1024, 1024**2, 16 * 1024**2, 64 * 1024**2)
+
+
+class BenchmarkObject:
+    """An opaque blob of bytes, written and read with stream formatters."""
+
+    def __init__(self, data):
+        self.data = data
+
+
+def _writeBenchmarkObject(stream, butlerLocation, obj):
+    stream.write(obj.data)
+
+
+def _readBenchmarkObject(stream, butlerLocation):
+    return BenchmarkObject(stream.read())
+
+
+S3Storage.registerStreamFormatters(BenchmarkObject, readFormatter=_readBenchmarkObject,
+                                   writeFormatter=_writeBenchmarkObject)
+
+
+def _result(name, value, unit, higherIsBetter, **params):
+    return dict(name=name, params=params, value=value, unit=unit, higherIsBetter=higherIsBetter)
+
+
+def _location(storage, key):
+    return dafPersist.ButlerLocation(pythonType=BenchmarkObject, cppType=None, storageName=None,
+                                     locationList=[key], dataId={}, mapper=None, storage=storage)
+
+
+def injectLatency(client, seconds):
+    """Delay every request of a client, to emulate the round trip to a remote server.
+
+    Parameters
+    ----------
+    client : botocore.client.BaseClient
+        The client, e.g. from `ClientPool.getClient`.
+    seconds : float
+        The delay added to each request.
+
+    Returns
+    -------
+    callable
+        Call it with no arguments to remove the delay.
+    """
+    def delay(**kwargs):
+        time.sleep(seconds)
+
+    client.meta.events.register('before-send.s3', delay)
+    return lambda: client.meta.events.unregister('before-send.s3', delay)
+
+
+def _timeConcurrently(func, items, concurrency):
+    """Call func on each item with concurrency threads and return the elapsed seconds."""
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(func, item) for item in items]:
+            future.result()
+    return time.monotonic() - start
+
+
+def benchmarkReadWrite(storage, sizes, concurrencies, totalBytes=64 * 1024**2, maxObjects=256):
+    """Measure write and read throughput.
+
+    For each size and concurrency level enough objects are written (then read) to make up about
+    totalBytes, with at least one and at most maxObjects objects. Concurrency levels above the number of
+    objects of a size are measured with one thread per object, once, and the others are skipped with a
+    warning; raise totalBytes to measure them.
+
+    Parameters
+    ----------
+    storage : S3Storage
+        The storage to write to.
+    sizes : sequence of int
+        Object sizes in bytes.
+    concurrencies : sequence of int
+        The numbers of threads writing and reading at the same time.
+    totalBytes : int
+        The number of bytes to transfer in each measurement.
+    maxObjects : int
+        The maximum number of objects in each measurement.
+
+    Returns
+    -------
+    list of dict
+        The results, see `runBenchmarks`.
+    """
+    results = []
+    for size in sizes:
+        obj = BenchmarkObject(os.urandom(size))
+        count = max(1, min(maxObjects, totalBytes // size))
+        measured = set()
+        for requested in concurrencies:
+            concurrency = min(requested, count)
+            if concurrency in measured:
+                warnings.warn("Skipping {} threads for objects of {} bytes: only {} objects make up {} bytes"
+                              .format(requested, size, count, totalBytes))
+                continue
+            measured.add(concurrency)
+            keys = ['readWrite/{}/{}/{}'.format(size, concurrency, i) for i in range(count)]
+            elapsed = _timeConcurrently(lambda key: storage.write(_location(storage, key), obj), keys,
+                                        concurrency)
+            results.append(_result('write', size * count / elapsed, 'bytes/s', True, size=size,
+                                   concurrency=concurrency))
+            results.append(_result('writeObjects', count / elapsed, 'objects/s', True, size=size,
+                                   concurrency=concurrency))
+            elapsed = _timeConcurrently(lambda key: storage.read(_location(storage, key)), keys, concurrency)
+            results.append(_result('read', size * count / elapsed, 'bytes/s', True, size=size,
+                                   concurrency=concurrency))
+            results.append(_result('readObjects', count / elapsed, 'objects/s', True, size=size,
+                                   concurrency=concurrency))
+    return results
+
+
+def _populate(storage, numKeys, keysPerDirectory, concurrency):
+    """Create numKeys empty objects and return their keys."""
+    keys = ['search/{:05d}/key{:07d}.fits'.format(i // keysPerDirectory, i) for i in range(numKeys)]
+    client = storage.s3.meta.client
+    _timeConcurrently(lambda key: client.put_object(Bucket=storage.bucketName, Key=key, Body=b''), keys,
+                      concurrency)
+    return keys
+
+
+def benchmarkExists(storage, numKeys, numLookups, keysPerDirectory=1000, concurrency=32):
+    """Measure the rate of exists and instanceSearch calls on a bucket holding many keys, then the rate at
+    which purge deletes the keys.
+
+    Half of the lookups are of keys that do not exist. exists is measured with its cache disabled, so every
+    call is a request; instanceSearch is measured as it is configured (answered from the key index).
+
+    Parameters
+    ----------
+    storage : S3Storage
+        The storage to use; numKeys objects are created in it.
+    numKeys : int
+        The number of keys in the bucket.
+    numLookups : int
+        The number of calls measured.
+    keysPerDirectory : int
+        The number of keys under each '/' separated prefix.
+    concurrency : int
+        The number of threads creating the keys and making the calls.
+
+    Returns
+    -------
+    list of dict
+        The results, see `runBenchmarks`.
+    """
+    start = time.monotonic()
+    keys = _populate(storage, numKeys, keysPerDirectory, concurrency)
+    results = [_result('populate', numKeys / (time.monotonic() - start), 'objects/s', True, keys=numKeys)]
+    rng = random.Random(12345)
+    lookups = [rng.choice(keys) if i % 2 else rng.choice(keys).replace('.fits', '.missing')
+               for i in range(numLookups)]
+    ttl, negativeTtl = storage.config.existsCacheTtl, storage.config.existsNegativeCacheTtl
+    storage.config.update(existsCacheTtl=0., existsNegativeCacheTtl=0.)
+    try:
+        elapsed = _timeConcurrently(storage.exists, lookups, concurrency)
+    finally:
+        storage.config.update(existsCacheTtl=ttl, existsNegativeCacheTtl=negativeTtl)
+    results.append(_result('exists', numLookups / elapsed, 'calls/s', True, keys=numKeys,
+                           concurrency=concurrency))
+    elapsed = _timeConcurrently(storage.instanceSearch, lookups, concurrency)
+    results.append(_result('instanceSearch', numLookups / elapsed, 'calls/s', True, keys=numKeys,
+                           concurrency=concurrency))
+    start = time.monotonic()
+    storage.purge('search/')
+    results.append(_result('purge', numKeys / (time.monotonic() - start), 'objects/s', True, keys=numKeys))
+    return results
+
+
+def benchmarkGetMapperClass(uri, repeats):
+    """Measure the cost of getMapperClass, cold (after S3Storage.clearSharedState) and warm.
+
+    Parameters
+    ----------
+    uri : string
+        The repository URI; a RepositoryCfg is written to it.
+    repeats : int
+        The number of calls measured in each state.
+
+    Returns
+    -------
+    list of dict
+        The results, see `runBenchmarks`.
+    """
+    cfg = dafPersist.RepositoryCfg.makeFromArgs(dafPersist.RepositoryArgs(root=uri, mapper=dafPersist.Mapper))
+    S3Storage.putRepositoryCfg(cfg)
+    cold = warm = 0.
+    for i in range(repeats):
+        S3Storage.clearSharedState()
+        start = time.monotonic()
+        S3Storage.getMapperClass(uri)
+        cold += time.monotonic() - start
+        start = time.monotonic()
+        S3Storage.getMapperClass(uri)
+        warm += time.monotonic() - start
+    return [_result('getMapperClassCold', cold / repeats, 's', False),
+            _result('getMapperClassWarm', warm / repeats, 's', False)]
+
+
+_IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import lsst.daf.fmt.s3
+print(time.perf_counter() - start)
+"""
+
+
+def benchmarkStartup(uri, repeats):
+    """Measure what a short-lived process pays before its first request.
+
+    The import of the package is timed in new interpreters. Constructing a storage and its first exists call
+    are timed cold (after S3Storage.clearSharedState, so the bucket is checked again) and warm.
+
+    Parameters
+    ----------
+    uri : string
+        The URI of an existing bucket.
+    repeats : int
+        The number of measurements of each kind.
+
+    Returns
+    -------
+    list of dict
+        The results, see `runBenchmarks`.
+    """
+    importTime = 0.
+    for i in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT], check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        importTime += float(output.split()[-1])
+    times = dict(constructCold=0., firstExistsCold=0., constructWarm=0., firstExistsWarm=0.)
+    for i in range(repeats):
+        S3Storage.clearSharedState()
+        for state in ('Cold', 'Warm'):
+            start = time.monotonic()
+            storage = S3Storage(uri, create=True)
+            constructed = time.monotonic()
+            storage.exists('startup')
+            times['construct' + state] += constructed - start
+            times['firstExists' + state] += time.monotonic() - constructed
+    return ([_result('import', importTime / repeats, 's', False)] +
+            [_result(name, value / repeats, 's', False) for name, value in times.items()])
+
+
+def runBenchmarks(uri, sizes=DEFAULT_SIZES, concurrencies=(1, 8, 32), totalBytes=64 * 1024**2,
+                  numKeys=100000, numLookups=10000, mapperRepeats=20, startupRepeats=5, latency=0.):
+    """Run all the benchmarks in a bucket.
+
+    Parameters
+    ----------
+    uri : string
+        The URI of the bucket, e.g. 's3://benchmark'. It is created if it does not exist and the objects
+        written are left in it.
+    sizes : sequence of int
+        Object sizes for the throughput benchmarks, see `benchmarkReadWrite`.
+    concurrencies : sequence of int
+        Concurrency levels for the throughput benchmarks.
+    totalBytes : int
+        Bytes transferred by each throughput measurement.
+    numKeys : int
+        Keys in the bucket for the exists and search benchmarks; 0 to skip them.
+    numLookups : int
+        Calls measured by the exists and search benchmarks.
+    mapperRepeats : int
+        Calls measured by the getMapperClass benchmark; 0 to skip it.
+    startupRepeats : int
+        Measurements of the startup benchmark; 0 to skip it.
+    latency : float
+        Seconds added to every request, see `injectLatency`.
+
+    Returns
+    -------
+    dict
+        ``environment`` describes the run (python, platform, endpoint, latency...) and ``results`` is a list
+        of dicts with the benchmark ``name``, its ``params``, the measured ``value`` and its ``unit``, and
+        ``higherIsBetter``.
+    """
+    config = S3StorageConfig()
+    client = ClientPool.getClient(config.endpointUrl, config.profile, config.maxPoolConnections,
+                                  config.maxAttempts, config.adaptiveConcurrency)
+    removeLatency = injectLatency(client, latency) if latency > 0 else None
+    try:
+        storage = S3Storage(uri, create=True)
+        results = benchmarkReadWrite(storage, sizes, concurrencies, totalBytes)
+        if numKeys > 0:
+            results += benchmarkExists(storage, numKeys, numLookups)
+        if mapperRepeats > 0:
+            results += benchmarkGetMapperClass(uri, mapperRepeats)
+        if startupRepeats > 0:
+            results += benchmarkStartup(uri, startupRepeats)
+    finally:
+        if removeLatency is not None:
+            removeLatency()
+    environment = dict(time=time.time(), python=platform.python_version(), platform=platform.platform(),
+                       endpointUrl=config.endpointUrl, latency=latency, cpus=os.cpu_count())
+    return dict(environment=environment, results=results)
+
+
+def _resultKey(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compareToBaseline(report, baseline, tolerance=0.1):
+    """Compare results to those of an earlier run.
+
+    Parameters
+    ----------
+    report : dict
+        The output of `runBenchmarks`.
+    baseline : dict
+        The output of an earlier run.
+    tolerance : float
+        The fraction by which a result may be worse than the baseline before it counts as a regression.
+
+    Returns
+    -------
+    list of dict
+        One entry for each result that is also in the baseline: the result's ``name`` and ``params``, the
+        ``value`` and ``baseline`` value, their ``ratio`` (above 1 is better) and whether it is a
+        ``regression``.
+    """
+    baselineValues = {_resultKey(result): result['value'] for result in baseline['results']}
+    comparisons = []
+    for result in report['results']:
+        old = baselineValues.get(_resultKey(result))
+        if old is None or old <= 0 or result['value'] <= 0:
+            continue
+        ratio = result['value'] / old if result['higherIsBetter'] else old / result['value']
+        comparisons.append(dict(name=result['name'], params=result['params'], value=result['value'],
+                                baseline=old, ratio=ratio, regression=ratio < 1. - tolerance))
+    return comparisons
+
+
+def _parseSize(text):
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line.
+
+    Parameters
+    ----------
+    argv : list of string, optional
+        The arguments; sys.argv[1:] if None.
+
+    Returns
+    -------
+    int
+        The exit status: 1 if results regressed compared to the baseline, else 0.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark S3Storage against a local S3 stand-in.")
+    parser.add_argument('--endpoint-url', help="S3 endpoint, e.g. http://localhost:9000 for a MinIO server. "
+                        "By default the endpoint of the S3 storage configuration (LSST_S3_ENDPOINT_URL) is "
+                        "used.")
+    parser.add_argument('--moto-server', action='store_true',
+                        help="start moto's S3 server in this process and run against it")
+    parser.add_argument('--bucket', default=None, help="bucket to use; a new one by default")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated object sizes, e.g. 1K,1M,1G")
+    parser.add_argument('--concurrency', default='1,8,32', help="comma separated numbers of threads")
+    parser.add_argument('--total-bytes', default='64M', help="bytes transferred per throughput measurement")
+    parser.add_argument('--keys', type=int, default=100000, help="keys for the exists/search benchmarks")
+    parser.add_argument('--lookups', type=int, default=10000, help="calls for the exists/search benchmarks")
+    parser.add_argument('--mapper-repeats', type=int, default=20,
+                        help="calls for the getMapperClass benchmark")
+    parser.add_argument('--startup-repeats', type=int, default=5,
+                        help="measurements of the import and construction benchmark")
+    parser.add_argument('--latency', type=float, default=0., help="seconds added to every request")
+    parser.add_argument('--output', help="file to write the JSON results to; stdout by default")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="fraction by which a result may be worse than the baseline")
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.moto_server:
+        from moto.server import ThreadedMotoServer
+        server = ThreadedMotoServer(port=0)
+        server.start()
+        host, port = server.get_host_and_port()
+        args.endpoint_url = 'http://{}:{}'.format(host, port)
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    if args.endpoint_url:
+        S3StorageConfig.setDefaults(endpointUrl=args.endpoint_url)
+    try:
+        report = runBenchmarks('s3://{}'.format(args.bucket or 'benchmark-' + uuid.uuid4().hex[:12]),
+                               sizes=[_parseSize(size) for size in args.sizes.split(',')],
+                               concurrencies=[int(c) for c in args.concurrency.split(',')],
+                               totalBytes=_parseSize(args.total_bytes), numKeys=args.keys,
+                               numLookups=args.lookups, mapperRepeats=args.mapper_repeats,
+                               startupRepeats=args.startup_repeats, latency=args.latency)
+    finally:
+        if server is not None:
+            server.stop()
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compareToBaseline(report, json.load(f), args.tolerance)
+        for comparison in report['comparison']:
+            if comparison['regression']:
+                status = 1
+                sys.stderr.write("regression: {} {} {:.4g} vs {:.4g} (x{:.2f})\n".format(
+                    comparison['name'], comparison['params'], comparison['value'], comparison['baseline'],
+                    comparison['ratio']))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    return status
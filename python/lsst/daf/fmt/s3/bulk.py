@@ -0,0 +1,93 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import threading
+
+__all__ = ['BulkResult', 'BulkOperationError']
+
+
+class BulkResult:
+    """Progress and outcome of a bulk operation on many objects, such as S3Storage.copyTree.
+
+    The counters are updated from several threads while the operation runs; the object passed to progress
+    callbacks is the live result, so read what you need from it inside the callback.
+
+    Attributes
+    ----------
+    total : int
+        The number of objects the operation covers.
+    totalBytes : int
+        The number of bytes in those objects.
+    done : int
+        The number of objects processed successfully.
+    doneBytes : int
+        The number of bytes in the objects processed successfully.
+    skipped : int
+        The number of objects that needed no work, e.g. already copied by an earlier, interrupted run.
+    failures : dict
+        Key -> exception for each object that failed.
+    """
+
+    def __init__(self, total=0, totalBytes=0):
+        self.total = total
+        self.totalBytes = totalBytes
+        self.done = 0
+        self.doneBytes = 0
+        self.skipped = 0
+        self.failures = {}
+        self._lock = threading.Lock()
+
+    def _record(self, key, size, error=None, skipped=False):
+        with self._lock:
+            if error is not None:
+                self.failures[key] = error
+            elif skipped:
+                self.skipped += 1
+            else:
+                self.done += 1
+                self.doneBytes += size
+
+    @property
+    def finished(self):
+        """The number of objects processed so far, including skipped and failed ones."""
+        return self.done + self.skipped + len(self.failures)
+
+    def __repr__(self):
+        return "{}(total={}, totalBytes={}, done={}, doneBytes={}, skipped={}, failed={})".format(
+            self.__class__.__name__, self.total, self.totalBytes, self.done, self.doneBytes, self.skipped,
+            len(self.failures))
+
+
+class BulkOperationError(RuntimeError):
+    """Raised when some objects of a bulk operation failed.
+
+    Parameters
+    ----------
+    message : string
+        The error message.
+    result : BulkResult
+        The result of the operation, including the failures.
+    """
+
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
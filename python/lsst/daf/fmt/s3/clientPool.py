@@ -0,0 +1,174 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import os
+import threading
+
+from .stats import S3Stats
+from .throttle import AdaptiveConcurrency
+
+__all__ = ['ClientPool']
+
+
+class _PoolEntry:
+    """A boto3 client, a resource that uses it and the limiter of its requests in flight."""
+
+    __slots__ = ('client', 'resource', 'concurrency')
+
+    def __init__(self, client, resource, concurrency):
+        self.client = client
+        self.resource = resource
+        self.concurrency = concurrency
+
+
+class ClientPool:
+    """Process-wide, thread-safe pool of boto3 S3 clients.
+
+    Creating a boto3 session and client is slow, and every client has its own HTTP connection pool, so each
+    new client pays fresh TLS handshakes. The pool keeps one client per combination of endpoint, credentials
+    and connection pool size and hands it to every S3Storage that asks for the same combination. Credentials
+    are identified by the AWS profile name and the ``AWS_ACCESS_KEY_ID`` environment variable.
+
+    boto3 clients are thread safe; resources are not, so each caller gets its own resource objects (e.g. via
+    ``resource.Bucket(name)``) but they all send their requests through the shared client.
+
+    Clients retry failed requests up to ``maxAttempts`` times in all, with botocore's standard retry mode:
+    truncated exponential backoff with full jitter, scaled up for throttling errors such as 503 SlowDown.
+    If ``adaptiveConcurrency`` is True an `AdaptiveConcurrency` limiter starting at ``maxPoolConnections``
+    also lowers the number of requests in flight while the server throttles them.
+    """
+
+    _lock = threading.Lock()
+    _entries = {}
+
+    @classmethod
+    def _getEntry(cls, endpointUrl, profileName, maxPoolConnections, maxAttempts, adaptiveConcurrency):
+        key = (endpointUrl, profileName, os.environ.get('AWS_ACCESS_KEY_ID'), maxPoolConnections, maxAttempts,
+               adaptiveConcurrency)
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry is None:
+                # boto3 takes a good part of a second to import, so it is only loaded for the first client.
+                import boto3
+                import botocore.config
+                session = boto3.session.Session(profile_name=profileName)
+                config = botocore.config.Config(max_pool_connections=maxPoolConnections,
+                                                retries={'max_attempts': maxAttempts, 'mode': 'standard'})
+                client = session.client('s3', endpoint_url=endpointUrl, config=config)
+                resource = session.resource('s3', endpoint_url=endpointUrl, config=config)
+                # route the resource's requests through the shared client so they share its connection pool;
+                # sub-resources such as Bucket inherit the client from here.
+                resource.meta.client = client
+                S3Stats.register(client)
+                concurrency = None
+                if adaptiveConcurrency:
+                    concurrency = AdaptiveConcurrency(maxPoolConnections)
+                    concurrency.register(client)
+                entry = cls._entries[key] = _PoolEntry(client, resource, concurrency)
+        return entry
+
+    @classmethod
+    def getClient(cls, endpointUrl=None, profileName=None, maxPoolConnections=10, maxAttempts=10,
+                  adaptiveConcurrency=True):
+        """Get the pooled S3 client for an endpoint and credentials.
+
+        Parameters
+        ----------
+        endpointUrl : string, optional
+            The S3 endpoint, or None for the AWS default.
+        profileName : string, optional
+            The AWS profile to get credentials from, or None for the default credential chain.
+        maxPoolConnections : int
+            The maximum number of HTTP connections the client keeps open.
+        maxAttempts : int
+            The maximum number of attempts of a request, including retries.
+        adaptiveConcurrency : bool
+            If True limit the requests in flight with an `AdaptiveConcurrency`.
+
+        Returns
+        -------
+        botocore.client.S3
+            The shared client.
+        """
+        return cls._getEntry(endpointUrl, profileName, maxPoolConnections, maxAttempts,
+                             adaptiveConcurrency).client
+
+    @classmethod
+    def getResource(cls, endpointUrl=None, profileName=None, maxPoolConnections=10, maxAttempts=10,
+                    adaptiveConcurrency=True):
+        """Get the pooled S3 service resource for an endpoint and credentials.
+
+        The resource sends its requests through the client returned by getClient for the same arguments.
+        Create sub-resources (e.g. ``getResource().Bucket(name)``) separately in each thread that uses them.
+
+        Parameters
+        ----------
+        endpointUrl : string, optional
+            The S3 endpoint, or None for the AWS default.
+        profileName : string, optional
+            The AWS profile to get credentials from, or None for the default credential chain.
+        maxPoolConnections : int
+            The maximum number of HTTP connections the client keeps open.
+        maxAttempts : int
+            The maximum number of attempts of a request, including retries.
+        adaptiveConcurrency : bool
+            If True limit the requests in flight with an `AdaptiveConcurrency`.
+
+        Returns
+        -------
+        boto3.resources.base.ServiceResource
+            The shared S3 service resource.
+        """
+        return cls._getEntry(endpointUrl, profileName, maxPoolConnections, maxAttempts,
+                             adaptiveConcurrency).resource
+
+    @classmethod
+    def getConcurrency(cls, endpointUrl=None, profileName=None, maxPoolConnections=10, maxAttempts=10,
+                       adaptiveConcurrency=True):
+        """Get the limiter of the requests in flight of the pooled client for the same arguments.
+
+        Parameters
+        ----------
+        endpointUrl : string, optional
+            The S3 endpoint, or None for the AWS default.
+        profileName : string, optional
+            The AWS profile to get credentials from, or None for the default credential chain.
+        maxPoolConnections : int
+            The maximum number of HTTP connections the client keeps open.
+        maxAttempts : int
+            The maximum number of attempts of a request, including retries.
+        adaptiveConcurrency : bool
+            If True limit the requests in flight with an `AdaptiveConcurrency`.
+
+        Returns
+        -------
+        AdaptiveConcurrency or None
+            The limiter, or None if adaptiveConcurrency is False.
+        """
+        return cls._getEntry(endpointUrl, profileName, maxPoolConnections, maxAttempts,
+                             adaptiveConcurrency).concurrency
+
+    @classmethod
+    def clear(cls):
+        """Drop all pooled clients, e.g. after credentials changed."""
+        with cls._lock:
+            cls._entries.clear()
@@ -0,0 +1,179 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import gzip
+import io
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+__all__ = ['Codec', 'getCodec', 'availableCodecs', 'decodeStream']
+
+# The S3 user metadata key (sent as x-amz-meta-lsst-encoding) that names the codec of an object.
+METADATA_KEY = 'lsst-encoding'
+
+CHUNK_SIZE = 1024**2
+
+
+class _NonClosing(io.RawIOBase):
+    """A writable proxy of a binary file that is not closed with the proxy.
+
+    Some compressors close the file they write to when they are closed; this keeps the caller's buffer open.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._fileobj.write(data)
+
+
+class Codec:
+    """A streaming compression format.
+
+    Parameters
+    ----------
+    name : string
+        The name recorded in the metadata of compressed objects.
+    openWriter : callable
+        ``openWriter(fileobj)`` must return a writable binary file that compresses into fileobj, and
+        finishes the compressed stream (without closing fileobj) when it is closed.
+    openReader : callable
+        ``openReader(fileobj)`` must return a readable binary file of the decompressed content of fileobj.
+    """
+
+    def __init__(self, name, openWriter, openReader):
+        self.name = name
+        self.openWriter = openWriter
+        self.openReader = openReader
+
+    def encode(self, source, destination):
+        """Compress a stream into another, a chunk at a time.
+
+        Parameters
+        ----------
+        source : file-like object
+            The readable binary data to compress, read from its current position.
+        destination : file-like object
+            The writable binary file to write the compressed data to. It is not closed.
+        """
+        with self.openWriter(_NonClosing(destination)) as writer:
+            shutil.copyfileobj(source, writer, CHUNK_SIZE)
+
+    def decode(self, source):
+        """Open a stream of the decompressed content of a compressed stream.
+
+        Parameters
+        ----------
+        source : file-like object
+            The readable compressed data.
+
+        Returns
+        -------
+        file-like object
+            The readable decompressed data; decompression happens as it is read.
+        """
+        return self.openReader(source)
+
+    def __repr__(self):
+        return "Codec({!r})".format(self.name)
+
+
+_codecs = {
+    'gzip': Codec('gzip', lambda f: gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6),
+                  lambda f: gzip.GzipFile(fileobj=f, mode='rb')),
+}
+if zstandard is not None:
+    _codecs['zstd'] = Codec('zstd', lambda f: zstandard.ZstdCompressor(level=3).stream_writer(f),
+                            lambda f: zstandard.ZstdDecompressor().stream_reader(f))
+if lz4 is not None:
+    _codecs['lz4'] = Codec('lz4', lambda f: lz4.frame.LZ4FrameFile(f, mode='wb'),
+                           lambda f: lz4.frame.LZ4FrameFile(f, mode='rb'))
+
+
+def availableCodecs():
+    """Get the names of the codecs that can be used in this environment.
+
+    gzip is always available; zstd and lz4 need the zstandard and lz4 packages.
+
+    Returns
+    -------
+    list of string
+        The codec names.
+    """
+    return sorted(_codecs)
+
+
+def getCodec(name):
+    """Get a codec by name.
+
+    Parameters
+    ----------
+    name : string
+        The codec name, e.g. 'zstd'.
+
+    Returns
+    -------
+    Codec
+        The codec.
+
+    Raises
+    ------
+    RuntimeError
+        If there is no such codec, or the package it needs is not installed.
+    """
+    codec = _codecs.get(name)
+    if codec is None:
+        raise RuntimeError("Compression codec {!r} is not available; available codecs are {}".format(
+            name, availableCodecs()))
+    return codec
+
+
+def decodeStream(stream, metadata):
+    """Wrap a stream of an object's content to decompress it if the object's metadata says it is compressed.
+
+    Parameters
+    ----------
+    stream : file-like object
+        The readable content of the object as stored.
+    metadata : dict or None
+        The user metadata of the object, e.g. the 'Metadata' of its get_object response.
+
+    Returns
+    -------
+    file-like object
+        stream itself for objects that are not compressed, else a stream of the decompressed content.
+    """
+    name = (metadata or {}).get(METADATA_KEY)
+    if name is None:
+        return stream
+    return getCodec(name).decode(stream)
@@ -0,0 +1,180 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import collections
+import threading
+import time
+
+__all__ = ['ExistenceCache']
+
+
+class ExistenceCache:
+    """A short-lived, in-process record of whether keys in a bucket exist.
+
+    Answers learned from the server expire after a time to live that can be different for positive and
+    negative answers. Answers recorded because this process itself created a key (see `set`) follow the same
+    expiry, so objects deleted by other processes are eventually noticed.
+
+    Changes made by this process take precedence over answers of requests that were sent before them:
+    callers asking the server get a `generation` first and pass it to `set` with the answer, which is dropped
+    if the key changed in between.
+
+    Use `forBucket` to get the cache shared by all the storages of a bucket in the process.
+
+    Parameters
+    ----------
+    maxEntries : int
+        The maximum number of keys to remember; the oldest answers are dropped above it.
+    """
+
+    _instances = {}
+    _instancesLock = threading.Lock()
+
+    def __init__(self, maxEntries=100000):
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+        # key -> (exists, time.monotonic() when the answer was recorded), oldest first.
+        self._entries = collections.OrderedDict()
+        # a counter of the changes; key -> the generation of its last change, oldest first.
+        self._generation = 0
+        self._changes = collections.OrderedDict()
+        # the newest generation of the changes no longer in _changes; keys not in it may have changed then.
+        self._forgotten = 0
+
+    @classmethod
+    def forBucket(cls, endpointUrl, bucketName):
+        """Get the process-wide existence cache of a bucket, creating it if needed.
+
+        Parameters
+        ----------
+        endpointUrl : string or None
+            The S3 endpoint of the bucket; buckets of the same name on different endpoints have different
+            caches.
+        bucketName : string
+            The name of the bucket.
+
+        Returns
+        -------
+        ExistenceCache
+            The cache for bucketName.
+        """
+        with cls._instancesLock:
+            cache = cls._instances.get((endpointUrl, bucketName))
+            if cache is None:
+                cache = cls._instances[(endpointUrl, bucketName)] = cls()
+        return cache
+
+    @classmethod
+    def clearAll(cls):
+        """Forget all answers of all buckets."""
+        with cls._instancesLock:
+            caches = list(cls._instances.values())
+        for cache in caches:
+            cache.clear()
+
+    def get(self, key, ttl, negativeTtl):
+        """Get the remembered answer for a key.
+
+        Parameters
+        ----------
+        key : string
+            The object key.
+        ttl : float
+            Maximum age in seconds of a positive answer.
+        negativeTtl : float
+            Maximum age in seconds of a negative answer.
+
+        Returns
+        -------
+        bool or None
+            True or False if a recent enough answer is known, else None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        exists, recorded = entry
+        if time.monotonic() - recorded >= (ttl if exists else negativeTtl):
+            return None
+        return exists
+
+    def generation(self):
+        """Get the current generation of the cache, to pass to `set` with an answer from the server.
+
+        Returns
+        -------
+        int
+            The number of changes recorded so far.
+        """
+        with self._lock:
+            return self._generation
+
+    def _changed(self, key):
+        """Record a change of a key made by this process. Caller must hold the lock."""
+        self._generation += 1
+        self._changes.pop(key, None)
+        self._changes[key] = self._generation
+        while len(self._changes) > self.maxEntries:
+            self._forgotten = self._changes.popitem(last=False)[1]
+
+    def set(self, key, exists, generation=None):
+        """Record whether a key exists.
+
+        Parameters
+        ----------
+        key : string
+            The object key.
+        exists : bool
+            True if the object exists.
+        generation : int, optional
+            The `generation` of the cache before the server was asked. The answer is dropped if this process
+            changed the key since. If None the answer is a change made by this process.
+        """
+        with self._lock:
+            if generation is None:
+                self._changed(key)
+            elif self._changes.get(key, self._forgotten) > generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (exists, time.monotonic())
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        """Forget what is known about a key, e.g. because a change of it failed.
+
+        Parameters
+        ----------
+        key : string
+            The object key.
+        """
+        with self._lock:
+            self._changed(key)
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget all answers."""
+        with self._lock:
+            self._generation += 1
+            self._forgotten = self._generation
+            self._changes.clear()
+            self._entries.clear()
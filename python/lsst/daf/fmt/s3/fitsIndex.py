@@ -0,0 +1,261 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import collections
+import json
+import re
+import threading
+
+__all__ = ['HduIndex', 'splitHduSuffix']
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+_hduSuffix = re.compile(r'^(.*)\[(\d+)\]$')
+
+
+def splitHduSuffix(path):
+    """Split an HDU indicator from a path.
+
+    Parameters
+    ----------
+    path : string
+        A path that may end with an HDU indicator, e.g. 'foo.fits[1]'.
+
+    Returns
+    -------
+    tuple
+        The path without the indicator and the HDU number as an int, or None if there was no indicator,
+        e.g. ('foo.fits', 1).
+    """
+    match = _hduSuffix.match(path)
+    if match is None:
+        return path, None
+    return match.group(1), int(match.group(2))
+
+
+def _padded(size):
+    """Round a size up to a whole number of FITS blocks."""
+    return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+class HduIndex:
+    """Byte offsets of the HDUs of a FITS object.
+
+    Each HDU is described by three offsets: the start of its header, the start of its data (which is the end
+    of its header) and the end of its padded data, which is also the start of the next HDU.
+
+    Parameters
+    ----------
+    size : int
+        The size of the FITS object in bytes.
+    hdus : list of tuple
+        ``(headerStart, dataStart, dataEnd)`` for each HDU, primary first.
+    etag : string, optional
+        The ETag of the object the index describes.
+    """
+
+    # (bucketName, key, etag) -> HduIndex, least recently used first.
+    _cache = collections.OrderedDict()
+    _cacheLock = threading.Lock()
+    maxCachedIndexes = 10000
+
+    def __init__(self, size, hdus, etag=None):
+        self.size = size
+        self.hdus = [tuple(hdu) for hdu in hdus]
+        self.etag = etag
+
+    def __len__(self):
+        return len(self.hdus)
+
+    def hduRange(self, hdu):
+        """Get the byte range of an HDU, header and data.
+
+        Parameters
+        ----------
+        hdu : int
+            The HDU number, 0 for the primary HDU.
+
+        Returns
+        -------
+        tuple
+            (start, end) of the HDU; end is exclusive.
+        """
+        headerStart, dataStart, dataEnd = self.hdus[hdu]
+        return headerStart, dataEnd
+
+    def headerRanges(self):
+        """Get the byte ranges of all the headers.
+
+        Returns
+        -------
+        list of tuple
+            (start, end) of each header; end is exclusive.
+        """
+        return [(headerStart, dataStart) for headerStart, dataStart, dataEnd in self.hdus]
+
+    @classmethod
+    def build(cls, readRange, size, etag=None, blocksPerRequest=4):
+        """Build the index of a FITS object by reading its headers.
+
+        Only the headers are read; the data of each HDU is skipped using the size computed from its header.
+
+        Parameters
+        ----------
+        readRange : callable
+            ``readRange(start, end)`` must return the bytes of the object from start to end (exclusive, and
+            no further than the end of the object).
+        size : int
+            The size of the object in bytes.
+        etag : string, optional
+            The ETag of the object, stored in the index.
+        blocksPerRequest : int
+            The number of FITS blocks requested at a time while looking for the end of a header.
+
+        Returns
+        -------
+        HduIndex
+            The index.
+
+        Raises
+        ------
+        RuntimeError
+            If the object is not a valid FITS file.
+        """
+        hdus = []
+        offset = 0
+        while offset < size:
+            header = b''
+            end = None
+            while end is None:
+                start = offset + len(header)
+                if start >= size:
+                    raise RuntimeError("FITS header at byte {} has no END card".format(offset))
+                header += readRange(start, min(start + blocksPerRequest * BLOCK_SIZE, size))
+                # only look at the new cards, but keep whole cards.
+                for cardStart in range(max(0, start - offset), len(header) - CARD_SIZE + 1, CARD_SIZE):
+                    if header[cardStart:cardStart + 8] == b'END     ':
+                        end = cardStart + CARD_SIZE
+                        break
+            dataStart = offset + _padded(end)
+            dataEnd = dataStart + _padded(cls._dataSize(header[:end], isPrimary=not hdus))
+            hdus.append((offset, dataStart, dataEnd))
+            offset = dataEnd
+        return cls(size, hdus, etag)
+
+    @staticmethod
+    def _dataSize(header, isPrimary):
+        """Compute the unpadded size of the data of an HDU from its header."""
+        values = {}
+        for cardStart in range(0, len(header), CARD_SIZE):
+            card = header[cardStart:cardStart + CARD_SIZE].decode('ascii', errors='replace')
+            if card[8:10] == '= ':
+                values[card[:8].strip()] = card[10:].split('/')[0].strip()
+        if isPrimary and values.get('SIMPLE') != 'T':
+            raise RuntimeError("Object does not start with a FITS primary header")
+        try:
+            naxis = int(values.get('NAXIS', 0))
+            if naxis == 0:
+                return 0
+            axes = [int(values['NAXIS{}'.format(i)]) for i in range(1, naxis + 1)]
+            bitpix = abs(int(values['BITPIX']))
+        except (KeyError, ValueError) as err:
+            raise RuntimeError("Invalid FITS header: {}".format(err))
+        if isPrimary and values.get('GROUPS') == 'T' and axes[0] == 0:
+            # random groups: NAXIS1 is 0 and does not count.
+            axes = axes[1:]
+        count = 1
+        for axis in axes:
+            count *= axis
+        pcount = int(values.get('PCOUNT', 0))
+        gcount = int(values.get('GCOUNT', 1))
+        return bitpix // 8 * gcount * (pcount + count)
+
+    def toJson(self):
+        """Serialize the index.
+
+        Returns
+        -------
+        string
+            The index as JSON.
+        """
+        return json.dumps(dict(size=self.size, etag=self.etag, hdus=self.hdus))
+
+    @classmethod
+    def fromJson(cls, text):
+        """Deserialize an index written by toJson.
+
+        Parameters
+        ----------
+        text : string or bytes
+            The JSON.
+
+        Returns
+        -------
+        HduIndex
+            The index.
+        """
+        record = json.loads(text)
+        return cls(record['size'], record['hdus'], record.get('etag'))
+
+    @classmethod
+    def getCached(cls, bucketName, key, etag):
+        """Get a cached index of a version of an object.
+
+        Parameters
+        ----------
+        bucketName : string
+            The bucket holding the object.
+        key : string
+            The key of the object.
+        etag : string
+            The ETag of the version of the object.
+
+        Returns
+        -------
+        HduIndex or None
+            The index, or None if it is not cached.
+        """
+        cacheKey = (bucketName, key, etag)
+        with cls._cacheLock:
+            index = cls._cache.get(cacheKey)
+            if index is not None:
+                cls._cache.move_to_end(cacheKey)
+        return index
+
+    @classmethod
+    def setCached(cls, bucketName, key, index):
+        """Cache the index of a version of an object; the version is the index's etag.
+
+        Parameters
+        ----------
+        bucketName : string
+            The bucket holding the object.
+        key : string
+            The key of the object.
+        index : HduIndex
+            The index to cache.
+        """
+        with cls._cacheLock:
+            cls._cache[(bucketName, key, index.etag)] = index
+            while len(cls._cache) > cls.maxCachedIndexes:
+                cls._cache.popitem(last=False)
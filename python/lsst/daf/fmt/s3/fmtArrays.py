@@ -0,0 +1,215 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import inspect
+import io
+import numpy as np
+import numpy.lib.format
+
+from .import S3Storage
+
+__all__ = ['writeArray', 'readArray']
+
+# The number of bytes of the first request of a read; enough for the header of most arrays.
+HEADER_READ_SIZE = 4096
+
+# numpy versions before 1.24 do not limit the size of the headers they read, nor take the limit as argument.
+_LIMITS_HEADER_SIZE = 'max_header_size' in inspect.signature(np.lib.format.read_array_header_1_0).parameters
+
+
+def writeArray(storage, path, array):
+    """Write a NumPy array as its raw buffer after a small header, in the NumPy ``.npy`` format.
+
+    The bytes are uploaded as they are written, see `UploadStream`, so the array is never serialized to a
+    temporary file.
+
+    Parameters
+    ----------
+    storage : S3Storage
+        The storage to write to.
+    path : string
+        The path to write, relative to the root of storage.
+    array : numpy.ndarray
+        The array. Arrays that are neither C nor Fortran contiguous are written in C order.
+
+    Raises
+    ------
+    RuntimeError
+        If the array holds Python objects, which have no raw buffer.
+    """
+    _writeArray(storage, storage._shardKey(path), array)
+
+
+def _writeArray(storage, key, array):
+    if array.dtype.hasobject:
+        raise RuntimeError("An array of {} holds Python objects and can not be written as a raw "
+                           "buffer".format(array.dtype))
+    if not (array.flags.c_contiguous or array.flags.f_contiguous):
+        array = np.ascontiguousarray(array)
+    header = io.BytesIO()
+    headerData = np.lib.format.header_data_from_array_1_0(array)
+    try:
+        np.lib.format.write_array_header_1_0(header, headerData)
+    except ValueError:
+        # the header is too large for format 1.0.
+        header = io.BytesIO()
+        np.lib.format.write_array_header_2_0(header, headerData)
+    with storage.transfer.openUpload(key, storage.config.pipelinedWriteBuffers) as stream:
+        stream.write(header.getvalue())
+        # order 'A' gives the bytes of a Fortran ordered array in the order its header records.
+        stream.write(array.reshape(-1, order='A').view(np.uint8))
+
+
+def readArray(storage, path, rows=None):
+    """Read a NumPy array written by `writeArray`, or some of its rows.
+
+    The header is read with the first bytes of the array, and the data straight into the new array; arrays
+    of at least multipartThreshold bytes are read with concurrent ranged GETs. When rows are given, only the
+    bytes of those rows are fetched.
+
+    Parameters
+    ----------
+    storage : S3Storage
+        The storage to read from.
+    path : string
+        The path to read, relative to the root of storage.
+    rows : int or slice, optional
+        The index, or the slice, of the first axis to read; the whole array if None. Only C ordered arrays
+        can be read in part.
+
+    Returns
+    -------
+    numpy.ndarray or None
+        The array, or ``array[rows]``; None if the object does not exist.
+
+    Raises
+    ------
+    RuntimeError
+        If the object is not a raw NumPy array, or rows are given for an array that is not C ordered or
+        has no axes.
+    """
+    key = storage._shardKey(path)
+    storage._settle(key)
+    return _readArray(storage, key, rows)
+
+
+def _readArray(storage, key, rows=None):
+    response = storage._getObject(key, Range='bytes=0-{}'.format(HEADER_READ_SIZE - 1))
+    if response is None:
+        return None
+    with response['Body'] as body:
+        first = body.read()
+    etag = response['ETag']
+    shape, fortranOrder, dtype, offset = _parseHeader(storage, key, first, etag)
+    if rows is None:
+        array = np.empty(shape, dtype, order='F' if fortranOrder else 'C')
+        _fill(storage, key, etag, array, offset, first)
+        return array
+    if fortranOrder or not shape:
+        raise RuntimeError("Rows can only be read from C ordered arrays with axes; {} is not one".format(key))
+    if isinstance(rows, slice):
+        indices = range(*rows.indices(shape[0]))
+    else:
+        indices = range(shape[0])[rows:rows + 1 or None]
+        if not indices:
+            raise IndexError("Index {} is out of bounds for the {} rows of {}".format(rows, shape[0], key))
+    if not indices:
+        return np.empty((0,) + shape[1:], dtype)
+    low, high = min(indices), max(indices) + 1
+    block = np.empty((high - low,) + shape[1:], dtype)
+    _fill(storage, key, etag, block, offset + low * block[:1].nbytes, first)
+    if not isinstance(rows, slice):
+        return block[0]
+    return block[indices.start - low::indices.step][:len(indices)]
+
+
+def _parseHeader(storage, key, first, etag):
+    """Parse the header of a raw array from its first bytes, reading more of them if needed.
+
+    Returns
+    -------
+    tuple
+        The shape, whether it is Fortran ordered, the dtype, and the offset of the data.
+    """
+    if not first.startswith(np.lib.format.MAGIC_PREFIX) or len(first) < 12:
+        raise RuntimeError("{} is not a raw NumPy array".format(key))
+    version = (first[6], first[7])
+    if version == (1, 0):
+        headerSize = 10 + int.from_bytes(first[8:10], 'little')
+        readHeader = np.lib.format.read_array_header_1_0
+    elif version == (2, 0):
+        headerSize = 12 + int.from_bytes(first[8:12], 'little')
+        readHeader = np.lib.format.read_array_header_2_0
+    else:
+        raise RuntimeError("{} has the unsupported NumPy format version {}.{}".format(key, *version))
+    if headerSize > len(first):
+        first = storage.transfer.readRange(key, 0, headerSize, etag)
+    header = io.BytesIO(first[:headerSize])
+    header.seek(8)
+    kwargs = {'max_header_size': headerSize} if _LIMITS_HEADER_SIZE else {}
+    shape, fortranOrder, dtype = readHeader(header, **kwargs)
+    return shape, fortranOrder, dtype, headerSize
+
+
+def _fill(storage, key, etag, array, start, first):
+    """Fill an array with the bytes of an object from start, using those already read in first."""
+    with memoryview(array.reshape(-1, order='A').view(np.uint8)) as raw:
+        have = first[start:start + len(raw)]
+        raw[:len(have)] = have
+        storage.transfer.readInto(key, raw[len(have):], start + len(have), etag)
+
+
+def writeNdarray(bucket, butlerLocation, obj):
+    """Write a NumPy array with `writeArray` to each location of butlerLocation.
+
+    Parameters
+    ----------
+    bucket : boto3.Bucket
+        Not used; the array is written by butlerLocation.storage.
+    butlerLocation : ButlerLocation
+        The location(s) to write.
+    obj : numpy.ndarray
+        The array to write.
+    """
+    for location in butlerLocation.getLocations():
+        _writeArray(butlerLocation.storage, location, obj)
+
+
+def readNdarray(bucket, butlerLocation):
+    """Read the NumPy arrays of each location of butlerLocation with `readArray`.
+
+    Parameters
+    ----------
+    bucket : boto3.Bucket
+        Not used; the arrays are read by butlerLocation.storage.
+    butlerLocation : ButlerLocation
+        The location(s) to read.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        The arrays; None for locations that do not exist.
+    """
+    return [_readArray(butlerLocation.storage, location) for location in butlerLocation.getLocations()]
+
+
+S3Storage.registerFormatters(np.ndarray, readNdarray, writeNdarray)
@@ -20,8 +20,6 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
-import botocore
-import tempfile
 import yaml
 
 from .import S3Storage
@@ -30,50 +28,41 @@ import lsst.daf.persistence as dafPersist
 
 __all__ = []
 
-remoteCfgName = 'repositoryCfg.yaml'
+remoteCfgName = S3Storage.repositoryCfgName
 
 
-def writeRepositoryCfg(bucket, butlerLocation, obj):
-    """Write a RepositoryCfg to an AWS bucket using boto3.
+def writeRepositoryCfg(stream, butlerLocation, obj):
+    """Write a RepositoryCfg to a stream that S3Storage uploads to the bucket.
 
     Parameters
     ----------
-    bucket : dict
-        A boto3 S3 Bucket
+    stream : file-like object
+        A writable binary stream.
     butlerLocation : ButlerLocation
         Location info for writing into the database.
-        Only getLocations is used.
+        Not used.
     obj : object instance
         The object to write into the database.
     """
     # TODO support for not-in-place cfgs (may be referring to a different repo elsewhere via different root)
     # TODO support for concurrency (HOW?)
-    with tempfile.NamedTemporaryFile('r+', prefix="FOO", encoding='utf-8') as f:
-        yaml.dump(obj, f)
-        f.flush()
-        with open(f.name, 'rb') as j:
-            bucket.put_object(Key=remoteCfgName, Body=j)
+    yaml.dump(obj, stream, encoding='utf-8')
 
 
-def readRepositoryCfg(bucket, butlerLocation):
-    """Read an RepositoryCfg from an AWS bucket using boto3.
+def readRepositoryCfg(stream, butlerLocation):
+    """Read a RepositoryCfg from a stream that S3Storage downloads from the bucket.
 
-    bucket : dict
-        A boto3 S3 Bucket
+    S3Storage returns None instead of calling this if the cfg does not exist in the bucket.
+
+    Parameters
+    ----------
+    stream : file-like object
+        A readable binary stream.
     butlerLocation : ButlerLocation
         Location info for reading from the database.
-        Only getLocations is used.
+        Not used.
     """
-    # TOOD this will probably raise something useful if the cfg does not exist in the bucket. Write a test for
-    # that and raise NoRepositoryAtCfg when it happens.
-    with tempfile.NamedTemporaryFile('w', prefix="BAR", encoding='utf-8') as f:
-        try:
-            bucket.download_file('repositoryCfg.yaml', f.name)
-        except botocore.exceptions.ClientError:
-            return None
-        with open(f.name, 'r') as j:
-            cfg = yaml.load(j)
-        return cfg
+    return yaml.load(stream)
 
 
-S3Storage.registerFormatters(dafPersist.RepositoryCfg, readRepositoryCfg, writeRepositoryCfg)
+S3Storage.registerStreamFormatters(dafPersist.RepositoryCfg, readRepositoryCfg, writeRepositoryCfg)
@@ -0,0 +1,160 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .import S3Storage
+from .streams import RangeReadStream
+
+__all__ = ['writeTable', 'readTable']
+
+# The number of bytes at the end of a Parquet object read by the first request; enough for most footers.
+FOOTER_READ_SIZE = 64 * 1024
+
+
+def _checkPyarrow():
+    if pyarrow is None:
+        raise RuntimeError("Tables can only be read and written with the pyarrow package")
+
+
+def writeTable(storage, path, table, **kwargs):
+    """Write an Arrow table in the Parquet format.
+
+    The bytes are uploaded as they are written, see `UploadStream`, so the table is never serialized to a
+    temporary file.
+
+    Parameters
+    ----------
+    storage : S3Storage
+        The storage to write to.
+    path : string
+        The path to write, relative to the root of storage.
+    table : pyarrow.Table
+        The table.
+    **kwargs
+        Passed to `pyarrow.parquet.write_table`, e.g. ``compression`` or ``row_group_size``.
+
+    Raises
+    ------
+    RuntimeError
+        If pyarrow is not available.
+    """
+    _checkPyarrow()
+    _writeTable(storage, storage._shardKey(path), table, **kwargs)
+
+
+def _writeTable(storage, key, table, **kwargs):
+    with storage.transfer.openUpload(key, storage.config.pipelinedWriteBuffers) as stream:
+        pyarrow.parquet.write_table(table, stream, **kwargs)
+
+
+def readTable(storage, path, columns=None):
+    """Read a table written in the Parquet format, or some of its columns.
+
+    The first request reads the end of the object, where the footer locates every column chunk, and each
+    chunk of the columns asked for is then read with a ranged GET, so the bytes of other columns are never
+    fetched.
+
+    Parameters
+    ----------
+    storage : S3Storage
+        The storage to read from.
+    path : string
+        The path to read, relative to the root of storage.
+    columns : list of string, optional
+        The names of the columns to read; all of them if None.
+
+    Returns
+    -------
+    pyarrow.Table or None
+        The table; None if the object does not exist.
+
+    Raises
+    ------
+    RuntimeError
+        If pyarrow is not available.
+    """
+    _checkPyarrow()
+    key = storage._shardKey(path)
+    storage._settle(key)
+    return _readTable(storage, key, columns)
+
+
+def _readTable(storage, key, columns=None):
+    response = storage._getObject(key, Range='bytes=-{}'.format(FOOTER_READ_SIZE))
+    if response is None:
+        return None
+    with response['Body'] as body:
+        tail = body.read()
+    etag = response['ETag']
+    size = int(response.get('ContentRange', '/{}'.format(response['ContentLength'])).split('/')[-1])
+    tailStart = size - len(tail)
+
+    def readRange(start, end):
+        if start >= tailStart:
+            return tail[start - tailStart:end - tailStart]
+        return storage.transfer.readRange(key, start, end, etag)
+
+    with RangeReadStream(readRange, size) as stream:
+        return pyarrow.parquet.ParquetFile(stream).read(columns=columns)
+
+
+def writeParquet(bucket, butlerLocation, obj):
+    """Write an Arrow table with `writeTable` to each location of butlerLocation.
+
+    Parameters
+    ----------
+    bucket : boto3.Bucket
+        Not used; the table is written by butlerLocation.storage.
+    butlerLocation : ButlerLocation
+        The location(s) to write.
+    obj : pyarrow.Table
+        The table to write.
+    """
+    for location in butlerLocation.getLocations():
+        _writeTable(butlerLocation.storage, location, obj)
+
+
+def readParquet(bucket, butlerLocation):
+    """Read the Arrow tables of each location of butlerLocation with `readTable`.
+
+    Parameters
+    ----------
+    bucket : boto3.Bucket
+        Not used; the tables are read by butlerLocation.storage.
+    butlerLocation : ButlerLocation
+        The location(s) to read.
+
+    Returns
+    -------
+    list of pyarrow.Table
+        The tables; None for locations that do not exist.
+    """
+    return [_readTable(butlerLocation.storage, location) for location in butlerLocation.getLocations()]
+
+
+if pyarrow is not None:
+    S3Storage.registerFormatters(pyarrow.Table, readParquet, writeParquet)
@@ -0,0 +1,248 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import bisect
+import collections
+import threading
+import time
+
+__all__ = ['KeyIndex']
+
+
+class _DirectoryListing:
+    """The sorted keys directly under one 'directory' prefix of a bucket."""
+
+    __slots__ = ('keys', 'built', 'refreshed')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.built = self.refreshed = time.monotonic()
+
+
+class KeyIndex:
+    """An in-memory index of the keys of a bucket, used to answer searches without requests.
+
+    Keys are grouped by 'directory', the part of the key up to and including the last '/'. The first lookup
+    in a directory lists it with one paginated ListObjectsV2 pass (with a '/' delimiter, so only the keys
+    directly in it are listed) and keeps its keys in a sorted list that is searched by bisection. Lookups in
+    a directory whose listing is older than ``ttl`` seconds first fetch only the keys sorting after the last
+    known one (ListObjectsV2 ``StartAfter``), which finds new keys appended in key order cheaply; a listing
+    older than ``rebuildInterval`` is replaced by a full one. Keys written by this process are added as they
+    are written. Keys written by other processes may be missing until then, so only hits are definite and
+    callers should confirm misses, e.g. with a HEAD request.
+
+    Use `forBucket` to get the index shared by all the storages of a bucket in the process.
+
+    Parameters
+    ----------
+    listKeys : callable
+        ``listKeys(prefix, startAfter)`` must return the keys directly under prefix (not in its
+        sub-directories) that sort after startAfter (all of them if startAfter is None), in order.
+    ttl : float
+        Seconds a directory listing is used before it is refreshed.
+    rebuildInterval : float
+        Seconds after which a directory is listed again in full.
+    maxDirectories : int
+        The maximum number of directories to keep; least recently used ones are dropped above it.
+    """
+
+    _instances = {}
+    _instancesLock = threading.Lock()
+
+    def __init__(self, listKeys, ttl, rebuildInterval, maxDirectories=10000):
+        self.listKeys = listKeys
+        self.ttl = ttl
+        self.rebuildInterval = rebuildInterval
+        self.maxDirectories = maxDirectories
+        self._lock = threading.Lock()
+        # directory prefix -> _DirectoryListing, least recently used first.
+        self._directories = collections.OrderedDict()
+        self._stats = dict(lookups=0, listings=0, refreshes=0)
+
+    @classmethod
+    def forBucket(cls, endpointUrl, bucketName, listKeys, ttl, rebuildInterval):
+        """Get the process-wide key index of a bucket, creating it if needed.
+
+        If the index already exists its ttl and rebuildInterval are updated to the passed-in values.
+
+        Parameters
+        ----------
+        endpointUrl : string or None
+            The S3 endpoint of the bucket; buckets of the same name on different endpoints have different
+            indexes.
+        bucketName : string
+            The name of the bucket.
+        listKeys : callable
+            See `KeyIndex`; only used if the index is created.
+        ttl : float
+            Seconds a directory listing is used before it is refreshed.
+        rebuildInterval : float
+            Seconds after which a directory is listed again in full.
+
+        Returns
+        -------
+        KeyIndex
+            The index of bucketName.
+        """
+        with cls._instancesLock:
+            index = cls._instances.get((endpointUrl, bucketName))
+            if index is None:
+                index = cls._instances[(endpointUrl, bucketName)] = cls(listKeys, ttl, rebuildInterval)
+            else:
+                index.ttl = ttl
+                index.rebuildInterval = rebuildInterval
+        return index
+
+    @classmethod
+    def clearAll(cls):
+        """Drop the indexes of all buckets."""
+        with cls._instancesLock:
+            cls._instances.clear()
+
+    @staticmethod
+    def _directory(key):
+        return key[:key.rfind('/') + 1]
+
+    def _getListing(self, directory):
+        """Get the up-to-date listing of a directory, listing it if needed."""
+        with self._lock:
+            listing = self._directories.get(directory)
+            if listing is not None:
+                self._directories.move_to_end(directory)
+        now = time.monotonic()
+        if listing is not None and now - listing.built >= self.rebuildInterval:
+            listing = None
+        if listing is None:
+            listing = _DirectoryListing(list(self.listKeys(directory, None)))
+            with self._lock:
+                self._stats['listings'] += 1
+                self._directories[directory] = listing
+                while len(self._directories) > self.maxDirectories:
+                    self._directories.popitem(last=False)
+        elif now - listing.refreshed >= self.ttl:
+            with self._lock:
+                lastKey = listing.keys[-1] if listing.keys else None
+            newKeys = list(self.listKeys(directory, lastKey))
+            with self._lock:
+                self._stats['refreshes'] += 1
+                for key in newKeys:
+                    self._insert(listing, key)
+                listing.refreshed = now
+        return listing
+
+    @staticmethod
+    def _insert(listing, key):
+        """Add a key to a listing, keeping it sorted. Caller must hold the lock."""
+        i = bisect.bisect_left(listing.keys, key)
+        if i == len(listing.keys) or listing.keys[i] != key:
+            listing.keys.insert(i, key)
+
+    def contains(self, key):
+        """Test if a key exists.
+
+        Parameters
+        ----------
+        key : string
+            The key to look for.
+
+        Returns
+        -------
+        bool
+            True if the key is in the index.
+        """
+        listing = self._getListing(self._directory(key))
+        with self._lock:
+            self._stats['lookups'] += 1
+            i = bisect.bisect_left(listing.keys, key)
+            return i < len(listing.keys) and listing.keys[i] == key
+
+    def keysWithPrefix(self, prefix):
+        """Get the keys that start with a prefix and have no '/' after it.
+
+        Parameters
+        ----------
+        prefix : string
+            The key prefix, e.g. 'raw/v1/foo'.
+
+        Returns
+        -------
+        list of string
+            The matching keys, sorted.
+        """
+        listing = self._getListing(self._directory(prefix))
+        with self._lock:
+            self._stats['lookups'] += 1
+            start = bisect.bisect_left(listing.keys, prefix)
+            keys = []
+            for key in listing.keys[start:]:
+                if not key.startswith(prefix):
+                    break
+                keys.append(key)
+        return keys
+
+    def add(self, key):
+        """Record that a key was created. Directories that are not indexed yet are not affected.
+
+        Parameters
+        ----------
+        key : string
+            The new key.
+        """
+        with self._lock:
+            listing = self._directories.get(self._directory(key))
+            if listing is not None:
+                self._insert(listing, key)
+
+    def discard(self, key):
+        """Record that a key was deleted.
+
+        Parameters
+        ----------
+        key : string
+            The deleted key.
+        """
+        with self._lock:
+            listing = self._directories.get(self._directory(key))
+            if listing is not None:
+                i = bisect.bisect_left(listing.keys, key)
+                if i < len(listing.keys) and listing.keys[i] == key:
+                    del listing.keys[i]
+
+    def clear(self):
+        """Drop all directory listings."""
+        with self._lock:
+            self._directories.clear()
+
+    def stats(self):
+        """Get the index counters.
+
+        Returns
+        -------
+        dict
+            ``lookups`` counts searches, ``listings`` full directory listings and ``refreshes`` incremental
+            ones; ``directories`` and ``keys`` describe the current contents.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['directories'] = len(self._directories)
+            stats['keys'] = sum(len(listing.keys) for listing in self._directories.values())
+        return stats
@@ -0,0 +1,355 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import collections
+import getpass
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from .fitsIndex import splitHduSuffix
+
+__all__ = ['LocalFileCache']
+
+
+class _CacheEntry:
+    """Bookkeeping for one file in a LocalFileCache."""
+
+    __slots__ = ('bucketName', 'key', 'etag', 'lastModified', 'size', 'path', 'validated')
+
+    def __init__(self, bucketName, key, etag, lastModified, size, path, validated=0.):
+        self.bucketName = bucketName
+        self.key = key
+        self.etag = etag
+        self.lastModified = lastModified
+        self.size = size
+        self.path = path
+        # time.monotonic() of the last time the entry was known to match the server, 0 if never.
+        self.validated = validated
+
+
+class LocalFileCache:
+    """A persistent, size-bounded directory of local copies of S3 objects.
+
+    Files are stored under a name derived from the bucket and key (keeping the key's extension, so readers
+    that look at it still work) next to a small JSON record of the object's ETag and Last-Modified time. The
+    records are reloaded when a cache is opened on an existing directory, so the cache survives across
+    processes on the same node. When the total size exceeds the byte budget the least recently used files
+    are deleted.
+
+    Before a cached file is returned it is revalidated against the server by comparing ETags, unless it was
+    validated less than ``ttl`` seconds ago.
+
+    Use `forDirectory` to get the cache instance shared by everything in the process using a directory.
+
+    Parameters
+    ----------
+    cacheDir : string or None
+        The directory to hold the cache. It is created if it does not exist. If None a per-user directory
+        in the system temporary directory is used.
+    maxBytes : int
+        The byte budget of the cache.
+    ttl : float
+        Number of seconds a validated file is trusted without asking the server again.
+    """
+
+    _instances = {}
+    _instancesLock = threading.Lock()
+
+    def __init__(self, cacheDir, maxBytes, ttl=0.):
+        if cacheDir is None:
+            cacheDir = self.defaultCacheDir()
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self._dataDir = os.path.join(cacheDir, 'data')
+        self._metaDir = os.path.join(cacheDir, 'meta')
+        os.makedirs(self._dataDir, exist_ok=True)
+        os.makedirs(self._metaDir, exist_ok=True)
+        self._lock = threading.Lock()
+        # (bucketName, key) -> _CacheEntry, least recently used first.
+        self._entries = collections.OrderedDict()
+        # (bucketName, key) -> the cache keys of the copies of HDUs of that object, see invalidate.
+        self._hduKeys = collections.defaultdict(set)
+        self._totalBytes = 0
+        self.resetStats()
+        self._load()
+
+    @staticmethod
+    def defaultCacheDir():
+        """Get the cache directory used when none is configured.
+
+        Returns
+        -------
+        string
+            A per-user directory in the system temporary directory.
+        """
+        return os.path.join(tempfile.gettempdir(), 'lsst-daf-fmt-s3-{}'.format(getpass.getuser()))
+
+    @classmethod
+    def forDirectory(cls, cacheDir, maxBytes, ttl=0.):
+        """Get the process-wide cache for a directory, creating it if needed.
+
+        If the cache already exists its byte budget and ttl are updated to the passed-in values.
+
+        Parameters
+        ----------
+        cacheDir : string or None
+            The cache directory, see `LocalFileCache`.
+        maxBytes : int
+            The byte budget of the cache.
+        ttl : float
+            Number of seconds a validated file is trusted without asking the server again.
+
+        Returns
+        -------
+        LocalFileCache
+            The cache using cacheDir.
+        """
+        if cacheDir is None:
+            cacheDir = cls.defaultCacheDir()
+        cacheDir = os.path.abspath(cacheDir)
+        with cls._instancesLock:
+            cache = cls._instances.get(cacheDir)
+            if cache is None:
+                cache = cls._instances[cacheDir] = cls(cacheDir, maxBytes, ttl)
+            else:
+                cache.maxBytes = maxBytes
+                cache.ttl = ttl
+        return cache
+
+    def resetStats(self):
+        """Set the hit, miss and eviction counters to zero."""
+        self._stats = dict(hits=0, misses=0, revalidations=0, evictions=0, bytesDownloaded=0,
+                           bytesEvicted=0)
+
+    def stats(self):
+        """Get the cache counters.
+
+        Returns
+        -------
+        dict
+            ``hits`` and ``misses`` count getFile calls served from and not served from the cache,
+            ``revalidations`` counts hits that needed a request to the server to check the ETag,
+            ``evictions`` and ``bytesEvicted`` count files deleted to stay within the byte budget,
+            ``bytesDownloaded`` counts bytes fetched on misses. ``files`` and ``bytes`` describe the current
+            contents of the cache.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['files'] = len(self._entries)
+            stats['bytes'] = self._totalBytes
+        return stats
+
+    def _baseName(self, bucketName, key):
+        digest = hashlib.sha1('{}/{}'.format(bucketName, key).encode('utf-8')).hexdigest()
+        # keep the extension of the object, without any HDU indicator.
+        return digest, os.path.splitext(splitHduSuffix(key)[0])[1]
+
+    @staticmethod
+    def _diskUsage(path):
+        """Get the number of bytes a file uses on disk, which for sparse files is less than their size."""
+        stat = os.stat(path)
+        blocks = getattr(stat, 'st_blocks', None)
+        if blocks is None:
+            return stat.st_size
+        return min(stat.st_size, blocks * 512)
+
+    def _load(self):
+        """Rebuild the index from the records in the cache directory, ordered by file modification time."""
+        entries = []
+        for metaName in os.listdir(self._metaDir):
+            if not metaName.endswith('.json'):
+                continue
+            metaPath = os.path.join(self._metaDir, metaName)
+            try:
+                with open(metaPath, 'r') as f:
+                    record = json.load(f)
+                path = os.path.join(self._dataDir, record['fileName'])
+                mtime = os.stat(path).st_mtime
+            except (OSError, ValueError, KeyError):
+                # incomplete or orphaned record; the data will be fetched again if needed.
+                self._removeFiles(metaPath, None)
+                continue
+            entries.append((mtime, _CacheEntry(record['bucketName'], record['key'], record['etag'],
+                                               record['lastModified'], record['size'], path)))
+        with self._lock:
+            for mtime, entry in sorted(entries, key=lambda item: item[0]):
+                self._add((entry.bucketName, entry.key), entry)
+            self._evict()
+
+    @staticmethod
+    def _removeFiles(metaPath, dataPath):
+        for path in (metaPath, dataPath):
+            if path is None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _metaPath(self, entry):
+        digest, _ = self._baseName(entry.bucketName, entry.key)
+        return os.path.join(self._metaDir, digest + '.json')
+
+    def _add(self, cacheKey, entry):
+        """Add an entry, replacing any entry of the same key. Caller must hold the lock."""
+        self._pop(cacheKey)
+        self._entries[cacheKey] = entry
+        self._totalBytes += entry.size
+        bucketName, key = cacheKey
+        objectKey, hdu = splitHduSuffix(key)
+        if hdu is not None:
+            self._hduKeys[(bucketName, objectKey)].add(cacheKey)
+
+    def _pop(self, cacheKey):
+        """Remove an entry from the index and return it, or None. Caller must hold the lock."""
+        entry = self._entries.pop(cacheKey, None)
+        if entry is None:
+            return None
+        self._totalBytes -= entry.size
+        bucketName, key = cacheKey
+        objectKey, hdu = splitHduSuffix(key)
+        if hdu is not None:
+            hduKeys = self._hduKeys.get((bucketName, objectKey))
+            if hduKeys is not None:
+                hduKeys.discard(cacheKey)
+                if not hduKeys:
+                    del self._hduKeys[(bucketName, objectKey)]
+        return entry
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries until the cache is within budget. Caller must hold the lock.
+
+        Parameters
+        ----------
+        keep : tuple, optional
+            The (bucketName, key) of an entry that must not be evicted, e.g. the one being returned.
+        """
+        for cacheKey in list(self._entries):
+            if self._totalBytes <= self.maxBytes:
+                break
+            if cacheKey == keep:
+                continue
+            entry = self._pop(cacheKey)
+            self._stats['evictions'] += 1
+            self._stats['bytesEvicted'] += entry.size
+            self._removeFiles(self._metaPath(entry), entry.path)
+
+    def _touch(self, cacheKey, entry):
+        """Mark an entry as most recently used. Caller must hold the lock."""
+        self._entries.move_to_end(cacheKey)
+        try:
+            os.utime(entry.path)
+        except OSError:
+            pass
+
+    def getFile(self, bucketName, key, fetch, validate):
+        """Get the path of a local copy of an object, downloading it if needed.
+
+        Parameters
+        ----------
+        bucketName : string
+            The name of the bucket holding the object.
+        key : string
+            The key of the object.
+        fetch : callable
+            ``fetch(localPath)`` must download the object to localPath and return a tuple
+            ``(etag, lastModified)`` describing the downloaded version.
+        validate : callable
+            ``validate(etag, lastModified)`` must return True if the object on the server still matches the
+            given ETag and Last-Modified time.
+
+        Returns
+        -------
+        string
+            The path to the local copy. The file may be evicted by a later call; open it promptly (an open
+            file remains readable after eviction).
+        """
+        cacheKey = (bucketName, key)
+        with self._lock:
+            entry = self._entries.get(cacheKey)
+        if entry is not None and os.path.exists(entry.path):
+            fresh = self.ttl > 0 and time.monotonic() - entry.validated < self.ttl
+            if not fresh and validate(entry.etag, entry.lastModified):
+                fresh = True
+                entry.validated = time.monotonic()
+                with self._lock:
+                    self._stats['revalidations'] += 1
+            if fresh:
+                with self._lock:
+                    if self._entries.get(cacheKey) is entry:
+                        self._stats['hits'] += 1
+                        self._touch(cacheKey, entry)
+                        return entry.path
+
+        digest, ext = self._baseName(bucketName, key)
+        fd, tmpPath = tempfile.mkstemp(dir=self._dataDir, prefix='.' + digest, suffix=ext)
+        os.close(fd)
+        try:
+            etag, lastModified = fetch(tmpPath)
+            size = self._diskUsage(tmpPath)
+            path = os.path.join(self._dataDir, digest + ext)
+            os.replace(tmpPath, path)
+        except BaseException:
+            self._removeFiles(tmpPath, None)
+            raise
+        newEntry = _CacheEntry(bucketName, key, etag, lastModified, size, path, time.monotonic())
+        metaPath = self._metaPath(newEntry)
+        # concurrent processes filling the cache with the same object must not share the temporary.
+        fd, tmpPath = tempfile.mkstemp(dir=self._metaDir, prefix='.' + digest, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(bucketName=bucketName, key=key, etag=etag, lastModified=lastModified,
+                               size=size, fileName=os.path.basename(path)), f)
+            os.replace(tmpPath, metaPath)
+        except BaseException:
+            self._removeFiles(tmpPath, None)
+            raise
+        with self._lock:
+            self._add(cacheKey, newEntry)
+            self._stats['misses'] += 1
+            self._stats['bytesDownloaded'] += size
+            self._evict(keep=cacheKey)
+        return path
+
+    def invalidate(self, bucketName, key):
+        """Forget the cached copies of an object, e.g. because it was overwritten.
+
+        Both the copy of the whole object and those of its HDUs (cached under the key with an HDU indicator,
+        e.g. 'foo.fits[2]') are forgotten.
+
+        Parameters
+        ----------
+        bucketName : string
+            The name of the bucket holding the object.
+        key : string
+            The key of the object.
+        """
+        with self._lock:
+            cacheKeys = [(bucketName, key)] + list(self._hduKeys.get((bucketName, key), ()))
+            entries = [entry for entry in map(self._pop, cacheKeys) if entry is not None]
+        for entry in entries:
+            self._removeFiles(self._metaPath(entry), entry.path)
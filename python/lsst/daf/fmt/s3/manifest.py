@@ -0,0 +1,601 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""A manifest of the objects of a repository, kept in the repository itself.
+
+The manifest is stored under `MANIFEST_PREFIX`, next to the RepositoryCfg. It is made of a base, a gzipped
+JSON object holding one entry per key, and delta segments, small JSON-lines objects written by the processes
+that create objects. Segments are never modified: each names its writer's records, and the segments newer
+than the base are applied on top of it in name (i.e. time) order when the manifest is loaded. Once enough
+segments pile up, a loader compacts them into a new base and deletes them, if the server enforces the
+conditions of conditional writes.
+
+Run ``s3Manifest.py --help`` for the command line that rebuilds a manifest from a full listing.
+"""
+
+import argparse
+import atexit
+import gzip
+import json
+import sys
+import threading
+import time
+import uuid
+import warnings
+
+import botocore.exceptions
+
+__all__ = ['RepositoryManifest']
+
+# The keys of the manifest objects start with this; they are not listed in the manifest.
+MANIFEST_PREFIX = 'repositoryManifest/'
+BASE_KEY = MANIFEST_PREFIX + 'base.json.gz'
+SEGMENT_PREFIX = MANIFEST_PREFIX + 'segments/'
+# An object written to check that the server rejects writes whose condition does not hold.
+PROBE_KEY = MANIFEST_PREFIX + 'conditionalWriteProbe'
+
+# The error codes of a conditional write whose condition did not hold.
+PRECONDITION_FAILED = ('412', 'PreconditionFailed', 'ConditionalRequestConflict')
+
+# Seconds during which a segment may still appear after segments with later names were seen: the clocks of
+# writers differ and their uploads take time. Refreshes look back this far, and compaction leaves younger
+# segments alone.
+SETTLE_SECONDS = 300.
+
+
+def _segmentKey(timestamp, suffix=''):
+    """Get the key of a segment written at a time; names sort in time order."""
+    return '{}{:014d}-{}'.format(SEGMENT_PREFIX, int(timestamp * 1000), suffix)
+
+
+def _segmentTime(key):
+    return int(key[len(SEGMENT_PREFIX):].split('-', 1)[0]) / 1000.
+
+
+class RepositoryManifest:
+    """The keys of a repository, with their size, ETag and dataset type, loaded once per process.
+
+    The manifest is loaded on the first lookup and kept in a dict from key to a ``(size, etag,
+    datasetType)`` tuple, so `contains` and `get` never make a request. Every ``refreshInterval`` seconds a
+    lookup first lists the segments written since the last refresh and applies them.
+
+    Writes are recorded with `record`: they are visible to this process at once and buffered until
+    ``segmentEntries`` records are waiting, `flush` is called or the process exits, then written as one
+    segment. Until then other processes do not know about these writes: their `contains` answers False for
+    the keys, even though the objects exist. Call `flush` before telling them about the objects. When loading
+    the manifest finds more than ``compactSegments`` settled segments on top of the base, they are compacted
+    (see `compact`).
+
+    The manifest only knows about objects whose writers record them; use `rebuild` when objects were written
+    or deleted by other means.
+
+    Use `forBucket` to get the manifest shared by all the storages of a bucket in the process.
+
+    Parameters
+    ----------
+    getClient : callable
+        ``getClient()`` must return the S3 client to send requests with.
+    bucketName : string
+        The bucket of the repository.
+    refreshInterval : float
+        Seconds between two checks for new segments.
+    segmentEntries : int
+        The number of buffered records that triggers writing a segment.
+    compactSegments : int
+        The number of settled segments that triggers a compaction.
+    """
+
+    _instances = {}
+    _instancesLock = threading.Lock()
+
+    def __init__(self, getClient, bucketName, refreshInterval, segmentEntries, compactSegments):
+        self.getClient = getClient
+        self.bucketName = bucketName
+        self.refreshInterval = refreshInterval
+        self.segmentEntries = segmentEntries
+        self.compactSegments = compactSegments
+        self._lock = threading.Lock()
+        self._loadLock = threading.Lock()
+        # key -> (size, etag, datasetType); None until loaded.
+        self._entries = None
+        self._refreshed = self._refreshedWallTime = None
+        # segment key -> its time, for the segments applied within the last SETTLE_SECONDS.
+        self._recentSegments = {}
+        # key -> record not written to a segment yet, see record.
+        self._pending = {}
+        # whether the server enforces the conditions of writes; None until checked, see compact.
+        self._conditionalWrites = None
+        self._stats = dict(lookups=0, loads=0, refreshes=0, segmentsRead=0, segmentsWritten=0, compactions=0)
+
+    @classmethod
+    def forBucket(cls, getClient, endpointUrl, bucketName, refreshInterval, segmentEntries, compactSegments):
+        """Get the process-wide manifest of a bucket, creating it if needed.
+
+        If the manifest already exists its settings are updated to the passed-in values. A new manifest writes
+        its buffered records when the process exits.
+
+        Parameters
+        ----------
+        getClient : callable
+            See `RepositoryManifest`; only used if the manifest is created.
+        endpointUrl : string or None
+            The S3 endpoint of the bucket; buckets of the same name on different endpoints have different
+            manifests.
+        bucketName : string
+            The name of the bucket.
+        refreshInterval : float
+            Seconds between two checks for new segments.
+        segmentEntries : int
+            The number of buffered records that triggers writing a segment.
+        compactSegments : int
+            The number of settled segments that triggers a compaction.
+
+        Returns
+        -------
+        RepositoryManifest
+            The manifest of bucketName.
+        """
+        with cls._instancesLock:
+            manifest = cls._instances.get((endpointUrl, bucketName))
+            if manifest is None:
+                manifest = cls._instances[(endpointUrl, bucketName)] = cls(getClient, bucketName,
+                                                                           refreshInterval, segmentEntries,
+                                                                           compactSegments)
+                atexit.register(manifest.close)
+            else:
+                manifest.refreshInterval = refreshInterval
+                manifest.segmentEntries = segmentEntries
+                manifest.compactSegments = compactSegments
+        return manifest
+
+    @classmethod
+    def clearAll(cls):
+        """Drop the manifests of all buckets. Records that were not written yet are lost."""
+        with cls._instancesLock:
+            manifests = list(cls._instances.values())
+            cls._instances.clear()
+        for manifest in manifests:
+            atexit.unregister(manifest.close)
+
+    @staticmethod
+    def isManifestKey(key):
+        """Test if a key is one of the manifest's own objects."""
+        return key.startswith(MANIFEST_PREFIX)
+
+    def _readBase(self, client):
+        """Get the entries of the base, the last segment merged into it and its ETag (None if none)."""
+        try:
+            response = client.get_object(Bucket=self.bucketName, Key=BASE_KEY)
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return {}, '', None
+            raise
+        base = json.loads(gzip.decompress(response['Body'].read()).decode('utf-8'))
+        entries = {key: (size, etag, None if datasetType is None else sys.intern(datasetType))
+                   for key, size, etag, datasetType in base['entries']}
+        return entries, base['through'], response['ETag']
+
+    def _writeBase(self, client, entries, through, etag):
+        """Replace the base, unless it changed since it was read with the given ETag.
+
+        Returns
+        -------
+        bool
+            False if another process replaced the base first.
+        """
+        base = dict(version=1, through=through,
+                    entries=[[key, size, entryEtag, datasetType]
+                             for key, (size, entryEtag, datasetType) in sorted(entries.items())])
+        condition = {'IfNoneMatch': '*'} if etag is None else {'IfMatch': etag}
+        try:
+            client.put_object(Bucket=self.bucketName, Key=BASE_KEY,
+                              Body=gzip.compress(json.dumps(base, separators=(',', ':')).encode('utf-8')),
+                              **condition)
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] in PRECONDITION_FAILED:
+                return False
+            raise
+        return True
+
+    def _checkConditionalWrites(self, client):
+        """Check, the first time, that the server rejects a write whose condition does not hold.
+
+        Servers that do not implement conditional writes ignore the conditions, and write the object anyway.
+
+        Returns
+        -------
+        bool
+            True if the conditions are enforced.
+        """
+        if self._conditionalWrites is None:
+            client.put_object(Bucket=self.bucketName, Key=PROBE_KEY, Body=b'')
+            try:
+                client.put_object(Bucket=self.bucketName, Key=PROBE_KEY, Body=b'', IfNoneMatch='*')
+            except botocore.exceptions.ClientError as err:
+                if err.response['Error']['Code'] not in PRECONDITION_FAILED:
+                    raise
+                self._conditionalWrites = True
+            else:
+                warnings.warn("The server of {} ignores the conditions of writes; its manifest is not "
+                              "compacted".format(self.bucketName))
+                self._conditionalWrites = False
+        return self._conditionalWrites
+
+    def _listSegments(self, client, startAfter):
+        """List the keys of the segments whose names sort after startAfter, in order."""
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucketName, Prefix=SEGMENT_PREFIX,
+                                       StartAfter=max(startAfter, SEGMENT_PREFIX)):
+            for entry in page.get('Contents', ()):
+                yield entry['Key']
+
+    def _readSegment(self, client, key):
+        """Get the records of a segment, or None if it was compacted and deleted meanwhile."""
+        try:
+            body = client.get_object(Bucket=self.bucketName, Key=key)['Body'].read()
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return [json.loads(line) for line in body.decode('utf-8').splitlines() if line]
+
+    @staticmethod
+    def _apply(entries, records):
+        """Apply the records of a segment to entries, see `record`."""
+        for record in records:
+            key = record[0]
+            if len(record) == 1:
+                entries.pop(key, None)
+                continue
+            size, etag, datasetType = record[1:]
+            old = entries.get(key)
+            if old is not None:
+                size = old[0] if size is None else size
+                etag = old[1] if etag is None else etag
+                datasetType = old[2] if datasetType is None else datasetType
+            entries[key] = (size, etag, None if datasetType is None else sys.intern(datasetType))
+
+    def _load(self):
+        """Load the manifest, or apply the segments written since the last refresh, as needed."""
+        if self._entries is not None and time.monotonic() - self._refreshed < self.refreshInterval:
+            return
+        with self._loadLock:
+            if self._entries is not None and time.monotonic() - self._refreshed < self.refreshInterval:
+                return
+            client = self.getClient()
+            full = self._entries is None
+            while True:
+                wallTime = time.time()
+                if full:
+                    entries, through, etag = self._readBase(client)
+                    startAfter = through
+                    applied = {}
+                else:
+                    entries = None
+                    startAfter = _segmentKey(self._refreshedWallTime - SETTLE_SECONDS)
+                    applied = self._recentSegments
+                newSegments = []
+                settled = 0
+                missing = False
+                for key in self._listSegments(client, startAfter):
+                    settled += _segmentTime(key) < wallTime - SETTLE_SECONDS
+                    if key in applied:
+                        continue
+                    records = self._readSegment(client, key)
+                    if records is None:
+                        missing = True
+                        break
+                    newSegments.append((key, records))
+                if not missing:
+                    break
+                # a compaction deleted segments this process had not read; they are in the new base.
+                full = True
+            with self._lock:
+                if entries is None:
+                    entries = self._entries
+                    self._stats['refreshes'] += 1
+                else:
+                    self._stats['loads'] += 1
+                    self._recentSegments = {}
+                for key, records in newSegments:
+                    self._apply(entries, records)
+                    self._recentSegments[key] = _segmentTime(key)
+                self._stats['segmentsRead'] += len(newSegments)
+                # this process's own writes that are not in a segment yet win over older segments.
+                self._apply(entries, self._pending.values())
+                # the next refresh lists the segments from SETTLE_SECONDS before this one.
+                self._recentSegments = {key: segmentTime
+                                        for key, segmentTime in self._recentSegments.items()
+                                        if segmentTime >= wallTime - SETTLE_SECONDS}
+                self._entries = entries
+                self._refreshed = time.monotonic()
+                self._refreshedWallTime = wallTime
+        if full and settled > self.compactSegments:
+            self.compact()
+
+    def contains(self, key):
+        """Test if a key exists.
+
+        Parameters
+        ----------
+        key : string
+            The key to look for.
+
+        Returns
+        -------
+        bool
+            True if the key is in the manifest.
+        """
+        self._load()
+        with self._lock:
+            self._stats['lookups'] += 1
+            return key in self._entries
+
+    def get(self, key):
+        """Get the manifest entry of a key.
+
+        Parameters
+        ----------
+        key : string
+            The key.
+
+        Returns
+        -------
+        tuple or None
+            ``(size, etag, datasetType)`` of the key, or None if it is not in the manifest. The size and ETag
+            are None while a write-behind upload of the key is not finished, and the dataset type is None if
+            the writer did not know it.
+        """
+        self._load()
+        with self._lock:
+            self._stats['lookups'] += 1
+            return self._entries.get(key)
+
+    def __len__(self):
+        self._load()
+        with self._lock:
+            return len(self._entries)
+
+    def record(self, key, size=None, etag=None, datasetType=None):
+        """Record that a key was written.
+
+        Values that are None leave those of the existing entry of the key, if any, unchanged, so a write can
+        be recorded in steps, e.g. its dataset type when it is queued and its ETag once it is uploaded.
+
+        Parameters
+        ----------
+        key : string
+            The key that was written.
+        size : int, optional
+            The size of the object.
+        etag : string, optional
+            The ETag of the object.
+        datasetType : string, optional
+            The dataset type of the object.
+        """
+        self._add(key, [key, size, etag, datasetType])
+
+    def discard(self, key):
+        """Record that a key was deleted.
+
+        Parameters
+        ----------
+        key : string
+            The deleted key.
+        """
+        self._add(key, [key])
+
+    def _add(self, key, record):
+        with self._lock:
+            old = self._pending.get(key)
+            if old is not None and len(old) > 1 and len(record) > 1:
+                record = [key] + [new if new is not None else previous for new, previous in
+                                  zip(record[1:], old[1:])]
+            self._pending.pop(key, None)
+            self._pending[key] = record
+            if self._entries is not None:
+                self._apply(self._entries, [record])
+            full = len(self._pending) >= self.segmentEntries
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records as a new segment."""
+        with self._lock:
+            records, self._pending = list(self._pending.values()), {}
+        if not records:
+            return
+        key = _segmentKey(time.time(), uuid.uuid4().hex)
+        body = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        try:
+            self.getClient().put_object(Bucket=self.bucketName, Key=key, Body=body.encode('utf-8'))
+        except BaseException:
+            with self._lock:
+                # keep the records for the next flush, unless newer records of the same keys came meanwhile.
+                for record in records:
+                    self._pending.setdefault(record[0], record)
+            raise
+        with self._lock:
+            self._recentSegments[key] = _segmentTime(key)
+            self._stats['segmentsWritten'] += 1
+
+    def close(self):
+        """Write the buffered records. Errors are reported as warnings, since close is called at exit where
+        they could not be handled."""
+        try:
+            self.flush()
+        except Exception as err:
+            warnings.warn("Could not write the manifest records of {}: {}".format(self.bucketName, err))
+
+    def clear(self):
+        """Forget the loaded manifest and the records not written yet, e.g. because the bucket was
+        recreated."""
+        with self._loadLock, self._lock:
+            self._entries = None
+            self._pending = {}
+            self._recentSegments = {}
+
+    def compact(self):
+        """Merge the settled segments into the base, and delete them.
+
+        The base is replaced with a conditional write, so if several processes compact at the same time only
+        one succeeds and the others leave the segments alone. Servers that ignore the conditions of writes
+        would let them delete segments that are not in the base they wrote, so the manifest of a bucket on
+        such a server is never compacted (the first compaction checks the server, and warns).
+
+        Returns
+        -------
+        bool
+            True if this call compacted the manifest.
+        """
+        client = self.getClient()
+        if not self._checkConditionalWrites(client):
+            return False
+        entries, through, etag = self._readBase(client)
+        settledBefore = time.time() - SETTLE_SECONDS
+        merged = []
+        for key in self._listSegments(client, through):
+            if _segmentTime(key) >= settledBefore:
+                break
+            records = self._readSegment(client, key)
+            if records is None:
+                # another process compacted meanwhile.
+                return False
+            self._apply(entries, records)
+            merged.append(key)
+        if not merged or not self._writeBase(client, entries, merged[-1], etag):
+            return False
+        self._deleteKeys(client, merged)
+        with self._lock:
+            self._stats['compactions'] += 1
+        return True
+
+    def rebuild(self, progress=None):
+        """Replace the manifest with one made from a full listing of the bucket.
+
+        Dataset types are kept from the current manifest for keys whose ETag did not change. All segments
+        written before the listing started are superseded and deleted; records written during the listing
+        are applied on top of the new base.
+
+        Parameters
+        ----------
+        progress : callable, optional
+            Called as ``progress(count)`` with the number of keys listed so far after each page of the
+            listing.
+
+        Returns
+        -------
+        int
+            The number of keys in the new manifest.
+        """
+        self.flush()
+        client = self.getClient()
+        oldEntries, through, etag = self._readBase(client)
+        # segments written from here on may describe objects the listing misses, so they are kept.
+        superseded = list(self._listSegments(client, through))
+        for key in superseded:
+            records = self._readSegment(client, key)
+            if records is not None:
+                self._apply(oldEntries, records)
+        entries = {}
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucketName):
+            for entry in page.get('Contents', ()):
+                key = entry['Key']
+                if self.isManifestKey(key):
+                    continue
+                old = oldEntries.get(key)
+                datasetType = old[2] if old is not None and old[1] == entry['ETag'] else None
+                entries[key] = (entry['Size'], entry['ETag'], datasetType)
+            if progress is not None:
+                progress(len(entries))
+        if not self._writeBase(client, entries, superseded[-1] if superseded else through, etag):
+            raise RuntimeError("The manifest of {} was changed by another process during the rebuild".format(
+                self.bucketName))
+        self._deleteKeys(client, superseded)
+        with self._loadLock, self._lock:
+            # loaded again, with the records written since, on the next lookup.
+            self._entries = None
+            self._recentSegments = {}
+        return len(entries)
+
+    def _deleteKeys(self, client, keys):
+        for start in range(0, len(keys), 1000):
+            client.delete_objects(Bucket=self.bucketName,
+                                  Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]],
+                                          'Quiet': True})
+
+    def stats(self):
+        """Get the manifest counters.
+
+        Returns
+        -------
+        dict
+            ``lookups`` counts contains and get calls; ``loads`` and ``refreshes`` count full loads and checks
+            for new segments, ``segmentsRead`` and ``segmentsWritten`` the segments applied and written, and
+            ``compactions`` the successful compactions by this process. ``entries`` is the number of keys
+            (None until loaded) and ``pending`` the number of records not written yet.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = None if self._entries is None else len(self._entries)
+            stats['pending'] = len(self._pending)
+        return stats
+
+
+def main(argv=None):
+    """Rebuild, compact or describe the manifest of a repository from the command line.
+
+    Parameters
+    ----------
+    argv : list of string, optional
+        The arguments; sys.argv[1:] if None.
+
+    Returns
+    -------
+    int
+        The exit status.
+    """
+    parser = argparse.ArgumentParser(description="Maintain the manifest of an S3 repository.")
+    parser.add_argument('uri', help="the repository, e.g. s3://my-bucket")
+    parser.add_argument('command', choices=('rebuild', 'compact', 'stats'),
+                        help="rebuild the manifest from a full listing, merge its settled segments, or print "
+                        "its size")
+    args = parser.parse_args(argv)
+
+    from .s3Storage import S3Storage
+    storage = S3Storage(args.uri, create=False)
+    manifest = RepositoryManifest.forBucket(lambda: storage.s3.meta.client, storage.config.endpointUrl,
+                                            storage.bucketName,
+                                            storage.config.manifestRefreshInterval,
+                                            storage.config.manifestSegmentEntries,
+                                            storage.config.manifestCompactSegments)
+    if args.command == 'rebuild':
+        count = manifest.rebuild(progress=lambda count: sys.stderr.write("listed {} keys\r".format(count)))
+        sys.stdout.write("\nthe manifest of {} lists {} keys\n".format(args.uri, count))
+    elif args.command == 'compact':
+        compacted = manifest.compact()
+        sys.stdout.write("compacted\n" if compacted else "nothing to compact\n")
+    else:
+        len(manifest)
+        sys.stdout.write(json.dumps(manifest.stats(), indent=2) + '\n')
+    return 0
@@ -0,0 +1,214 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import collections
+import threading
+import time
+
+__all__ = ['ObjectCache']
+
+
+class _CachedObject:
+    """One object held by an ObjectCache."""
+
+    __slots__ = ('value', 'etag', 'size', 'validated')
+
+    def __init__(self, value, etag, size):
+        self.value = value
+        self.etag = etag
+        self.size = size
+        # time.monotonic() of the last time the entry was known to match the server.
+        self.validated = time.monotonic()
+
+
+class ObjectCache:
+    """An in-memory, byte-budgeted LRU cache of objects read from S3, shared by the whole process.
+
+    Values are whatever the storage chooses to keep for a key, e.g. a deserialized object or the bytes it is
+    deserialized from, along with the ETag of the version they were made from and their size in bytes. When
+    the sizes add up to more than ``maxBytes`` the least recently used values are dropped; values larger
+    than the whole budget are not kept.
+
+    A cached value is returned without a request for ``ttl`` seconds after it was read or revalidated.
+    After that it is revalidated with a conditional request made by the caller's fetch function, which only
+    transfers the object if its ETag changed.
+
+    Use `shared` to get the cache instance of the process.
+
+    Parameters
+    ----------
+    maxBytes : int
+        The byte budget of the cache; 0 disables it.
+    ttl : float
+        Seconds a value is trusted without revalidating its ETag; ``float('inf')`` never revalidates.
+    """
+
+    _instance = None
+    _instanceLock = threading.Lock()
+
+    def __init__(self, maxBytes, ttl=float('inf')):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (bucketName, key) -> _CachedObject, least recently used first.
+        self._entries = collections.OrderedDict()
+        self._totalBytes = 0
+        # incremented whenever entries are discarded, so a fetch that raced with a write is not cached.
+        self._generation = 0
+        self.resetStats()
+
+    @classmethod
+    def shared(cls, maxBytes, ttl):
+        """Get the process-wide object cache, creating it if needed.
+
+        If the cache already exists its byte budget and ttl are updated to the passed-in values.
+
+        Parameters
+        ----------
+        maxBytes : int
+            The byte budget of the cache.
+        ttl : float
+            Seconds a value is trusted without revalidating its ETag.
+
+        Returns
+        -------
+        ObjectCache
+            The cache.
+        """
+        with cls._instanceLock:
+            if cls._instance is None:
+                cls._instance = cls(maxBytes, ttl)
+            else:
+                cls._instance.maxBytes = maxBytes
+                cls._instance.ttl = ttl
+                with cls._instance._lock:
+                    cls._instance._evict()
+            return cls._instance
+
+    @classmethod
+    def clearAll(cls):
+        """Drop all the values of the process-wide cache, if it exists."""
+        with cls._instanceLock:
+            cache = cls._instance
+        if cache is not None:
+            cache.clear()
+
+    def resetStats(self):
+        """Set the hit, miss and eviction counters to zero."""
+        self._stats = dict(hits=0, misses=0, revalidations=0, evictions=0)
+
+    def stats(self):
+        """Get the cache counters.
+
+        Returns
+        -------
+        dict
+            ``hits`` and ``misses`` count getObject calls served from and not served from the cache,
+            ``revalidations`` counts hits that needed a conditional request, ``evictions`` counts values
+            dropped to stay within the byte budget. ``objects`` and ``bytes`` describe the current contents.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['objects'] = len(self._entries)
+            stats['bytes'] = self._totalBytes
+        return stats
+
+    def _evict(self):
+        """Drop least recently used values until the cache is within its budget. Caller must hold the lock."""
+        while self._entries and self._totalBytes > self.maxBytes:
+            cacheKey, entry = self._entries.popitem(last=False)
+            self._totalBytes -= entry.size
+            self._stats['evictions'] += 1
+
+    def getObject(self, bucketName, key, fetch):
+        """Get the cached value of an object, fetching it if it is not cached or has changed.
+
+        Parameters
+        ----------
+        bucketName : string
+            The name of the bucket holding the object.
+        key : string
+            The key of the object.
+        fetch : callable
+            ``fetch(etag)`` must read the object and return a tuple ``(value, etag, size)``. If etag is not
+            None it may instead return None when the object's ETag on the server is still etag. Exceptions,
+            e.g. because the object does not exist, are passed on to the caller.
+
+        Returns
+        -------
+        object
+            The value.
+        """
+        cacheKey = (bucketName, key)
+        with self._lock:
+            entry = self._entries.get(cacheKey)
+            if entry is not None:
+                self._entries.move_to_end(cacheKey)
+            generation = self._generation
+        if entry is not None:
+            if time.monotonic() - entry.validated < self.ttl:
+                with self._lock:
+                    self._stats['hits'] += 1
+                return entry.value
+            fetched = fetch(entry.etag)
+            if fetched is None:
+                entry.validated = time.monotonic()
+                with self._lock:
+                    self._stats['hits'] += 1
+                    self._stats['revalidations'] += 1
+                return entry.value
+        else:
+            fetched = fetch(None)
+        value, etag, size = fetched
+        with self._lock:
+            self._stats['misses'] += 1
+            if self._generation == generation and size <= self.maxBytes:
+                old = self._entries.pop(cacheKey, None)
+                if old is not None:
+                    self._totalBytes -= old.size
+                self._entries[cacheKey] = _CachedObject(value, etag, size)
+                self._totalBytes += size
+                self._evict()
+        return value
+
+    def discard(self, bucketName, key):
+        """Forget the value of an object, e.g. because it was overwritten.
+
+        Parameters
+        ----------
+        bucketName : string
+            The name of the bucket holding the object.
+        key : string
+            The key of the object.
+        """
+        with self._lock:
+            self._generation += 1
+            entry = self._entries.pop((bucketName, key), None)
+            if entry is not None:
+                self._totalBytes -= entry.size
+
+    def clear(self):
+        """Forget all values."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._totalBytes = 0
@@ -0,0 +1,271 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import concurrent.futures
+import shutil
+import tempfile
+import threading
+
+from .stats import S3Stats
+
+__all__ = ['Prefetcher']
+
+# The counters of Prefetcher.stats, besides those of the current state.
+_COUNTERS = ('requested', 'hits', 'hitBytes', 'cancelled', 'wasted', 'wastedBytes', 'errors')
+
+
+class _Prefetch:
+    """A prefetched object: its content in a spooled temporary file, or None if the object does not exist."""
+
+    __slots__ = ('key', 'future', 'state', 'buffer', 'size', 'metadata', 'cancelled', 'taken')
+
+    def __init__(self, key):
+        self.key = key
+        self.future = None
+        # 'queued' or 'running' until the download ends as 'done' or 'failed'.
+        self.state = 'queued'
+        self.buffer = None
+        self.size = 0
+        self.metadata = None
+        self.cancelled = False
+        # set when a reader waits for the download, which then no longer waits for the budget.
+        self.taken = False
+
+
+class Prefetcher:
+    """Downloads objects in the background, in the order they will be read, within a byte budget.
+
+    `prefetch` gives the keys that are going to be read; they are downloaded in that order by ``threads``
+    threads into temporary files that stay in memory up to ``spillThreshold`` bytes and spill to
+    ``spoolDir`` beyond. Downloaded objects are held until `take` hands them to the reader. When the held
+    objects add up to more than ``maxBytes``, downloads wait until enough of them are taken or dropped, so a
+    prefetch that runs far ahead of the reader does not fill memory or disk.
+
+    Objects that are dropped after they were downloaded, because a later `prefetch` no longer lists them,
+    they were `cancel`\\ led or `discard`\\ ed, count as wasted.
+
+    Parameters
+    ----------
+    download : callable
+        ``download(key)`` must return the get_object response of key, or None if it does not exist.
+    maxBytes : int
+        The budget of downloaded bytes held at a time.
+    threads : int
+        The number of downloads run at the same time.
+    spillThreshold : int
+        Objects larger than this are held in a file in spoolDir.
+    spoolDir : string, optional
+        The directory for spilled objects; the system temporary directory if None.
+    """
+
+    def __init__(self, download, maxBytes, threads, spillThreshold, spoolDir=None):
+        self.download = download
+        self.maxBytes = maxBytes
+        self.spillThreshold = spillThreshold
+        self.spoolDir = spoolDir
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._condition = threading.Condition()
+        # key -> _Prefetch, in the order they were asked for.
+        self._entries = {}
+        self._heldBytes = 0
+        self._stats = dict.fromkeys(_COUNTERS, 0)
+
+    def prefetch(self, keys):
+        """Start downloading keys, and drop the prefetches of keys that are no longer needed.
+
+        Parameters
+        ----------
+        keys : iterable of string
+            The keys that are going to be read, in the order they will be. Prefetches of other keys that were
+            not taken yet are cancelled, and their bytes dropped if they were already downloaded.
+        """
+        keys = list(dict.fromkeys(keys))
+        wanted = set(keys)
+        with self._condition:
+            for key in [key for key in self._entries if key not in wanted]:
+                self._drop(self._entries.pop(key))
+            for key in keys:
+                if key not in self._entries:
+                    entry = self._entries[key] = _Prefetch(key)
+                    self._stats['requested'] += 1
+                    entry.future = self._pool.submit(S3Stats.bind(self._fetch), entry)
+
+    def _fetch(self, entry):
+        try:
+            response = self.download(entry.key)
+            size = 0 if response is None else response['ContentLength']
+            with self._condition:
+                # the response is taken before waiting so its size is known; the wait holds its connection.
+                while (not entry.cancelled and not entry.taken and self._heldBytes and
+                       self._heldBytes + size > self.maxBytes):
+                    self._condition.wait()
+                if entry.cancelled:
+                    entry.state = 'done'
+                    self._stats['cancelled'] += 1
+                    if response is not None:
+                        response['Body'].close()
+                    return
+                entry.state = 'running'
+                self._heldBytes += size
+                entry.size = size
+            if response is not None:
+                entry.buffer = tempfile.SpooledTemporaryFile(max_size=self.spillThreshold, dir=self.spoolDir)
+                with response['Body'] as body:
+                    shutil.copyfileobj(body, entry.buffer, 1024**2)
+                entry.buffer.seek(0)
+                entry.metadata = response.get('Metadata')
+        except Exception:
+            with self._condition:
+                entry.state = 'failed'
+                self._stats['errors'] += 1
+                self._release(entry, wasted=False)
+            raise
+        with self._condition:
+            entry.state = 'done'
+            if entry.cancelled:
+                # dropped while it downloaded.
+                self._release(entry, wasted=True)
+
+    def _drop(self, entry):
+        """Cancel a prefetch, or release what it downloaded. Caller must hold the lock."""
+        entry.cancelled = True
+        if entry.future.cancel():
+            self._stats['cancelled'] += 1
+        elif entry.state == 'done':
+            self._release(entry, wasted=True)
+        # a running download sees that it was cancelled when it ends.
+        self._condition.notify_all()
+
+    def _release(self, entry, wasted):
+        """Release the bytes of a downloaded prefetch. Caller must hold the lock."""
+        if wasted:
+            self._stats['wasted'] += 1
+            self._stats['wastedBytes'] += entry.size
+        self._heldBytes -= entry.size
+        entry.size = 0
+        if entry.buffer is not None:
+            entry.buffer.close()
+            entry.buffer = None
+        self._condition.notify_all()
+
+    def take(self, key):
+        """Get a prefetched object, waiting for its download if it is running.
+
+        Parameters
+        ----------
+        key : string
+            The key to read.
+
+        Returns
+        -------
+        tuple or None
+            None if key is not prefetched, or its download has not started or failed; the caller should then
+            read it itself. Otherwise ``(buffer, metadata)``: the content of the object in a binary file
+            positioned at its start, which the caller must close, and the object's user metadata; buffer is
+            None if the object does not exist.
+        """
+        with self._condition:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry.future.cancel():
+                self._stats['cancelled'] += 1
+                return None
+            entry.taken = True
+            self._condition.notify_all()
+        try:
+            entry.future.result()
+        except Exception:
+            return None
+        with self._condition:
+            buffer, metadata = entry.buffer, entry.metadata
+            self._stats['hits'] += 1
+            self._stats['hitBytes'] += entry.size
+            # the caller owns the buffer from now on.
+            entry.buffer = None
+            self._release(entry, wasted=False)
+        return buffer, metadata
+
+    def discard(self, key):
+        """Drop the prefetch of a key, e.g. because the object changed.
+
+        Parameters
+        ----------
+        key : string
+            The key.
+        """
+        with self._condition:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._drop(entry)
+
+    def cancel(self, keys=None):
+        """Drop prefetches.
+
+        Parameters
+        ----------
+        keys : iterable of string, optional
+            The keys whose prefetches to drop; all of them if None.
+        """
+        with self._condition:
+            for key in list(self._entries) if keys is None else keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._drop(entry)
+
+    def stats(self):
+        """Get the prefetch counters.
+
+        Returns
+        -------
+        dict
+            ``requested`` counts the prefetches started, ``hits`` (and ``hitBytes``) those read, ``cancelled``
+            those dropped before they were downloaded, ``wasted`` (and ``wastedBytes``) those dropped after,
+            and ``errors`` the downloads that failed. ``hitRate`` is the fraction of the prefetches that
+            were read, of those read or dropped. ``pending`` is the number of prefetches not taken yet and
+            ``heldBytes`` the bytes they hold.
+        """
+        with self._condition:
+            return self._makeStats(self._stats, len(self._entries), self._heldBytes)
+
+    @staticmethod
+    def emptyStats():
+        """Get the counters of a prefetcher that was not used; see `stats`.
+
+        Returns
+        -------
+        dict
+            The counters, all zero.
+        """
+        return Prefetcher._makeStats(dict.fromkeys(_COUNTERS, 0), 0, 0)
+
+    @staticmethod
+    def _makeStats(counters, pending, heldBytes):
+        stats = dict(counters, pending=pending, heldBytes=heldBytes)
+        resolved = stats['hits'] + stats['cancelled'] + stats['wasted']
+        stats['hitRate'] = stats['hits'] / resolved if resolved else 0.
+        return stats
+
+    def close(self):
+        """Drop all prefetches and stop the download threads."""
+        self.cancel()
+        self._pool.shutdown(wait=True)
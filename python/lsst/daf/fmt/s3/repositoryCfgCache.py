@@ -0,0 +1,153 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import copy
+import threading
+import time
+
+__all__ = ['RepositoryCfgCache']
+
+
+class _CachedCfg:
+    """A parsed RepositoryCfg and the ETag of the object it was parsed from."""
+
+    __slots__ = ('etag', 'cfg', 'validated')
+
+    def __init__(self, etag, cfg):
+        self.etag = etag
+        self.cfg = cfg
+        # time.monotonic() of the last time the ETag was known to match the server.
+        self.validated = time.monotonic()
+
+
+class RepositoryCfgCache:
+    """Process-wide cache of parsed RepositoryCfgs, keyed by bucket name.
+
+    S3Storage uses it to revalidate a cached cfg with a conditional GET (``If-None-Match``) instead of
+    downloading and parsing it again, or to skip the request entirely while the cfg is younger than a time to
+    live. Callers always get their own copy of the cfg, so changes made to it do not leak into the cache.
+    """
+
+    _lock = threading.Lock()
+    _entries = {}
+    _stats = dict(hits=0, revalidations=0, misses=0)
+
+    @classmethod
+    def get(cls, bucketName):
+        """Get the cached entry of a bucket.
+
+        Parameters
+        ----------
+        bucketName : string
+            The name of the repository's bucket.
+
+        Returns
+        -------
+        tuple or None
+            ``(etag, age)`` of the cached cfg, where age is the number of seconds since it was last
+            validated, or None if nothing is cached.
+        """
+        with cls._lock:
+            entry = cls._entries.get(bucketName)
+            if entry is None:
+                return None
+            return entry.etag, time.monotonic() - entry.validated
+
+    @classmethod
+    def use(cls, bucketName, revalidated):
+        """Get a copy of the cached cfg of a bucket and count the cache hit.
+
+        Parameters
+        ----------
+        bucketName : string
+            The name of the repository's bucket.
+        revalidated : bool
+            True if the server was asked and confirmed the cached ETag, which also restarts its time to
+            live.
+
+        Returns
+        -------
+        RepositoryCfg or None
+            A copy of the cached cfg, or None if it was removed meanwhile.
+        """
+        with cls._lock:
+            entry = cls._entries.get(bucketName)
+            if entry is None:
+                return None
+            if revalidated:
+                entry.validated = time.monotonic()
+                cls._stats['revalidations'] += 1
+            else:
+                cls._stats['hits'] += 1
+            cfg = entry.cfg
+        return copy.deepcopy(cfg)
+
+    @classmethod
+    def set(cls, bucketName, etag, cfg):
+        """Cache a freshly downloaded cfg.
+
+        Parameters
+        ----------
+        bucketName : string
+            The name of the repository's bucket.
+        etag : string
+            The ETag of the cfg object.
+        cfg : RepositoryCfg
+            The parsed cfg; a copy is cached.
+        """
+        entry = _CachedCfg(etag, copy.deepcopy(cfg))
+        with cls._lock:
+            cls._entries[bucketName] = entry
+            cls._stats['misses'] += 1
+
+    @classmethod
+    def invalidate(cls, bucketName):
+        """Forget the cached cfg of a bucket.
+
+        Parameters
+        ----------
+        bucketName : string
+            The name of the repository's bucket.
+        """
+        with cls._lock:
+            cls._entries.pop(bucketName, None)
+
+    @classmethod
+    def stats(cls):
+        """Get the cache counters.
+
+        Returns
+        -------
+        dict
+            ``hits`` counts cfgs returned without a request, ``revalidations`` cfgs returned after a
+            conditional GET answered "not modified", ``misses`` cfgs that were downloaded and parsed.
+        """
+        with cls._lock:
+            return dict(cls._stats)
+
+    @classmethod
+    def clear(cls):
+        """Forget all cached cfgs and reset the counters."""
+        with cls._lock:
+            cls._entries.clear()
+            for name in cls._stats:
+                cls._stats[name] = 0
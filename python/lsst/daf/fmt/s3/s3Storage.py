@@ -22,17 +22,61 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
-import boto3
-import botocore
+import asyncio
+import botocore.exceptions
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import importlib
+import io
+import os
+import shutil
+import tempfile
+import threading
 import urllib.parse
+import weakref
 
 import lsst.daf.persistence as dafPersist
+from .bulk import BulkOperationError, BulkResult
+from .clientPool import ClientPool
+from .compression import METADATA_KEY, decodeStream, getCodec
+from .existenceCache import ExistenceCache
+from .fitsIndex import HduIndex, splitHduSuffix
+from .keyIndex import KeyIndex
+from .localFileCache import LocalFileCache
+from .manifest import RepositoryManifest
+from .objectCache import ObjectCache
+from .prefetch import Prefetcher
+from .repositoryCfgCache import RepositoryCfgCache
+from .s3StorageConfig import S3StorageConfig
+from .singleFlight import SingleFlight
+from .stats import S3Stats
+from .streams import AsyncReadStream, AsyncWriteStream, S3ReadStream
+from .transfer import COPY_SOURCE_ETAG_KEY, TransferEngine
+from .writeBehind import WriteBehindQueue
 
 
 # this class emits warnings. some say they are intended:
 # https://github.com/boto/boto3/issues/454
 
 
+class _SharedRead:
+    """The result of one GET shared by concurrent reads of a key: the decoded content if it is small enough
+    to hold in memory, else the response, which only one of the readers can stream."""
+
+    def __init__(self, data=None, response=None):
+        self.data = data
+        self._response = response
+        self._lock = threading.Lock()
+
+    def takeResponse(self):
+        """Get the response if no other reader took it yet, else None."""
+        with self._lock:
+            response, self._response = self._response, None
+        return response
+
+
 class S3Storage(dafPersist.StorageInterface):
     """Defines the interface for a connection to an S3 Storage.
 
@@ -58,46 +102,419 @@ class S3Storage(dafPersist.StorageInterface):
         specified by uri then NoRepositroyAtRoot is raised.
     """
 
+    # The key of the persisted RepositoryCfg, relative to the bucket root.
+    repositoryCfgName = 'repositoryCfg.yaml'
+
+    _streamReadFormatters = {}
+    _streamWriteFormatters = {}
+    _asyncReadFormatters = {}
+    _asyncWriteFormatters = {}
+
+    # qualified type name -> module of this package that registers formatters for that type when imported.
+    # The modules are imported the first time an object of the type is read or written, so importing this
+    # package does not import the libraries of the types.
+    _formatterModules = {
+        'numpy.ndarray': '.fmtArrays',
+        'pyarrow.lib.Table': '.fmtTables',
+    }
+
+    # Appended to the key of a FITS object to get the key of its HDU index sidecar.
+    hduIndexSuffix = '.hduindex.json'
+
+    # python type -> name of the codec objects of that type are compressed with, or None.
+    _compressionCodecs = {}
+
+    # python type -> 'object' or 'bytes', how objects of that type are kept in the object cache.
+    _objectCacheModes = {}
+
+    # bucket name -> S3Storage, see _getStorage.
+    _storages = {}
+    _storagesLock = threading.Lock()
+
+    # bucket name -> S3StorageConfig settings recorded in the repository's RepositoryCfg.
+    _repositorySettings = {}
+
+    # (endpoint URL, bucket name) of the buckets known to exist, see _checkBucket.
+    _checkedBuckets = set()
+
     def __init__(self, uri, create):
         """initialzer"""
         parseRes = urllib.parse.urlparse(uri)
         if parseRes.scheme.upper() != "S3":
             raise RuntimeError("S3Storage does not support scheme:{}".format(parseRes.scheme))
-        self.s3 = boto3.resource('s3')
+        self.bucketName = self._parseBucketName(uri)
+        self.config = S3StorageConfig()
+        self.config.applyRepositorySettings(self._repositorySettings.get(self.bucketName, {}))
+        if self.config.stats:
+            S3Stats.enable()
+            if self.config.statsDumpFile is not None:
+                S3Stats.startPeriodicDump(self.config.statsDumpFile, self.config.statsDumpInterval)
+        self._existenceCache = ExistenceCache.forBucket(self.config.endpointUrl, self.bucketName)
+        # the index is shared by the storages of the bucket, so it must not keep this one alive.
+        self._keyIndex = KeyIndex.forBucket(self.config.endpointUrl, self.bucketName,
+                                            self._directoryLister(self._clientGetter(), self.bucketName),
+                                            self.config.keyIndexTtl, self.config.keyIndexRebuildInterval)
+        self._uri = uri
+        self._create = create
+        self._s3 = None
+        self._s3Lock = threading.Lock()
+        self._bucket = None
+        if not create:
+            # a missing repository is reported by the constructor; creating one waits for the first request.
+            self._getResource()
+        self._localCache = None
+        self._transfer = None
+        self._threadLocal = threading.local()
+        self._readPool = None
+        self._readPoolLock = threading.Lock()
+        self._asyncPool = None
+        # event loop -> asyncio.Semaphore bounding the requests of this storage in flight on that loop.
+        self._asyncSemaphores = weakref.WeakKeyDictionary()
+        self._writeBehind = None
+        self._writeBehindLock = threading.Lock()
+        self._prefetcher = None
+        # coalesces concurrent reads, exists checks and downloads of the same key, see _readStream.
+        self._flights = SingleFlight()
+
+    @property
+    def s3(self):
+        """The pooled boto3 S3 resource (see `ClientPool`).
+
+        boto3 is imported, and the bucket checked and created if needed (see `_checkBucket`), when it is first
+        used, so constructing a storage does not cost a request or the import."""
+        if self._s3 is None:
+            return self._getResource()
+        return self._s3
+
+    def _clientGetter(self):
+        """Get a callable returning the pooled client of this storage's settings, that does not refer to the
+        storage, for process-wide objects that outlive it."""
+        return functools.partial(ClientPool.getClient, self.config.endpointUrl, self.config.profile,
+                                 self.config.maxPoolConnections, self.config.maxAttempts,
+                                 self.config.adaptiveConcurrency)
+
+    def _getResource(self):
+        """Get the pooled resource and check the bucket, the first time this storage needs them."""
+        with self._s3Lock:
+            if self._s3 is None:
+                s3 = ClientPool.getResource(self.config.endpointUrl, self.config.profile,
+                                            self.config.maxPoolConnections, self.config.maxAttempts,
+                                            self.config.adaptiveConcurrency)
+                self._checkBucket(s3)
+                self._s3 = s3
+            return self._s3
+
+    @property
+    def bucket(self):
+        """The boto3 Bucket of this storage, passed to formatters."""
+        if self._bucket is None:
+            self._bucket = self.s3.Bucket(self.bucketName)
+        return self._bucket
+
+    def _checkBucket(self, s3):
+        """Make sure the bucket exists, creating it if the storage was made with create=True.
+
+        A bucket is only checked once per process; clearSharedState forgets which ones were.
+
+        Parameters
+        ----------
+        s3 : boto3.resources.base.ServiceResource
+            The resource to send the requests with.
+
+        Raises
+        ------
+        NoRepositroyAtRoot
+            If the bucket does not exist and create was False.
+        """
+        checkKey = (self.config.endpointUrl, self.bucketName)
+        if checkKey in self._checkedBuckets:
+            return
+        if not self._bucketExists(s3.meta.client):
+            if not self._create:
+                raise dafPersist.NoRepositroyAtRoot(self._uri)
+            s3.create_bucket(Bucket=self.bucketName)
+            # anything remembered about a bucket of the same name is out of date.
+            self._existenceCache.clear()
+            self._keyIndex.clear()
+            self.objectCache.clear()
+            if self.manifest is not None:
+                self.manifest.clear()
+            RepositoryCfgCache.invalidate(self.bucketName)
+        self._checkedBuckets.add(checkKey)
 
+    @staticmethod
+    def _parseBucketName(uri):
+        """Get the bucket name from a storage URI."""
+        parseRes = urllib.parse.urlparse(uri)
         # if the URI is specified with 2 slashes the bucket name will be in the netLoc. If it has more than 2
         # it will be in the path, and may have leading slashes.
-        self.bucketName = (parseRes.netloc or parseRes.path).lstrip('/')
-        if self._bucketExists(uri) is False:
-            if create is True:
-                self.s3.create_bucket(Bucket=self.bucketName)
-            else:
-                raise dafPersist.NoRepositroyAtRoot(uri)
-        self.bucket = self.s3.Bucket(self.bucketName)
+        return (parseRes.netloc or parseRes.path).lstrip('/')
 
-    def _bucketExists(self, uri):
-        """Query if the bucket exists
+    def _shardKey(self, key):
+        """Get the key an object is stored under in this repository's layout, see the shardPrefixLength
+        setting. The RepositoryCfg is always stored under its own name, so it can be found before the layout
+        is known."""
+        length = self.config.shardPrefixLength
+        if length <= 0 or key == self.repositoryCfgName:
+            return key
+        directory = key[:key.rfind('/') + 1]
+        return hashlib.md5(directory.encode('utf-8')).hexdigest()[:length] + '/' + key
+
+    def _shardPath(self, path):
+        """Get the stored key of a path that may have an HDU indicator, keeping the indicator."""
+        objectName = splitHduSuffix(path)[0]
+        return self._shardKey(objectName) + path[len(objectName):]
+
+    def _shardLocation(self, butlerLocation):
+        """Get a ButlerLocation with the stored keys of the locations of butlerLocation, for formatters that
+        talk to S3 themselves."""
+        if self.config.shardPrefixLength <= 0:
+            return butlerLocation
+        shardedLocation = copy.copy(butlerLocation)
+        shardedLocation.locationList = [self._shardKey(location)
+                                        for location in butlerLocation.getLocations()]
+        return shardedLocation
+
+    def _shardPrefixes(self):
+        """Get the shard prefixes of this layout; a prefix of keys is spread over all of them."""
+        length = self.config.shardPrefixLength
+        if length <= 0:
+            return ['']
+        return ['{:0{}x}/'.format(i, length) for i in range(16**length)]
+
+    @classmethod
+    def _getStorage(cls, uri, create=True):
+        """Get the process-wide S3Storage for the bucket named by a URI, creating it if needed.
+
+        Reusing the storage avoids probing the bucket again each time a RepositoryCfg is read or written.
 
         Parameters
         ----------
         uri : string
-            The name of the bucket.
+            URI of the storage, see `S3Storage`.
+        create : bool
+            If True and a new storage is made, create the bucket if it does not exist.
+
+        Returns
+        -------
+        S3Storage
+            The storage for the bucket.
+        """
+        bucketName = cls._parseBucketName(uri)
+        with cls._storagesLock:
+            storage = cls._storages.get(bucketName)
+        if storage is None:
+            storage = cls(uri, create)
+            with cls._storagesLock:
+                storage = cls._storages.setdefault(bucketName, storage)
+        return storage
+
+    @classmethod
+    def clearSharedState(cls):
+        """Forget the storages, RepositoryCfgs, key indexes, manifests, existence answers and cached objects
+        shared within this process.
+
+        Use this when buckets were deleted or recreated behind the process's back, e.g. between tests.
+        """
+        with cls._storagesLock:
+            cls._storages.clear()
+        cls._repositorySettings.clear()
+        cls._checkedBuckets.clear()
+        RepositoryCfgCache.clear()
+        ExistenceCache.clearAll()
+        KeyIndex.clearAll()
+        RepositoryManifest.clearAll()
+        ObjectCache.clearAll()
+
+    def _bucketExists(self, client):
+        """Query if the bucket exists
+
+        Parameters
+        ----------
+        client : botocore.client.S3
+            The client to send the request with.
 
         Returns
         -------
         bool
-            True if the bucket exists else false.
+            True if the bucket exists else false. A bucket owned by someone else exists.
         """
         try:
-            self.s3.meta.client.head_bucket(Bucket=uri)
+            client.head_bucket(Bucket=self.bucketName)
             return True
-        except botocore.exceptions.ParamValidationError:
-            # The bucket does not exist or you have no access.
-            return False
+        except botocore.exceptions.ClientError as err:
+            code = err.response['Error']['Code']
+            if code in ('404', 'NoSuchBucket', 'NotFound'):
+                return False
+            if code in ('403', 'AccessDenied', 'Forbidden'):
+                return True
+            raise
+
+    @classmethod
+    def registerStreamFormatters(cls, formatable, readFormatter=None, writeFormatter=None):
+        """Register read and/or write formatters that work with file-like streams for a type.
+
+        Stream formatters do not talk to S3; the storage does the transfer. A stream write formatter is called
+        as ``writeFormatter(stream, butlerLocation, obj)`` and must serialize obj to the writable binary
+        stream. The stream is an in-memory buffer that spills to a temporary file once it grows beyond the
+        spillThreshold setting, so small objects never touch the disk. A stream read formatter is called once
+        per location as ``readFormatter(stream, butlerLocation)``, where butlerLocation holds only that
+        location, and must return the deserialized object. The readable binary stream reads directly from the
+        HTTP response; its readinto fills a preallocated buffer such as a NumPy array without intermediate
+        copies (see also `readInto`).
+
+        Stream formatters take precedence over formatters registered with registerFormatters for the same
+        type.
+
+        Parameters
+        ----------
+        formatable : class
+            The type of object the formatters read and write.
+        readFormatter : callable, optional
+            The stream read formatter.
+        writeFormatter : callable, optional
+            The stream write formatter.
+        """
+        if readFormatter is not None:
+            cls._streamReadFormatters[formatable] = readFormatter
+        if writeFormatter is not None:
+            cls._streamWriteFormatters[formatable] = writeFormatter
+
+    @classmethod
+    def getReadFormatter(cls, objType):
+        """Get the read formatter registered for a type with registerFormatters, or None."""
+        cls._importFormatters(objType)
+        return super().getReadFormatter(objType)
+
+    @classmethod
+    def getWriteFormatter(cls, objType):
+        """Get the write formatter registered for a type with registerFormatters, or None."""
+        cls._importFormatters(objType)
+        return super().getWriteFormatter(objType)
+
+    @classmethod
+    def _importFormatters(cls, objType):
+        """Import the module of this package that registers the formatters of a type, if there is one."""
+        moduleName = cls._formatterModules.get('{}.{}'.format(objType.__module__, objType.__qualname__))
+        if moduleName is not None:
+            importlib.import_module(moduleName, __package__)
+
+    @classmethod
+    def getStreamReadFormatter(cls, objType):
+        """Get the stream read formatter registered for a type, or None."""
+        return cls._streamReadFormatters.get(objType)
+
+    @classmethod
+    def getStreamWriteFormatter(cls, objType):
+        """Get the stream write formatter registered for a type, or None."""
+        return cls._streamWriteFormatters.get(objType)
+
+    @classmethod
+    def registerAsyncFormatters(cls, formatable, readFormatter=None, writeFormatter=None):
+        """Register coroutine read and/or write formatters for a type, used by aread and awrite.
 
+        An async write formatter is called as ``await writeFormatter(stream, butlerLocation, obj)`` and must
+        serialize obj with ``await stream.write(data)``; the data is buffered like for stream formatters and
+        uploaded once the formatter returns. An async read formatter is called once per location as
+        ``await readFormatter(stream, butlerLocation)`` and reads the object with ``await stream.read(size)``
+        directly from the HTTP response, without blocking the event loop.
+
+        Types without async formatters can still be used with aread and awrite; their regular formatters run
+        on the storage's async executor.
+
+        Parameters
+        ----------
+        formatable : class
+            The type of object the formatters read and write.
+        readFormatter : coroutine function, optional
+            The async read formatter.
+        writeFormatter : coroutine function, optional
+            The async write formatter.
+        """
+        if readFormatter is not None:
+            cls._asyncReadFormatters[formatable] = readFormatter
+        if writeFormatter is not None:
+            cls._asyncWriteFormatters[formatable] = writeFormatter
+
+    @classmethod
+    def registerCompression(cls, formatable, codec):
+        """Choose how objects of a type written with a stream write formatter are compressed.
+
+        The serialized object is compressed between the formatter and the upload, and the codec is recorded
+        in the object's metadata so `read` (and `getLocalFile`) decompress it whatever the current settings
+        are; objects without the record are read as they are. Objects smaller than compressionMinBytes, or
+        that do not shrink to compressionMaxRatio of their size, are stored uncompressed. Types that are not
+        registered use the compression setting.
+
+        Parameters
+        ----------
+        formatable : class
+            The type of the objects.
+        codec : string or None
+            The codec name, see `availableCodecs`, or None to never compress objects of this type.
+
+        Raises
+        ------
+        RuntimeError
+            If the codec is not available.
+        """
+        if codec is not None:
+            getCodec(codec)
+        cls._compressionCodecs[formatable] = codec
+
+    @classmethod
+    def registerObjectCache(cls, formatable, mode='object'):
+        """Keep objects of a type read with a stream read formatter in the in-memory object cache.
+
+        The cache is shared by all the storages of the process, holds at most objectCacheMaxBytes bytes
+        (counted as the size of the serialized objects) and drops the least recently used objects above it.
+        Objects are dropped when a storage of this process writes or copies to their key. Other processes'
+        writes are noticed when the ETag is revalidated, after objectCacheTtl seconds.
+
+        Parameters
+        ----------
+        formatable : class
+            The type of the objects.
+        mode : string or None
+            'object' keeps the deserialized object and returns that same object from each read, so callers
+            must not modify it. 'bytes' keeps the serialized object and deserializes it on each read, which
+            avoids the transfer but not the formatter. None stops caching objects of the type.
+
+        Raises
+        ------
+        RuntimeError
+            If mode is not one of the above.
+        """
+        if mode not in ('object', 'bytes', None):
+            raise RuntimeError("Unknown object cache mode {!r}; use 'object', 'bytes' or None".format(mode))
+        if cls._objectCacheModes.get(formatable) not in (None, mode):
+            # values kept in the old mode must not be returned in the new one.
+            ObjectCache.clearAll()
+        if mode is None:
+            cls._objectCacheModes.pop(formatable, None)
+        else:
+            cls._objectCacheModes[formatable] = mode
+
+    def _getCodec(self, pythonType):
+        """Get the codec to compress objects of a type with, or None."""
+        name = self._compressionCodecs.get(pythonType, self.config.compression)
+        return None if name is None else getCodec(name)
+
+    @S3Stats.instrument('write', lambda self, butlerLocation, obj: type(obj))
     def write(self, butlerLocation, obj):
         """Writes an object to a location and persistence format specified by ButlerLocation
 
+        In write-behind mode (the writeBehind setting) objects written with a stream write formatter are
+        uploaded in the background: write returns once the object is serialized, and errors are raised by
+        `flush`. Until an upload is finished, reads and exists calls of its key are answered from the queued
+        copy. Objects written with other formatters, and the RepositoryCfg, are always uploaded before write
+        returns.
+
+        With the pipelinedWrites setting (and outside write-behind mode), stream write formatters of types
+        that are not compressed write to an `UploadStream`: the object is uploaded in parts while it is
+        serialized, holding at most pipelinedWriteBuffers parts in memory, and a formatter that raises leaves
+        no object behind. Such formatters must write the object sequentially, without seeking.
+
         Parameters
         ----------
         butlerLocation : ButlerLocation
@@ -105,12 +522,381 @@ class S3Storage(dafPersist.StorageInterface):
         obj : object instance
             The object to be written.
         """
+        streamFormatter = self.getStreamWriteFormatter(type(obj))
+        if streamFormatter is not None:
+            location = self._shardKey(butlerLocation.getLocations()[0])
+            self._writeStream(location, streamFormatter, butlerLocation, obj)
+            self._wrote(location, butlerLocation.datasetType)
+            return
         writeFormatter = self.getWriteFormatter(type(obj))
         if writeFormatter is None:
             raise RuntimeError(
                 "No write formatter registered with {} for {}".format(__class__.__name__, type(obj)))
+        butlerLocation = self._shardLocation(butlerLocation)
+        for location in butlerLocation.getLocations() or ():
+            self._settle(location)
         writeFormatter(self.bucket, butlerLocation, obj)
+        for location in butlerLocation.getLocations() or ():
+            if self.manifest is not None:
+                # the formatter uploaded the object itself, so only the server knows its size and ETag.
+                head = self.s3.meta.client.head_object(Bucket=self.bucketName, Key=location)
+                self._wrote(location, butlerLocation.datasetType, head['ContentLength'], head['ETag'])
+            else:
+                self._wrote(location, butlerLocation.datasetType)
 
+    def _wrote(self, key, datasetType=None, size=None, etag=None):
+        """Update what this process knows about a key after this storage wrote to it.
+
+        Parameters
+        ----------
+        key : string
+            The key that was written.
+        datasetType : string, optional
+            The dataset type of the object, recorded in the manifest.
+        size : int, optional
+            The size of the object as stored, recorded in the manifest if known.
+        etag : string, optional
+            The ETag of the object, recorded in the manifest if known.
+        """
+        self._changed(key)
+        self._existenceCache.set(key, True)
+        self._keyIndex.add(key)
+        if self.manifest is not None:
+            self.manifest.record(key, size, etag, datasetType)
+
+    def _deleted(self, key):
+        """Update what this process knows about a key after this storage deleted it.
+
+        Parameters
+        ----------
+        key : string
+            The key that was deleted.
+        """
+        self._changed(key)
+        self._existenceCache.set(key, False)
+        self._keyIndex.discard(key)
+        if self.manifest is not None:
+            self.manifest.discard(key)
+
+    def _changed(self, key):
+        """Drop the copies of an object this process holds, after this storage wrote or deleted it."""
+        self._invalidateLocalFile(key)
+        self.objectCache.discard(self.bucketName, key)
+        if self._prefetcher is not None:
+            self._prefetcher.discard(key)
+        # callers from now on must not get what a request made before the change returns.
+        for kind in ('read', 'cached', 'exists', 'localFile'):
+            self._flights.forget((kind, key))
+        if key == self.repositoryCfgName:
+            RepositoryCfgCache.invalidate(self.bucketName)
+
+    def _writeStream(self, key, streamFormatter, butlerLocation, obj):
+        """Serialize an object with a stream write formatter and upload it.
+
+        Parameters
+        ----------
+        key : string
+            The key to write the object to.
+        streamFormatter : callable
+            The stream write formatter.
+        butlerLocation : ButlerLocation
+            Passed to the formatter.
+        obj : object instance
+            The object to be written.
+        """
+        if (self.config.pipelinedWrites and not self.config.writeBehind and key != self.repositoryCfgName and
+                self._getCodec(type(obj)) is None):
+            self._settle(key)
+            with self.transfer.openUpload(key, self.config.pipelinedWriteBuffers) as stream:
+                streamFormatter(stream, butlerLocation, obj)
+            self._uploaded(key, stream.size, stream.etag)
+            return
+        with tempfile.SpooledTemporaryFile(max_size=self.config.spillThreshold) as buffer:
+            streamFormatter(buffer, butlerLocation, obj)
+            size = buffer.tell()
+            buffer.seek(0)
+            self._upload(buffer, key, size, type(obj))
+
+    def _upload(self, buffer, key, size, pythonType):
+        """Compress a serialized object if its type calls for it (see `registerCompression`) and upload it.
+
+        Parameters
+        ----------
+        buffer : file-like object
+            The serialized object, positioned at its start.
+        key : string
+            The key to write the object to.
+        size : int
+            The number of bytes in buffer.
+        pythonType : type
+            The type of the object.
+        """
+        codec = None
+        # the RepositoryCfg is left readable by anything that reads plain YAML.
+        if size >= self.config.compressionMinBytes and key != self.repositoryCfgName:
+            codec = self._getCodec(pythonType)
+        if codec is None:
+            self._put(buffer, key, size)
+            return
+        with tempfile.SpooledTemporaryFile(max_size=self.config.spillThreshold) as encoded:
+            codec.encode(buffer, encoded)
+            encodedSize = encoded.tell()
+            if encodedSize > size * self.config.compressionMaxRatio:
+                buffer.seek(0)
+                self._put(buffer, key, size)
+            else:
+                encoded.seek(0)
+                self._put(encoded, key, encodedSize, {'Metadata': {METADATA_KEY: codec.name}})
+
+    def _put(self, fileobj, key, size, extraArgs=None):
+        """Upload bytes to a key, in the background in write-behind mode."""
+        if self.config.writeBehind and key != self.repositoryCfgName:
+            self._getWriteBehind().put(fileobj, key, size, extraArgs)
+        else:
+            self._settle(key)
+            self._uploaded(key, size, self.transfer.upload(fileobj, key, size, extraArgs))
+
+    def _uploaded(self, key, size, etag):
+        """Record the size and ETag of an uploaded object in the manifest; its dataset type is recorded by
+        `_wrote`."""
+        if self.manifest is not None:
+            self.manifest.record(key, size, etag)
+
+    def _getWriteBehind(self):
+        """Get the write-behind queue of this storage, creating it if needed."""
+        with self._writeBehindLock:
+            if self._writeBehind is None:
+                # the queue outlives the storage until its uploads are finished, so it must not refer to it;
+                # it gets what the uploads need instead.
+                transfer, existenceCache, keyIndex = self.transfer, self._existenceCache, self._keyIndex
+                manifest = self.manifest
+
+                def upload(fileobj, key, size, extraArgs):
+                    etag = transfer.upload(fileobj, key, size, extraArgs)
+                    if manifest is not None:
+                        manifest.record(key, size, etag)
+
+                def onError(key, err):
+                    existenceCache.discard(key)
+                    keyIndex.discard(key)
+                    if manifest is not None:
+                        manifest.discard(key)
+
+                self._writeBehind = WriteBehindQueue(upload, self.config.writeBehindMaxBytes,
+                                                     self.config.writeBehindThreads,
+                                                     self.config.spillThreshold, onError=onError)
+                # uploads still queued when the storage is collected, or the process exits, are finished then.
+                weakref.finalize(self, self._writeBehind.close)
+            return self._writeBehind
+
+    def _settle(self, key):
+        """Wait until a write-behind upload of a key (of all keys if key is None), if any, is finished."""
+        if self._writeBehind is not None:
+            self._writeBehind.wait(key)
+
+    def _getPrefetcher(self):
+        """Get the prefetcher of this storage, creating it if needed."""
+        with self._writeBehindLock:
+            if self._prefetcher is None:
+                # the prefetcher is closed when the storage is collected, so it must not keep it alive.
+                storageRef = weakref.ref(self)
+
+                def download(key):
+                    storage = storageRef()
+                    if storage is None:
+                        return None
+                    # a queued write-behind upload would make the prefetched copy stale.
+                    storage._settle(key)
+                    return storage._getObject(key)
+
+                self._prefetcher = Prefetcher(download, self.config.prefetchMaxBytes,
+                                              self.config.prefetchThreads, self.config.spillThreshold)
+                weakref.finalize(self, self._prefetcher.close)
+            return self._prefetcher
+
+    def _prefetchKeys(self, locations):
+        """Get the stored keys of ButlerLocations, or of paths, whose objects are read by `_readStream`."""
+        keys = []
+        for location in locations:
+            if isinstance(location, str):
+                keys.append(self._shardKey(location))
+            elif self.getStreamReadFormatter(location.getPythonType()) is not None:
+                keys += [self._shardKey(path) for path in location.getLocations()]
+        return keys
+
+    def prefetch(self, locations):
+        """Start downloading objects that are going to be read, so that read finds them already here.
+
+        The objects are downloaded in the given order, prefetchThreads at a time, and held in memory (or in
+        temporary files beyond spillThreshold bytes) until they are read. Downloads pause while the objects
+        held add up to more than prefetchMaxBytes. A read of a prefetched location uses the downloaded bytes,
+        or waits for its download if it is running, instead of making its own request.
+
+        Each call replaces the list of what is going to be read: prefetches of locations that are no longer
+        in it are cancelled, and their bytes dropped if they were already downloaded. Writes by this storage
+        also drop the prefetched copies of what they change. See `prefetchStats` for the hit rate and the
+        bytes wasted.
+
+        Only objects read with stream read formatters are prefetched; other locations are ignored.
+
+        Parameters
+        ----------
+        locations : iterable of ButlerLocation or string
+            The locations that are going to be read, in the order they will be. Every location of a
+            ButlerLocation is prefetched.
+        """
+        self._getPrefetcher().prefetch(self._prefetchKeys(locations))
+
+    def cancelPrefetch(self, locations=None):
+        """Cancel prefetches, and drop what they downloaded.
+
+        Parameters
+        ----------
+        locations : iterable of ButlerLocation or string, optional
+            The locations whose prefetches to cancel; all of them if None.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.cancel(None if locations is None else self._prefetchKeys(locations))
+
+    def prefetchStats(self):
+        """Get the counters of the prefetches of this storage.
+
+        Returns
+        -------
+        dict
+            See `Prefetcher.stats`; all the counters are zero if nothing was prefetched.
+        """
+        if self._prefetcher is None:
+            return Prefetcher.emptyStats()
+        return self._prefetcher.stats()
+
+    @S3Stats.instrument('flush')
+    def flush(self):
+        """Wait until all the uploads queued in write-behind mode are finished.
+
+        Call this at the end of a task, before telling anyone else that its outputs exist. It is also run when
+        the process exits.
+
+        Raises
+        ------
+        BulkOperationError
+            If uploads failed since the last flush. The result's failures maps each key that was not written
+            to its exception.
+        """
+        if self._writeBehind is not None:
+            self._writeBehind.flush()
+        if self.manifest is not None:
+            self.manifest.flush()
+
+    def _readStream(self, key, streamFormatter, butlerLocation):
+        """Download an object and deserialize it with a stream read formatter.
+
+        Parameters
+        ----------
+        key : string
+            The key of the object.
+        streamFormatter : callable
+            The stream read formatter.
+        butlerLocation : ButlerLocation
+            Passed to the formatter.
+
+        Objects prefetched with `prefetch` are read from the prefetched copy. Concurrent reads of the same key
+        share one GET: objects of up to readCoalesceMaxBytes are downloaded once into memory and each reader
+        deserializes its own copy. Larger objects are streamed by the first reader and fetched again by the
+        others.
+
+        Returns
+        -------
+        object or None
+            The deserialized object, or None if the key does not exist.
+        """
+        if self._writeBehind is not None:
+            queued = self._writeBehind.open(key)
+            if queued is not None:
+                queuedFile, extraArgs = queued
+                with queuedFile, decodeStream(queuedFile, extraArgs.get('Metadata')) as stream:
+                    return streamFormatter(stream, butlerLocation)
+        prefetched = self._prefetcher.take(key) if self._prefetcher is not None else None
+        if prefetched is not None:
+            buffer, metadata = prefetched
+            if buffer is None:
+                return None
+            with buffer, decodeStream(buffer, metadata) as stream:
+                return streamFormatter(stream, butlerLocation)
+        mode = self._objectCacheModes.get(butlerLocation.getPythonType())
+        if mode is not None and self.config.objectCacheMaxBytes > 0:
+            return self._readCached(key, streamFormatter, butlerLocation, mode)
+        response = None
+        if self.config.readCoalesceMaxBytes > 0:
+            shared = self._flights.do(('read', key), lambda: self._getShared(key))
+            if shared is None:
+                return None
+            if shared.data is not None:
+                return streamFormatter(io.BytesIO(shared.data), butlerLocation)
+            response = shared.takeResponse()
+        if response is None:
+            response = self._getObject(key)
+            if response is None:
+                return None
+        with io.BufferedReader(S3ReadStream(response['Body'], response['ContentLength'])) as body, \
+                decodeStream(body, response.get('Metadata')) as stream:
+            return streamFormatter(stream, butlerLocation)
+
+    def _getObject(self, key, **kwargs):
+        """Send a GET request for a key and return the response, or None if the key does not exist."""
+        try:
+            return self.s3.meta.client.get_object(Bucket=self.bucketName, Key=key, **kwargs)
+        except botocore.exceptions.ClientError as err:
+            if self._isNotFound(err):
+                return None
+            raise
+
+    @staticmethod
+    def _readBody(response):
+        """Read the whole decoded content of a GET response."""
+        with io.BufferedReader(S3ReadStream(response['Body'], response['ContentLength'])) as body, \
+                decodeStream(body, response.get('Metadata')) as stream:
+            return stream.read()
+
+    def _getShared(self, key):
+        """GET an object for all the concurrent readers of a key, see `_readStream`."""
+        response = self._getObject(key)
+        if response is None:
+            return None
+        if response['ContentLength'] > self.config.readCoalesceMaxBytes:
+            return _SharedRead(response=response)
+        return _SharedRead(data=self._readBody(response))
+
+    def _readCached(self, key, streamFormatter, butlerLocation, mode):
+        """Read an object through the object cache, see `registerObjectCache` and `_readStream`."""
+        client = self.s3.meta.client
+
+        def fetch(etag):
+            try:
+                if etag is None:
+                    response = client.get_object(Bucket=self.bucketName, Key=key)
+                else:
+                    response = client.get_object(Bucket=self.bucketName, Key=key, IfNoneMatch=etag)
+            except botocore.exceptions.ClientError as err:
+                if etag is not None and err.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                    return None
+                raise
+            data = self._readBody(response)
+            value = data if mode == 'bytes' else streamFormatter(io.BytesIO(data), butlerLocation)
+            return value, response['ETag'], len(data)
+
+        try:
+            value = self._flights.do(('cached', key),
+                                     lambda: self.objectCache.getObject(self.bucketName, key, fetch))
+        except botocore.exceptions.ClientError as err:
+            if self._isNotFound(err):
+                return None
+            raise
+        if mode == 'bytes':
+            return streamFormatter(io.BytesIO(value), butlerLocation)
+        return value
+
+    @S3Stats.instrument('read', lambda self, butlerLocation: butlerLocation.getPythonType())
     def read(self, butlerLocation):
         """Read from a butlerLocation.
 
@@ -119,22 +905,147 @@ class S3Storage(dafPersist.StorageInterface):
         butlerLocation : ButlerLocation
             The location & formatting for the object(s) to be read.
 
+        When butlerLocation has more than one location, the formatter is called once per location with a
+        copy of butlerLocation holding only that location, and the calls run concurrently on this storage's
+        read pool (at most readConcurrency at a time). Lists returned by the formatter are concatenated,
+        other return values are appended, in the order of butlerLocation.getLocations(). Stream read
+        formatters are always called once per location.
+
         Returns
         -------
         A list of objects as described by the butler location. One item for
         each location in butlerLocation.getLocations()
         """
+        streamFormatter = self.getStreamReadFormatter(butlerLocation.getPythonType())
+        if streamFormatter is not None:
+            return self._readLocations(
+                butlerLocation,
+                lambda location, singleLocation: self._readStream(self._shardKey(location), streamFormatter,
+                                                                  singleLocation))
         readFormatter = self.getReadFormatter(butlerLocation.getPythonType())
         if readFormatter is None:
             raise RuntimeError(
                 "No read formatter registered with {} for {}".format(__class__.__name__,
                                                                      butlerLocation.getPythonType()))
-        return readFormatter(self.bucket, butlerLocation)
+        butlerLocation = self._shardLocation(butlerLocation)
+        locations = butlerLocation.getLocations()
+        for location in locations or ():
+            self._settle(location)
+        if not locations or len(locations) == 1:
+            return readFormatter(self.bucket, butlerLocation)
+        return self._readLocations(
+            butlerLocation,
+            lambda location, singleLocation: readFormatter(self._threadBucket(), singleLocation))
+
+    def _readLocations(self, butlerLocation, readOne):
+        """Read each location of a ButlerLocation, concurrently if there is more than one.
+
+        Parameters
+        ----------
+        butlerLocation : ButlerLocation
+            The location(s) to read.
+        readOne : callable
+            ``readOne(location, singleLocation)`` reads one location, where singleLocation is a copy of
+            butlerLocation holding only that location.
+
+        Returns
+        -------
+        list
+            The results of readOne; lists are concatenated, other values appended.
+        """
+        def readLocation(location):
+            singleLocation = copy.copy(butlerLocation)
+            singleLocation.locationList = [location]
+            return readOne(location, singleLocation)
+
+        locations = butlerLocation.getLocations()
+        if len(locations) == 1:
+            readResults = [readLocation(locations[0])]
+        else:
+            readResults = self._getReadPool().map(S3Stats.bind(readLocation), locations)
+        results = []
+        for result in readResults:
+            if isinstance(result, list):
+                results.extend(result)
+            else:
+                results.append(result)
+        return results
+
+    def _getReadPool(self):
+        """Get the thread pool used for concurrent reads, creating it if needed."""
+        with self._readPoolLock:
+            if self._readPool is None:
+                self._readPool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.config.readConcurrency)
+        return self._readPool
+
+    def _threadBucket(self):
+        """Get a Bucket resource that is safe to use in the calling thread.
+
+        boto3 resources must not be shared between threads, so each thread gets its own Bucket; they all use
+        the pooled, thread-safe client.
+        """
+        bucket = getattr(self._threadLocal, 'bucket', None)
+        if bucket is None:
+            bucket = self.s3.Bucket(self.bucketName)
+            self._threadLocal.bucket = bucket
+        return bucket
+
+    @property
+    def transfer(self):
+        """The TransferEngine used for uploads and downloads, configured by multipartThreshold,
+        multipartChunkSize and transferThreads."""
+        if self._transfer is None:
+            self._transfer = TransferEngine(self.s3.meta.client, self.bucketName,
+                                            threshold=self.config.multipartThreshold,
+                                            chunkSize=self.config.multipartChunkSize,
+                                            threads=self.config.transferThreads,
+                                            copyThreshold=self.config.multipartCopyThreshold,
+                                            copyChunkSize=self.config.multipartCopyChunkSize)
+        return self._transfer
+
+    @property
+    def localCache(self):
+        """The LocalFileCache used by getLocalFile, configured by cacheDir, cacheMaxBytes and cacheTtl."""
+        if self._localCache is None:
+            self._localCache = LocalFileCache.forDirectory(self.config.cacheDir, self.config.cacheMaxBytes,
+                                                           self.config.cacheTtl)
+        return self._localCache
 
+    @property
+    def objectCache(self):
+        """The process-wide ObjectCache used by read for the types registered with registerObjectCache,
+        configured by objectCacheMaxBytes and objectCacheTtl."""
+        return ObjectCache.shared(self.config.objectCacheMaxBytes, self.config.objectCacheTtl)
+
+    @property
+    def manifest(self):
+        """The process-wide RepositoryManifest of the bucket, or None if the manifest setting is off."""
+        if not self.config.manifest:
+            return None
+        return RepositoryManifest.forBucket(self._clientGetter(), self.config.endpointUrl, self.bucketName,
+                                            self.config.manifestRefreshInterval,
+                                            self.config.manifestSegmentEntries,
+                                            self.config.manifestCompactSegments)
+
+    def _invalidateLocalFile(self, path):
+        """Drop the local cached copy of an object this storage has changed, if the cache is in use."""
+        if self._localCache is not None:
+            self._localCache.invalidate(self.bucketName, path)
+
+    @S3Stats.instrument('getLocalFile')
     def getLocalFile(self, path):
         """Get a handle to a local copy of the file, downloading it to a
         temporary if needed.
 
+        Copies are kept in a persistent local cache (see `localCache`). A repeated request for the same
+        object costs a HEAD request to compare its ETag, or nothing if it was checked within cacheTtl
+        seconds. Concurrent requests for the same path share one download.
+
+        If path has an HDU indicator, e.g. 'foo.fits[2]', the local copy is a sparse file that has all the
+        headers of the FITS object but only the data of that HDU (see `getHduIndex`); the data of the other
+        HDUs reads as zeros. Open it with the same indicator appended to its name.
+
         Parameters
         ----------
         path : string
@@ -145,16 +1056,222 @@ class S3Storage(dafPersist.StorageInterface):
         A handle to a local copy of the file. If storage is remote it will be
         a temporary file. If storage is local it may be the original file or
         a temporary file. The file name can be gotten via the 'name' property
-        of the returned object.
+        of the returned object. None if the object does not exist.
         """
-        raise NotImplementedError
+        client = self.s3.meta.client
+        path = self._shardPath(path)
+        objectName, hdu = splitHduSuffix(path)
+        self._settle(objectName)
+
+        def fetch(localPath):
+            if hdu is not None:
+                # make a sparse copy with all the headers but only the data of the requested HDU, so that HDU
+                # numbers still work without moving the data of the other HDUs.
+                index, head = self._getHduIndex(objectName, allowCompressed=True)
+                if index is not None:
+                    self.transfer.downloadRanges(objectName, index.etag, localPath, index.size,
+                                                 index.headerRanges() + [index.hduRange(hdu)])
+                    return index.etag, str(head['LastModified'])
+            response = self.transfer.download(objectName, localPath)
+            self._decodeFile(localPath, response.get('Metadata'))
+            return response['ETag'], str(response['LastModified'])
+
+        def validate(etag, lastModified):
+            try:
+                response = client.head_object(Bucket=self.bucketName, Key=objectName)
+            except botocore.exceptions.ClientError:
+                return False
+            return response['ETag'] == etag and str(response['LastModified']) == lastModified
+
+        try:
+            # concurrent calls share one download and get the same local copy.
+            localPath = self._flights.do(
+                ('localFile', path), lambda: self.localCache.getFile(self.bucketName, path, fetch, validate))
+        except botocore.exceptions.ClientError as err:
+            if self._isNotFound(err):
+                return None
+            raise
+        return open(localPath, 'rb')
+
+    def _decodeFile(self, path, metadata):
+        """Decompress a downloaded object in place if its metadata says it is compressed."""
+        if not (metadata or {}).get(METADATA_KEY):
+            return
+        with open(path, 'rb') as source, decodeStream(source, metadata) as stream, \
+                open(path + '.decoded', 'wb') as destination:
+            shutil.copyfileobj(stream, destination, 1024**2)
+        os.replace(path + '.decoded', path)
+
+    def _getHduIndex(self, path, allowCompressed=False):
+        """Get the HDU index of the current version of a FITS object, and the object's HEAD response.
+
+        Compressed objects can not be read by ranges; for them the index is None if allowCompressed, else a
+        RuntimeError is raised.
+        """
+        self._settle(path)
+        client = self.s3.meta.client
+        head = client.head_object(Bucket=self.bucketName, Key=path)
+        if head.get('Metadata', {}).get(METADATA_KEY):
+            if allowCompressed:
+                return None, head
+            raise RuntimeError("{} is compressed and its HDUs can not be read separately".format(path))
+        etag = head['ETag']
+        index = HduIndex.getCached(self.bucketName, path, etag)
+        if index is not None:
+            return index, head
+        sidecarKey = path + self.hduIndexSuffix
+        if self.config.hduIndexSidecar:
+            try:
+                sidecar = client.get_object(Bucket=self.bucketName, Key=sidecarKey)['Body'].read()
+                index = HduIndex.fromJson(sidecar.decode('utf-8'))
+                if index.etag != etag:
+                    index = None
+            except botocore.exceptions.ClientError as err:
+                if not self._isNotFound(err):
+                    raise
+        if index is None:
+            index = HduIndex.build(lambda start, end: self.transfer.readRange(path, start, end, etag),
+                                   head['ContentLength'], etag)
+            if self.config.hduIndexSidecar:
+                sidecar = index.toJson().encode('utf-8')
+                response = client.put_object(Bucket=self.bucketName, Key=sidecarKey, Body=sidecar)
+                self._wrote(sidecarKey, size=len(sidecar), etag=response['ETag'])
+        HduIndex.setCached(self.bucketName, path, index)
+        return index, head
+
+    @S3Stats.instrument('getHduIndex')
+    def getHduIndex(self, path):
+        """Get the byte offsets of the HDUs of a FITS object.
+
+        The index is built by reading only the headers with ranged requests and is cached per ETag in this
+        process. If the hduIndexSidecar setting is True it is also stored as a sidecar object (the key with
+        hduIndexSuffix appended) and reused by other processes while the FITS object is unchanged.
+
+        Parameters
+        ----------
+        path : string
+            A path to the FITS object in storage, relative to root. An HDU indicator is ignored.
+
+        Returns
+        -------
+        HduIndex
+            The index of the current version of the object.
+        """
+        return self._getHduIndex(self._shardKey(splitHduSuffix(path)[0]))[0]
+
+    @S3Stats.instrument('readHdu')
+    def readHdu(self, path):
+        """Read the bytes of one HDU of a FITS object, without the rest of the object.
+
+        Parameters
+        ----------
+        path : string
+            A path to the FITS object in storage with an HDU indicator, e.g. 'foo.fits[2]'. Without an
+            indicator the primary HDU is read.
+
+        Returns
+        -------
+        bytes
+            The header and data of the HDU.
+        """
+        objectName, hdu = splitHduSuffix(path)
+        objectName = self._shardKey(objectName)
+        index = self._getHduIndex(objectName)[0]
+        start, end = index.hduRange(hdu or 0)
+        return self.transfer.readRange(objectName, start, end, index.etag)
+
+    @S3Stats.instrument('readInto')
+    def readInto(self, path, buffer=None):
+        """Read an object, or one HDU of a FITS object, straight into a writable buffer.
+
+        The response bodies are read into the buffer as they arrive, with no temporary file or bytes object
+        in between; objects or HDUs of at least multipartThreshold bytes are read by concurrent ranged GETs,
+        each into its own slice of the buffer. A read formatter that knows the size of what it reads (e.g.
+        from a FITS header) can allocate a NumPy array and have it filled in place, so the peak memory of the
+        read is the size of the array. Stream read formatters can do the same for the stream they are given
+        with ``stream.readinto(array)``.
+
+        Parameters
+        ----------
+        path : string
+            A path to the object in storage, relative to root. With an HDU indicator, e.g. 'foo.fits[2]',
+            only the header and data of that HDU are read.
+        buffer : bytes-like object or callable, optional
+            A writable, contiguous buffer (e.g. a bytearray, memoryview or numpy.ndarray) of at least the
+            size of what is read, or a callable ``buffer(size)`` returning one, called once the size is known.
+            If None a bytearray is allocated.
+
+        Returns
+        -------
+        bytes-like object or None
+            The buffer, filled from its start, or None if the object does not exist.
+
+        Raises
+        ------
+        RuntimeError
+            If the buffer is too small, or the object is compressed.
+        """
+        objectName, hdu = splitHduSuffix(path)
+        objectName = self._shardKey(objectName)
+        try:
+            if hdu is not None:
+                index = self._getHduIndex(objectName)[0]
+                start, end = index.hduRange(hdu)
+                etag = index.etag
+            else:
+                self._settle(objectName)
+                head = self.s3.meta.client.head_object(Bucket=self.bucketName, Key=objectName)
+                if head.get('Metadata', {}).get(METADATA_KEY):
+                    raise RuntimeError("{} is compressed and can not be read into a buffer".format(path))
+                start, end, etag = 0, head['ContentLength'], head['ETag']
+            size = end - start
+            if buffer is None:
+                buffer = bytearray(size)
+            elif callable(buffer):
+                buffer = buffer(size)
+            with memoryview(buffer) as view, view.cast('B') as raw:
+                if len(raw) < size:
+                    raise RuntimeError("A buffer of {} bytes is too small for the {} bytes of {}".format(
+                        len(raw), size, path))
+                self.transfer.readInto(objectName, raw[:size], start, etag)
+        except botocore.exceptions.ClientError as err:
+            if self._isNotFound(err):
+                return None
+            raise
+        return buffer
+
+    @staticmethod
+    def _isNotFound(err):
+        """Test if a botocore ClientError means that the requested object does not exist."""
+        return err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+
+    @S3Stats.instrument('exists')
+    def _knownExists(self, objectName):
+        """Get whether a key exists if that is known without a request, checking what `exists` checks in
+        the same order.
+
+        Returns
+        -------
+        bool or None
+            True or False if known, None if the manifest (which may need requests to load) or the server
+            must be asked.
+        """
+        if self._writeBehind is not None and self._writeBehind.isPending(objectName):
+            return True
+        if self.config.manifest:
+            return None
+        return self._existenceCache.get(objectName, self.config.existsCacheTtl,
+                                        self.config.existsNegativeCacheTtl)
 
     def exists(self, location):
         """Check if location exists.
 
-        Performs a "listing request" (by some accounts 12.5x more expensive than
-        a get), but since the objects can be large files this seems like a
-        better approach than a try-get-catch approach.
+        Performs a HEAD request for the exact key. Answers are remembered for existsCacheTtl seconds
+        (existsNegativeCacheTtl for objects that do not exist) and are updated by this process's own write
+        and copyFile calls, so repeated checks of the same location do not each cost a request. Concurrent
+        checks of the same location share one request. With the manifest setting the answer comes from the
+        repository manifest and no request is made; objects other processes wrote are only known once they
+        flushed their manifest records (see `RepositoryManifest`).
 
         Parameters
         ----------
@@ -167,13 +1284,35 @@ class S3Storage(dafPersist.StorageInterface):
         bool
             True if exists, else False.
         """
-        objectName = location.getLocations()[0]
-        bucketObjects = list(self.bucket.objects.filter(Prefix=objectName))
-        for bucketObject in bucketObjects:
-            if objectName == bucketObject.key:
-                return True
-        return False
+        if isinstance(location, str):
+            objectName = location
+        else:
+            objectName = location.getLocations()[0]
+        objectName = self._shardKey(objectName)
+        exists = self._knownExists(objectName)
+        if exists is not None:
+            return exists
+        if self.manifest is not None:
+            # the manifest reads with the pooled client; the bucket is checked by this storage.
+            self.s3
+            return self.manifest.contains(objectName)
 
+        def head():
+            # an answer is not remembered if this process wrote or deleted the object while it was asked.
+            generation = self._existenceCache.generation()
+            try:
+                self.s3.meta.client.head_object(Bucket=self.bucketName, Key=objectName)
+                exists = True
+            except botocore.exceptions.ClientError as err:
+                if not self._isNotFound(err):
+                    raise
+                exists = False
+            self._existenceCache.set(objectName, exists, generation)
+            return exists
+
+        return self._flights.do(('exists', objectName), head)
+
+    @S3Stats.instrument('search')
     def instanceSearch(self, path):
         """Search for the given path in this storage instance.
 
@@ -182,6 +1321,13 @@ class S3Storage(dafPersist.StorageInterface):
         will match filenames without the HDU indicator, e.g. 'foo.fits'. The
         path returned WILL contain the indicator though, e.g. ['foo.fits[1]'].
 
+        Keys found in the bucket's `KeyIndex` are answered from memory: the first search in a directory lists
+        it, and keys written by this process are added as they are written. The index may not know yet about
+        keys written by other processes, so a miss is confirmed with `exists`, whose negative answers are
+        only remembered for existsNegativeCacheTtl seconds; keys it finds are added to the index. With the
+        manifest setting searches are answered from the repository manifest instead, which sees the keys
+        written by other processes after at most manifestRefreshInterval seconds.
+
         Parameters
         ----------
         path : string
@@ -189,16 +1335,22 @@ class S3Storage(dafPersist.StorageInterface):
 
         Returns
         -------
-        string or None
+        list of string or None
             The location that was found, or None if no location was found.
         """
-        strippedPath = path
-        if strippedPath.endswith(']'):
-            strippedPath = strippedPath[:strippedPath.rfind('[')]
-        location = dafPersist.ButlerLocation(pythonType=None, cppType=None, storageName=None,
-                                             locationList=[strippedPath], dataId={}, mapper=None,
-                                             storage=None)
-        return bool(self.exists(location))
+        strippedPath = splitHduSuffix(path)[0]
+        key = self._shardKey(strippedPath)
+        # the index lists with the pooled client; the bucket is checked by this storage.
+        self.s3
+        if self.manifest is not None:
+            found = self.manifest.contains(key)
+        elif self._keyIndex.contains(key):
+            found = True
+        else:
+            found = self.exists(strippedPath)
+            if found:
+                self._keyIndex.add(key)
+        return [path] if found else None
 
     @classmethod
     def search(cls, root, path):
@@ -221,14 +1373,18 @@ class S3Storage(dafPersist.StorageInterface):
 
         Returns
         -------
-        string or None
+        list of string or None
             The location that was found, or None if no location was found.
         """
-        raise NotImplementedError
+        return cls._getStorage(root).instanceSearch(path)
 
+    @S3Stats.instrument('copyFile')
     def copyFile(self, fromLocation, toLocation):
         """Copy a file from one location to another on the local filesystem.
 
+        The copy is done on the server side (see `TransferEngine.copy`) and keeps the object's metadata, such
+        as its compression codec.
+
         Parameters
         ----------
         fromLocation : string
@@ -240,11 +1396,407 @@ class S3Storage(dafPersist.StorageInterface):
         -------
         None
         """
-        copy_source = {
-            'Bucket': self.bucketName,
-            'Key': fromLocation
-        }
-        self.bucket.copy(copy_source, toLocation)
+        fromLocation = self._shardKey(fromLocation)
+        toLocation = self._shardKey(toLocation)
+        self._settle(fromLocation)
+        self._settle(toLocation)
+        head = self.s3.meta.client.head_object(Bucket=self.bucketName, Key=fromLocation)
+        etag = self.transfer.copy(fromLocation, toLocation, head['ContentLength'], etag=head['ETag'])
+        self._wrote(toLocation, self._manifestDatasetType(fromLocation), head['ContentLength'], etag)
+
+    def _manifestDatasetType(self, key):
+        """Get the dataset type the manifest records for a key, or None."""
+        entry = self.manifest.get(key) if self.manifest is not None else None
+        return entry[2] if entry is not None else None
+
+    def _listObjects(self, prefix, startAfter=None, delimiter=None):
+        """List the objects whose keys start with a prefix, in key order.
+
+        Parameters
+        ----------
+        prefix : string
+            The key prefix.
+        startAfter : string, optional
+            Only list keys after this one.
+        delimiter : string, optional
+            If given, skip the keys that contain it after the prefix, e.g. '/' to list only one 'directory'.
+
+        Yields
+        ------
+        dict
+            The ListObjectsV2 'Contents' entry of each object, with 'Key', 'Size', 'ETag' and 'LastModified'.
+        """
+        return self._paginateObjects(self.s3.meta.client, self.bucketName, prefix, startAfter, delimiter)
+
+    @staticmethod
+    def _paginateObjects(client, bucketName, prefix, startAfter=None, delimiter=None):
+        """List the objects of a bucket whose keys start with a prefix with a client; see `_listObjects`."""
+        kwargs = {'Bucket': bucketName, 'Prefix': prefix}
+        if startAfter:
+            kwargs['StartAfter'] = startAfter
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            for entry in page.get('Contents', ()):
+                yield entry
+
+    @classmethod
+    def _directoryLister(cls, getClient, bucketName):
+        """Get a function listing the keys directly under a 'directory' prefix, in key order, for the
+        `KeyIndex`."""
+        def listDirectory(prefix, startAfter=None):
+            entries = cls._paginateObjects(getClient(), bucketName, prefix, startAfter, delimiter='/')
+            return (entry['Key'] for entry in entries)
+
+        return listDirectory
+
+    @S3Stats.instrument('copyTree')
+    def copyTree(self, fromPrefix, toPrefix, progress=None):
+        """Copy all the objects under a prefix to another prefix, on the server side.
+
+        The source prefix is listed once and the objects are copied concurrently (copyConcurrency at a time),
+        large ones with multipart copies (see `transfer`). The destination is listed once as well, and
+        objects that are already there with the same size and the ETag of the current source are skipped, so
+        rerunning an interrupted or partially failed copy only copies what is missing. Copies whose ETag
+        differs from that of the source, like those of multipart uploads, are recognised by the source ETag
+        in their metadata (see `TransferEngine.copy`), at the cost of a HEAD request each.
+
+        Parameters
+        ----------
+        fromPrefix : string
+            The prefix of the keys to copy, e.g. 'rerun/a/'.
+        toPrefix : string
+            The prefix that replaces fromPrefix in the new keys, e.g. 'rerun/b/'.
+        progress : callable, optional
+            Called as ``progress(result)`` with the live BulkResult after each object is processed.
+
+        Returns
+        -------
+        BulkResult
+            Counts of the objects and bytes copied and skipped.
+
+        Raises
+        ------
+        BulkOperationError
+            If any object failed to copy; its ``result`` lists the failures. The other objects were copied.
+        """
+        self._settle(None)
+        sources = []
+        existing = {}
+        # in a sharded layout a prefix is spread over all the shards.
+        for shard in self._shardPrefixes():
+            sources += self._listObjects(shard + fromPrefix)
+            existing.update((entry['Key'], entry) for entry in self._listObjects(shard + toPrefix))
+        result = BulkResult(total=len(sources), totalBytes=sum(entry['Size'] for entry in sources))
+        shardLength = self.config.shardPrefixLength + 1 if self.config.shardPrefixLength > 0 else 0
+
+        def copyOne(source):
+            destKey = self._shardKey(toPrefix + source['Key'][shardLength + len(fromPrefix):])
+            if self._isCopyOf(existing.get(destKey), source):
+                result._record(destKey, source['Size'], skipped=True)
+            else:
+                try:
+                    etag = self.transfer.copy(source['Key'], destKey, source['Size'], etag=source['ETag'])
+                    self._wrote(destKey, self._manifestDatasetType(source['Key']), source['Size'], etag)
+                except Exception as err:
+                    result._record(destKey, source['Size'], error=err)
+                else:
+                    result._record(destKey, source['Size'])
+            if progress is not None:
+                progress(result)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.copyConcurrency) as pool:
+            copyOne = S3Stats.bind(copyOne)
+            for future in [pool.submit(copyOne, source) for source in sources]:
+                future.result()
+        if result.failures:
+            raise BulkOperationError("{} of {} objects failed to copy from {} to {}".format(
+                len(result.failures), result.total, fromPrefix, toPrefix), result)
+        return result
+
+    def _isCopyOf(self, dest, source):
+        """Check whether a listed object was copied from the current version of a listed source object."""
+        if dest is None or dest['Size'] != source['Size']:
+            return False
+        if dest['ETag'] == source['ETag']:
+            return True
+        try:
+            head = self.s3.meta.client.head_object(Bucket=self.bucketName, Key=dest['Key'])
+        except botocore.exceptions.ClientError:
+            return False
+        return head.get('Metadata', {}).get(COPY_SOURCE_ETAG_KEY) == source['ETag']
+
+    @S3Stats.instrument('delete')
+    def delete(self, locations, dryRun=False, progress=None):
+        """Delete objects, in batches of up to 1000 keys sent concurrently.
+
+        Each batch is one DeleteObjects request, and deleteConcurrency batches are in flight at a time.
+        Queued write-behind uploads are finished first, so they do not recreate the objects afterwards.
+
+        Parameters
+        ----------
+        locations : iterable of string
+            Paths of the objects in storage, relative to root. Deleting an object that does not exist is not
+            an error.
+        dryRun : bool
+            If True nothing is deleted, and the result counts the objects that exist and their bytes.
+        progress : callable, optional
+            Called as ``progress(result)`` with the live BulkResult after each batch.
+
+        Returns
+        -------
+        BulkResult
+            Counts of the objects deleted. Their bytes are only counted for a dry run, or with the manifest
+            setting, since DeleteObjects does not report them.
+
+        Raises
+        ------
+        BulkOperationError
+            If any object could not be deleted; its ``result`` lists the failures.
+        """
+        self._settle(None)
+        keys = list(dict.fromkeys(self._shardKey(location) for location in locations))
+        if dryRun:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.copyConcurrency) as pool:
+                sizes = zip(keys, pool.map(S3Stats.bind(self._objectSize), keys))
+                sizes = [(key, size) for key, size in sizes if size is not None]
+        else:
+            sizes = [(key, self._objectSize(key, head=False) or 0) for key in keys]
+        return self._deleteKeys(sizes, dryRun, progress, '')
+
+    def _objectSize(self, key, head=True):
+        """Get the stored size of an object from the manifest, or if there is none with a HEAD request (if
+        head is True). None if the object does not exist or its size is not known."""
+        if self.manifest is not None:
+            entry = self.manifest.get(key)
+            return None if entry is None else entry[0] or 0
+        if not head:
+            return None
+        try:
+            return self.s3.meta.client.head_object(Bucket=self.bucketName, Key=key)['ContentLength']
+        except botocore.exceptions.ClientError as err:
+            if not self._isNotFound(err):
+                raise
+            return None
+
+    @S3Stats.instrument('purge')
+    def purge(self, prefix, dryRun=False, progress=None):
+        """Delete all the objects under a prefix, e.g. a rerun or collection, in batches sent concurrently.
+
+        The prefix is listed once (every shard of it in a sharded layout) and the objects are deleted as by
+        `delete`. The repository's RepositoryCfg and manifest are never deleted, even when prefix is empty.
+
+        Parameters
+        ----------
+        prefix : string
+            The prefix of the paths to delete, e.g. 'rerun/a/'.
+        dryRun : bool
+            If True nothing is deleted, and the result counts the objects and bytes that would be.
+        progress : callable, optional
+            Called as ``progress(result)`` with the live BulkResult after each batch.
+
+        Returns
+        -------
+        BulkResult
+            Counts of the objects and bytes deleted.
+
+        Raises
+        ------
+        BulkOperationError
+            If any object could not be deleted; its ``result`` lists the failures. The other objects were
+            deleted.
+        """
+        self._settle(None)
+        sizes = []
+        for shard in self._shardPrefixes():
+            sizes += [(entry['Key'], entry['Size']) for entry in self._listObjects(shard + prefix)
+                      if entry['Key'] != self.repositoryCfgName and
+                      not RepositoryManifest.isManifestKey(entry['Key'])]
+        return self._deleteKeys(sizes, dryRun, progress, " under {!r}".format(prefix))
+
+    def _deleteKeys(self, sizes, dryRun, progress, description):
+        """Delete keys with concurrent DeleteObjects requests, see `delete`.
+
+        Parameters
+        ----------
+        sizes : list of tuple
+            (key, size) of each object to delete.
+        dryRun : bool
+            If True only count the objects.
+        progress : callable or None
+            Called with the result after each batch.
+        description : string
+            Appended to the error message, e.g. to name the prefix deleted.
+
+        Returns
+        -------
+        BulkResult
+            The result.
+        """
+        result = BulkResult(total=len(sizes), totalBytes=sum(size for key, size in sizes))
+        if dryRun:
+            return result
+        client = self.s3.meta.client
+
+        def deleteBatch(batch):
+            try:
+                response = client.delete_objects(Bucket=self.bucketName, Delete={
+                    'Objects': [{'Key': key} for key, size in batch], 'Quiet': True})
+                errors = {error['Key']: RuntimeError("{}: {}".format(error.get('Code'), error.get('Message')))
+                          for error in response.get('Errors', ())}
+            except Exception as err:
+                errors = {key: err for key, size in batch}
+            for key, size in batch:
+                if key not in errors:
+                    self._deleted(key)
+                result._record(key, size, error=errors.get(key))
+            if progress is not None:
+                progress(result)
+
+        batches = [sizes[start:start + 1000] for start in range(0, len(sizes), 1000)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.deleteConcurrency) as pool:
+            deleteBatch = S3Stats.bind(deleteBatch)
+            for future in [pool.submit(deleteBatch, batch) for batch in batches]:
+                future.result()
+        if result.failures:
+            raise BulkOperationError("{} of {} objects failed to delete{}".format(
+                len(result.failures), result.total, description), result)
+        return result
+
+    def _getAsyncPool(self):
+        """Get the executor that runs the blocking requests of the async methods, creating it if needed."""
+        with self._readPoolLock:
+            if self._asyncPool is None:
+                self._asyncPool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.config.asyncConcurrency)
+        return self._asyncPool
+
+    def _getAsyncSemaphore(self):
+        """Get the semaphore that bounds the async operations of this storage on the running event loop."""
+        loop = asyncio.get_running_loop()
+        semaphore = self._asyncSemaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._asyncSemaphores[loop] = asyncio.Semaphore(self.config.asyncConcurrency)
+        return semaphore
+
+    async def _runBlocking(self, func, *args):
+        """Run a blocking call on the async executor, within the storage's async concurrency limit."""
+        async with self._getAsyncSemaphore():
+            return await asyncio.get_running_loop().run_in_executor(self._getAsyncPool(), func, *args)
+
+    async def aread(self, butlerLocation):
+        """Read from a butlerLocation without blocking the event loop.
+
+        Has the same semantics and return value as `read`. If an async read formatter is registered for the
+        location's python type (see `registerAsyncFormatters`) all locations are read concurrently on the
+        event loop; otherwise `read` runs on the storage's async executor. At most asyncConcurrency requests
+        of this storage are in flight at a time.
+
+        Parameters
+        ----------
+        butlerLocation : ButlerLocation
+            The location & formatting for the object(s) to be read.
+
+        Returns
+        -------
+        A list of objects as described by the butler location. One item for
+        each location in butlerLocation.getLocations()
+        """
+        asyncFormatter = self._asyncReadFormatters.get(butlerLocation.getPythonType())
+        if asyncFormatter is None:
+            return await self._runBlocking(self.read, butlerLocation)
+
+        async def readOne(location):
+            singleLocation = copy.copy(butlerLocation)
+            singleLocation.locationList = [location]
+            location = self._shardKey(location)
+            async with self._getAsyncSemaphore():
+                loop = asyncio.get_running_loop()
+                queued = self._writeBehind.open(location) if self._writeBehind is not None else None
+                if queued is not None:
+                    queuedFile, extraArgs = queued
+                    with queuedFile, decodeStream(queuedFile, extraArgs.get('Metadata')) as stream:
+                        return await asyncFormatter(AsyncReadStream(stream, loop, self._getAsyncPool()),
+                                                    singleLocation)
+                try:
+                    response = await loop.run_in_executor(
+                        self._getAsyncPool(),
+                        lambda: self.s3.meta.client.get_object(Bucket=self.bucketName, Key=location))
+                except botocore.exceptions.ClientError as err:
+                    if self._isNotFound(err):
+                        return None
+                    raise
+                with io.BufferedReader(S3ReadStream(response['Body'], response['ContentLength'])) as body, \
+                        decodeStream(body, response.get('Metadata')) as stream:
+                    return await asyncFormatter(AsyncReadStream(stream, loop, self._getAsyncPool()),
+                                                singleLocation)
+
+        return list(await asyncio.gather(*[readOne(location) for location in butlerLocation.getLocations()]))
+
+    async def awrite(self, butlerLocation, obj):
+        """Write an object to a location without blocking the event loop.
+
+        Has the same semantics as `write`. If an async write formatter is registered for the type of obj
+        (see `registerAsyncFormatters`) it serializes on the event loop and only the upload runs on the
+        storage's async executor; otherwise `write` runs on the executor.
+
+        Parameters
+        ----------
+        butlerLocation : ButlerLocation
+            The location & formatting for the object to be written.
+        obj : object instance
+            The object to be written.
+        """
+        asyncFormatter = self._asyncWriteFormatters.get(type(obj))
+        if asyncFormatter is None:
+            await self._runBlocking(self.write, butlerLocation, obj)
+            return
+        location = self._shardKey(butlerLocation.getLocations()[0])
+        with tempfile.SpooledTemporaryFile(max_size=self.config.spillThreshold) as buffer:
+            await asyncFormatter(AsyncWriteStream(buffer), butlerLocation, obj)
+            size = buffer.tell()
+            buffer.seek(0)
+            await self._runBlocking(self._upload, buffer, location, size, type(obj))
+        self._wrote(location, butlerLocation.datasetType)
+
+    async def aexists(self, location):
+        """Check if location exists without blocking the event loop.
+
+        Has the same semantics as `exists`; answers known without a request are returned on the event loop,
+        the others come from `exists` run on the storage's async executor, so at most asyncConcurrency of them
+        are in flight at a time.
+
+        Parameters
+        ----------
+        location : ButlerLocation or string
+            A a string or a ButlerLocation that describes the location of an
+            object in this storage.
+
+        Returns
+        -------
+        bool
+            True if exists, else False.
+        """
+        location = location if isinstance(location, str) else location.getLocations()[0]
+        exists = self._knownExists(self._shardKey(location))
+        if exists is not None:
+            return exists
+        return await self._runBlocking(self.exists, location)
+
+    async def acopyFile(self, fromLocation, toLocation):
+        """Copy a file from one location to another without blocking the event loop.
+
+        Has the same semantics as `copyFile`.
+
+        Parameters
+        ----------
+        fromLocation : string
+            Path and name of existing file.
+        toLocation : string
+            Path and name of new file.
+        """
+        await self._runBlocking(self.copyFile, fromLocation, toLocation)
 
     def locationWithRoot(self, location):
         """Get the full path to the location.
@@ -263,6 +1815,7 @@ class S3Storage(dafPersist.StorageInterface):
         raise NotImplementedError
 
     @classmethod
+    @S3Stats.instrument('getRepositoryCfg')
     def getRepositoryCfg(cls, uri):
         """Get a persisted RepositoryCfg
 
@@ -275,19 +1828,70 @@ class S3Storage(dafPersist.StorageInterface):
         -------
         A RepositoryCfg instance or None
         """
-        storage = dafPersist.Storage.makeFromURI(uri)
+        storage = cls._getStorage(uri)
         location = dafPersist.ButlerLocation(pythonType=dafPersist.RepositoryCfg,
                                              cppType=None,
                                              storageName=None,
-                                             locationList=None,
+                                             locationList=[cls.repositoryCfgName],
                                              dataId={},
                                              mapper=None,
                                              storage=storage,
                                              usedDataId=None,
                                              datasetType=None)
-        return storage.read(location)
+        cfg = storage._readRepositoryCfg(location)
+        if cfg is not None:
+            cls._recordRepositorySettings(storage, cfg)
+        return cfg
+
+    def _readRepositoryCfg(self, butlerLocation):
+        """Read the RepositoryCfg of this storage's bucket, using the process-wide RepositoryCfgCache.
+
+        A cached cfg younger than repositoryCfgTtl seconds is returned without a request. An older one is
+        revalidated with a conditional GET on its ETag and only downloaded and parsed again if it changed.
+
+        Parameters
+        ----------
+        butlerLocation : ButlerLocation
+            The location of the cfg, passed to the read formatter.
+
+        Returns
+        -------
+        RepositoryCfg or None
+            The cfg, or None if the bucket does not have one.
+        """
+        streamFormatter = self.getStreamReadFormatter(dafPersist.RepositoryCfg)
+        if streamFormatter is None:
+            return self.read(butlerLocation)[0]
+        cached = RepositoryCfgCache.get(self.bucketName)
+        kwargs = {}
+        if cached is not None:
+            etag, age = cached
+            if age < self.config.repositoryCfgTtl:
+                cfg = RepositoryCfgCache.use(self.bucketName, revalidated=False)
+                if cfg is not None:
+                    return cfg
+            kwargs['IfNoneMatch'] = etag
+        try:
+            response = self.s3.meta.client.get_object(Bucket=self.bucketName, Key=self.repositoryCfgName,
+                                                      **kwargs)
+        except botocore.exceptions.ClientError as err:
+            if cached is not None and err.response['Error']['Code'] in ('304', 'NotModified'):
+                cfg = RepositoryCfgCache.use(self.bucketName, revalidated=True)
+                if cfg is not None:
+                    return cfg
+                # the entry was invalidated meanwhile; fetch the cfg unconditionally.
+                return self._readRepositoryCfg(butlerLocation)
+            if self._isNotFound(err):
+                RepositoryCfgCache.invalidate(self.bucketName)
+                return None
+            raise
+        with io.BufferedReader(S3ReadStream(response['Body'], response['ContentLength'])) as stream:
+            cfg = streamFormatter(stream, butlerLocation)
+        RepositoryCfgCache.set(self.bucketName, response['ETag'], cfg)
+        return cfg
 
     @classmethod
+    @S3Stats.instrument('putRepositoryCfg')
     def putRepositoryCfg(cls, cfg, loc=None):
         """Serialize a RepositoryCfg to a location.
 
@@ -309,17 +1913,48 @@ class S3Storage(dafPersist.StorageInterface):
         -------
         None
         """
-        storage = dafPersist.Storage.makeFromURI(cfg.root if loc is None else loc, create=True)
+        storage = cls._getStorage(cfg.root if loc is None else loc, create=True)
         location = dafPersist.ButlerLocation(pythonType=dafPersist.RepositoryCfg,
                                              cppType=None,
                                              storageName=None,
-                                             locationList=None,
+                                             locationList=[cls.repositoryCfgName],
                                              dataId={},
                                              mapper=None,
                                              storage=storage,
                                              usedDataId=None,
                                              datasetType=None)
         storage.write(location, cfg)
+        cls._recordRepositorySettings(storage, cfg)
+
+    @classmethod
+    def _recordRepositorySettings(cls, storage, cfg):
+        """Remember the S3Storage settings in a repository's RepositoryCfg and apply them to its storages.
+
+        Settings are taken from the 's3' entry of the cfg's policy, e.g. a policy of
+        ``{'s3': {'transferThreads': 16}}``. They are applied to the storage passed in, to the shared
+        storage of the bucket and to storages of the bucket created later in this process.
+
+        Parameters
+        ----------
+        storage : S3Storage
+            The storage that read or wrote the cfg.
+        cfg : RepositoryCfg
+            The repository's cfg.
+        """
+        policy = getattr(cfg, 'policy', None)
+        if not policy or 's3' not in policy:
+            return
+        s3Policy = policy['s3']
+        settings = {name: s3Policy[name] for name in S3StorageConfig._defaults if name in s3Policy}
+        cls._repositorySettings[storage.bucketName] = settings
+        storages = [storage]
+        sharedStorage = cls._storages.get(storage.bucketName)
+        if sharedStorage is not None and sharedStorage is not storage:
+            storages.append(sharedStorage)
+        for s3Storage in storages:
+            s3Storage.config.applyRepositorySettings(settings)
+            # engines are rebuilt with the new settings on next use.
+            s3Storage._transfer = None
 
     @classmethod
     def getMapperClass(cls, root):
@@ -0,0 +1,265 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import os
+import re
+
+__all__ = ['S3StorageConfig']
+
+
+class S3StorageConfig:
+    """Tunable settings used by an S3Storage instance.
+
+    Every setting has a built-in default that can be overridden for the whole process with an environment
+    variable named ``LSST_S3_`` followed by the setting name in upper case with words separated by
+    underscores, e.g. ``cacheMaxBytes`` is read from ``LSST_S3_CACHE_MAX_BYTES``. Process-wide overrides can
+    also be made in code with `setDefaults`, and a single storage can be adjusted with `update`. Repository
+    layout settings, such as ``shardPrefixLength``, are the exception: they come from the repository's
+    RepositoryCfg only.
+
+    Parameters
+    ----------
+    **kwargs
+        Initial values for settings, taking precedence over the environment and the defaults.
+    """
+
+    # name: default value. The type of the default is used to convert values read from the environment; a
+    # default of None means the value is used as a string.
+    _defaults = {
+        # URL of the S3 service; None uses the AWS default.
+        'endpointUrl': None,
+        # AWS profile to take credentials from; None uses the default credential chain.
+        'profile': None,
+        # Maximum number of HTTP connections kept open to the service by the shared client.
+        'maxPoolConnections': 32,
+        # Maximum number of attempts of a request, including retries with jittered exponential backoff.
+        'maxAttempts': 10,
+        # If True the number of requests in flight is lowered while the server throttles them (503 SlowDown)
+        # and raised back up to maxPoolConnections as requests succeed; see AdaptiveConcurrency.
+        'adaptiveConcurrency': True,
+        # Directory of the persistent local file cache used by getLocalFile. None uses a per-user
+        # directory in the system temporary directory.
+        'cacheDir': None,
+        # Byte budget of the local file cache; least recently used files are evicted above it.
+        'cacheMaxBytes': 2 * 1024**3,
+        # Seconds during which a cached file is trusted without revalidating its ETag with the server.
+        'cacheTtl': 0.,
+        # Seconds during which an answer of exists() that the object exists is reused without a request.
+        'existsCacheTtl': 10.,
+        # Seconds during which an answer of exists() that the object does not exist is reused.
+        'existsNegativeCacheTtl': 2.,
+        # Maximum number of locations of one ButlerLocation that read() fetches at the same time.
+        'readConcurrency': 16,
+        # Objects read with stream formatters up to this many bytes are downloaded once into memory for all
+        # the threads reading them at the same time; larger ones are fetched by each. 0 disables sharing.
+        'readCoalesceMaxBytes': 64 * 1024**2,
+        # Size in bytes above which objects serialized by stream write formatters are buffered on disk
+        # instead of in memory.
+        'spillThreshold': 16 * 1024**2,
+        # Size in bytes from which objects are uploaded as parallel multipart uploads and downloaded with
+        # parallel ranged GETs.
+        'multipartThreshold': 64 * 1024**2,
+        # Size in bytes of each part of a multipart upload or ranged download.
+        'multipartChunkSize': 16 * 1024**2,
+        # Maximum number of parts or ranges of one storage transferred at the same time.
+        'transferThreads': 8,
+        # If True, objects serialized by stream write formatters are uploaded while they are serialized,
+        # as a multipart upload of multipartChunkSize parts, instead of after; see S3Storage.write.
+        'pipelinedWrites': False,
+        # Number of part buffers of multipartChunkSize bytes each pipelined write fills or uploads at a time.
+        'pipelinedWriteBuffers': 4,
+        # Seconds during which a cached RepositoryCfg is used without asking the server whether it changed.
+        'repositoryCfgTtl': 0.,
+        # If True, the HDU offset index of a FITS object is stored next to it as a sidecar object so other
+        # processes do not have to scan its headers again.
+        'hduIndexSidecar': False,
+        # Maximum number of requests of one storage in flight at a time from its async methods. Those without
+        # an async formatter run the blocking methods on a thread pool of this size.
+        'asyncConcurrency': 64,
+        # Size in bytes from which server-side copies are done as multipart copies with parallel parts.
+        'multipartCopyThreshold': 1024**3,
+        # Size in bytes of each part of a multipart copy.
+        'multipartCopyChunkSize': 256 * 1024**2,
+        # Maximum number of objects copyTree copies at the same time.
+        'copyConcurrency': 32,
+        # Maximum number of DeleteObjects requests, of up to 1000 keys each, in flight at the same time.
+        'deleteConcurrency': 16,
+        # Seconds a directory listing of the search index is used before keys added after it are listed.
+        'keyIndexTtl': 60.,
+        # Seconds after which a directory of the search index is listed again in full.
+        'keyIndexRebuildInterval': 600.,
+        # If True, exists and instanceSearch are answered from the repository manifest (see
+        # RepositoryManifest) without requests, and write, copyFile and copyTree record what they create in
+        # it. Every process writing to the repository must keep it up to date: set it in the 's3' policy of
+        # the RepositoryCfg, and run s3Manifest.py rebuild after objects were written by other means.
+        'manifest': False,
+        # Seconds between two checks of the manifest for segments written by other processes.
+        'manifestRefreshInterval': 60.,
+        # Number of records a process buffers before writing them to the manifest as one segment. Until the
+        # segment is written (or flush is called, or the process exits), other processes answer that the
+        # objects do not exist.
+        'manifestSegmentEntries': 1000,
+        # Number of settled segments above which loading the manifest compacts them into its base. Manifests
+        # on servers that ignore conditional writes are never compacted.
+        'manifestCompactSegments': 100,
+        # If True, write returns once the object is serialized and uploads it in the background; see flush.
+        'writeBehind': False,
+        # Maximum number of bytes waiting to be uploaded in write-behind mode before write blocks.
+        'writeBehindMaxBytes': 1024**3,
+        # Maximum number of write-behind uploads in flight at the same time.
+        'writeBehindThreads': 8,
+        # Maximum number of prefetched bytes (see S3Storage.prefetch) held in memory or spooled to disk
+        # and not read yet; prefetching pauses above it.
+        'prefetchMaxBytes': 512 * 1024**2,
+        # Maximum number of prefetch downloads in flight at the same time.
+        'prefetchThreads': 4,
+        # If True, collect request counts, bytes and latencies in S3Stats.
+        'stats': False,
+        # If set (and stats is True), append a snapshot of S3Stats to this file every statsDumpInterval s.
+        'statsDumpFile': None,
+        # Seconds between two snapshots written to statsDumpFile.
+        'statsDumpInterval': 60.,
+        # Codec ('gzip', 'zstd' or 'lz4') used to compress objects of types without a codec registered with
+        # S3Storage.registerCompression; None to not compress them.
+        'compression': None,
+        # Objects smaller than this many bytes are not compressed.
+        'compressionMinBytes': 4096,
+        # Compressed objects are stored uncompressed unless compression shrinks them to this fraction or less.
+        'compressionMaxRatio': 0.9,
+        # Byte budget of the in-memory cache of objects of the types registered with
+        # S3Storage.registerObjectCache; 0 disables it.
+        'objectCacheMaxBytes': 512 * 1024**2,
+        # Seconds an object in the in-memory cache is used before its ETag is checked with a conditional
+        # request; inf (the default) trusts it until this process writes it or it is evicted.
+        'objectCacheTtl': float('inf'),
+        # Number of hexadecimal digits of the MD5 hash of an object's directory prepended to its key, e.g. 2
+        # stores 'calexp/v1/c.fits' as '63/calexp/v1/c.fits', spreading a repository over 16**2 prefixes
+        # that S3 can scale independently; 0 uses keys as they are. This is a repository layout: set it in
+        # the 's3' policy of the RepositoryCfg before writing anything, so all readers use it.
+        'shardPrefixLength': 0,
+    }
+
+    # Settings that describe how a repository is stored, and must be the same for all its readers and
+    # writers. They are only taken from the repository's RepositoryCfg (or given explicitly in code), never
+    # from the environment or setDefaults.
+    _layoutSettings = frozenset(['shardPrefixLength'])
+
+    _overrides = {}
+
+    def __init__(self, **kwargs):
+        for name, default in self._defaults.items():
+            if name in self._layoutSettings:
+                setattr(self, name, default)
+                continue
+            value = self._overrides.get(name, default)
+            envValue = os.environ.get(self._envName(name))
+            if envValue is not None:
+                value = self._convert(default, envValue)
+            setattr(self, name, value)
+        self.update(**kwargs)
+
+    @staticmethod
+    def _envName(name):
+        """Get the name of the environment variable that overrides a setting."""
+        return 'LSST_S3_' + re.sub('([A-Z])', r'_\1', name).upper()
+
+    @staticmethod
+    def _convert(default, value):
+        """Convert a string from the environment to the type of the setting's default."""
+        if isinstance(default, bool):
+            return value.lower() in ('1', 'true', 'yes', 'on')
+        if default is None:
+            return value
+        return type(default)(value)
+
+    @classmethod
+    def _checkNames(cls, names):
+        unknown = set(names) - set(cls._defaults)
+        if unknown:
+            raise RuntimeError("Unknown {} setting(s): {}".format(cls.__name__, ', '.join(sorted(unknown))))
+
+    @classmethod
+    def setDefaults(cls, **kwargs):
+        """Override the defaults for storages created from now on in this process.
+
+        Environment variables still take precedence over these values.
+
+        Parameters
+        ----------
+        **kwargs
+            Setting names and their new default values.
+
+        Raises
+        ------
+        RuntimeError
+            If a name is unknown or a repository layout setting, which only the RepositoryCfg can set.
+        """
+        cls._checkNames(kwargs)
+        layout = cls._layoutSettings.intersection(kwargs)
+        if layout:
+            raise RuntimeError("{} describe(s) the layout of a repository and can only be set in its "
+                               "RepositoryCfg".format(', '.join(sorted(layout))))
+        cls._overrides.update(kwargs)
+
+    def update(self, **kwargs):
+        """Change settings of this config.
+
+        Parameters
+        ----------
+        **kwargs
+            Setting names and their new values.
+        """
+        self._checkNames(kwargs)
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def applyRepositorySettings(self, settings):
+        """Apply settings recorded in a repository's RepositoryCfg.
+
+        Settings that are set by environment variables are not changed, so that the person running a
+        process can always override what a repository asks for, except for the layout settings (e.g.
+        shardPrefixLength) which are always applied.
+
+        Parameters
+        ----------
+        settings : dict
+            Setting names and values; unknown names are ignored.
+        """
+        for name, value in settings.items():
+            if name in self._layoutSettings:
+                setattr(self, name, value)
+            elif name in self._defaults and self._envName(name) not in os.environ:
+                setattr(self, name, value)
+
+    def toDict(self):
+        """Get the settings as a dict.
+
+        Returns
+        -------
+        dict
+            Setting names and values.
+        """
+        return {name: getattr(self, name) for name in self._defaults}
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__,
+                               ', '.join('{}={!r}'.format(k, v) for k, v in self.toDict().items()))
@@ -0,0 +1,114 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import threading
+
+__all__ = ['SingleFlight']
+
+
+class _Flight:
+    """One call of a SingleFlight and the callers waiting for it."""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one.
+
+    The first thread to ask for a key runs the call; threads asking for the same key while it runs wait for
+    it and get the same result, or the same exception raised. A thread asking after the call finished starts
+    a new one, so results are never older than the request for them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> _Flight of the call running for that key.
+        self._flights = {}
+        self._stats = dict(calls=0, shared=0)
+
+    def stats(self):
+        """Get the counters.
+
+        Returns
+        -------
+        dict
+            ``calls`` counts the calls that were run and ``shared`` the callers that waited for a call run
+            by another thread instead.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def do(self, key, func):
+        """Run a call, or wait for the one already running for the same key.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the call.
+        func : callable
+            Called with no arguments to get the result.
+
+        Returns
+        -------
+        object
+            The result of func, possibly returned to other callers too.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._stats['calls'] += 1
+            else:
+                self._stats['shared'] += 1
+        if leader:
+            try:
+                flight.result = func()
+            except BaseException as err:
+                flight.error = err
+            finally:
+                with self._lock:
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def forget(self, key):
+        """Make callers asking for a key from now on start a new call instead of waiting for the running one,
+        e.g. because what it reads was just changed.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the call.
+        """
+        with self._lock:
+            self._flights.pop(key, None)
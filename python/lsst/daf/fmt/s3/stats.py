@@ -0,0 +1,362 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import contextlib
+import functools
+import json
+import threading
+import time
+
+__all__ = ['S3Stats']
+
+# Upper bounds in seconds of the latency histogram buckets; a last bucket counts anything slower.
+LATENCY_BUCKETS = tuple(0.001 * 2**i for i in range(17))
+
+
+class _NoOperation:
+    """The context manager returned by S3Stats.operation while collection is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_noOperation = _NoOperation()
+
+
+class _Counters:
+    """Counters of one operation or one kind of S3 request."""
+
+    __slots__ = ('calls', 'errors', 'requests', 'retries', 'bytesIn', 'bytesOut', 'seconds', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.requests = 0
+        self.retries = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.seconds = 0.
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def addLatency(self, seconds):
+        self.seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(LATENCY_BUCKETS)
+        self.histogram[i] += 1
+
+    def toDict(self):
+        return {name: (list(getattr(self, name)) if name == 'histogram' else getattr(self, name))
+                for name in self.__slots__}
+
+
+class S3Stats:
+    """Process-wide counters of the work done by S3Storage.
+
+    Two tables are kept. ``operations`` has one row per S3Storage operation (read, write, exists, copyFile,
+    getRepositoryCfg, ...) and python type of the object read or written, e.g. 'read:Exposure'; each row
+    counts the calls, failed calls and their wall time, and the S3 requests, retries and bytes sent and
+    received on behalf of those calls. ``requests`` has one row per S3 API operation (GetObject,
+    HeadObject, ...) with the same request counters and the requests' latencies.
+
+    Requests are counted by handlers on the botocore events of the pooled clients. They are attributed to
+    the operation running in the same thread; work an operation hands to a thread pool is attributed to it
+    if the submitted callable is wrapped with `bind`. Requests made outside any operation are counted under
+    'other'.
+
+    Collection is off until `enable` is called (or an S3Storage is made with the stats setting). While it is
+    off `operation` and `bind` return their arguments unchanged and the event handlers return at once.
+    """
+
+    enabled = False
+    _lock = threading.Lock()
+    _operations = {}
+    _requests = {}
+    _local = threading.local()
+    _dumpThread = None
+    _dumpStop = None
+    _dumpArgs = None
+
+    @classmethod
+    def enable(cls):
+        """Start collecting counters."""
+        cls.enabled = True
+
+    @classmethod
+    def disable(cls):
+        """Stop collecting counters. The counters collected so far are kept."""
+        cls.enabled = False
+
+    @classmethod
+    def reset(cls):
+        """Set all counters to zero."""
+        with cls._lock:
+            cls._operations = {}
+            cls._requests = {}
+
+    @classmethod
+    def snapshot(cls):
+        """Get a copy of the counters.
+
+        Returns
+        -------
+        dict
+            ``{'time': time.time(), 'operations': {name: counters}, 'requests': {name: counters}}``, where
+            counters is a dict of calls, errors, requests, retries, bytesIn, bytesOut, seconds and histogram.
+            histogram counts latencies (wall time of calls for operations, of requests for requests) in the
+            buckets bounded by `LATENCY_BUCKETS`. Suitable for json.
+        """
+        with cls._lock:
+            return dict(time=time.time(),
+                        operations={name: counters.toDict() for name, counters in cls._operations.items()},
+                        requests={name: counters.toDict() for name, counters in cls._requests.items()})
+
+    @classmethod
+    def _counters(cls, table, name):
+        """Get the counters of a row, creating it if needed. Caller must hold the lock."""
+        counters = table.get(name)
+        if counters is None:
+            counters = table[name] = _Counters()
+        return counters
+
+    @staticmethod
+    def _operationName(name, pythonType):
+        if pythonType is None:
+            return name
+        return '{}:{}'.format(name, getattr(pythonType, '__name__', pythonType))
+
+    @classmethod
+    def operation(cls, name, pythonType=None):
+        """Get a context manager that counts a call of an operation and attributes its requests to it.
+
+        Parameters
+        ----------
+        name : string
+            The operation, e.g. 'read'.
+        pythonType : type, optional
+            The type of the object read or written.
+
+        Returns
+        -------
+        context manager
+            Does nothing if collection is off.
+        """
+        if not cls.enabled:
+            return _noOperation
+        return cls._timeOperation(cls._operationName(name, pythonType))
+
+    @classmethod
+    @contextlib.contextmanager
+    def _timeOperation(cls, name):
+        previous = getattr(cls._local, 'operation', None)
+        cls._local.operation = name
+        start = time.monotonic()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            elapsed = time.monotonic() - start
+            cls._local.operation = previous
+            with cls._lock:
+                counters = cls._counters(cls._operations, name)
+                counters.calls += 1
+                counters.errors += failed
+                counters.addLatency(elapsed)
+
+    @classmethod
+    def instrument(cls, name, pythonTypeOf=None):
+        """Decorate a method so that each call is counted as an operation.
+
+        Parameters
+        ----------
+        name : string
+            The operation name.
+        pythonTypeOf : callable, optional
+            ``pythonTypeOf(*args, **kwargs)``, called with the method's arguments, must return the python
+            type to count the call under.
+
+        Returns
+        -------
+        callable
+            The decorator.
+        """
+        def decorator(method):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                if not cls.enabled:
+                    return method(*args, **kwargs)
+                pythonType = pythonTypeOf(*args, **kwargs) if pythonTypeOf is not None else None
+                with cls._timeOperation(cls._operationName(name, pythonType)):
+                    return method(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def bind(cls, func):
+        """Wrap a callable so that requests it makes in another thread are attributed to the current
+        operation.
+
+        Parameters
+        ----------
+        func : callable
+            The callable, e.g. to be submitted to a thread pool.
+
+        Returns
+        -------
+        callable
+            func itself if collection is off or no operation is running.
+        """
+        name = getattr(cls._local, 'operation', None) if cls.enabled else None
+        if name is None:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = getattr(cls._local, 'operation', None)
+            cls._local.operation = name
+            try:
+                return func(*args, **kwargs)
+            finally:
+                cls._local.operation = previous
+        return wrapper
+
+    @classmethod
+    def register(cls, client):
+        """Install the event handlers that count the requests of a botocore client.
+
+        Parameters
+        ----------
+        client : botocore.client.BaseClient
+            The client.
+        """
+        events = client.meta.events
+        events.register('before-call.s3', cls._beforeCall)
+        events.register('before-send.s3', cls._beforeSend)
+        events.register('after-call.s3', cls._afterCall)
+        events.register('after-call-error.s3', cls._afterCallError)
+
+    @staticmethod
+    def _apiOperation(eventName):
+        return eventName.rsplit('.', 1)[-1]
+
+    @classmethod
+    def _beforeCall(cls, context=None, **kwargs):
+        if cls.enabled and context is not None:
+            context['lsstS3StatsStart'] = time.monotonic()
+
+    @classmethod
+    def _beforeSend(cls, request=None, event_name='', **kwargs):
+        """Count the bytes sent, once per attempt so retried uploads are counted again."""
+        if not cls.enabled or request is None:
+            return None
+        headers = request.headers
+        # streamed (aws-chunked) uploads only give the size of the payload in this header.
+        size = int(headers.get('X-Amz-Decoded-Content-Length') or headers.get('Content-Length') or 0)
+        with cls._lock:
+            cls._counters(cls._requests, cls._apiOperation(event_name)).bytesOut += size
+            cls._counters(cls._operations, getattr(cls._local, 'operation', None) or 'other').bytesOut += size
+        return None
+
+    @classmethod
+    def _record(cls, eventName, context, retries, bytesIn, failed):
+        start = (context or {}).get('lsstS3StatsStart')
+        elapsed = time.monotonic() - start if start is not None else 0.
+        with cls._lock:
+            requests = cls._counters(cls._requests, cls._apiOperation(eventName))
+            operation = cls._counters(cls._operations, getattr(cls._local, 'operation', None) or 'other')
+            for counters in (requests, operation):
+                counters.requests += 1
+                counters.retries += retries
+                counters.bytesIn += bytesIn
+            requests.calls += 1
+            requests.errors += failed
+            requests.addLatency(elapsed)
+
+    @classmethod
+    def _afterCall(cls, http_response=None, parsed=None, context=None, event_name='', **kwargs):
+        if not cls.enabled:
+            return
+        metadata = (parsed or {}).get('ResponseMetadata', {})
+        bytesIn = 0
+        if http_response is not None:
+            bytesIn = int(http_response.headers.get('Content-Length', 0) or 0)
+        failed = http_response is None or http_response.status_code >= 300
+        cls._record(event_name, context, metadata.get('RetryAttempts', 0), bytesIn, failed)
+
+    @classmethod
+    def _afterCallError(cls, context=None, event_name='', **kwargs):
+        if cls.enabled:
+            cls._record(event_name, context, 0, 0, True)
+
+    @classmethod
+    def dump(cls, path):
+        """Append a snapshot to a file, as one line of JSON.
+
+        Parameters
+        ----------
+        path : string
+            The file.
+        """
+        line = json.dumps(cls.snapshot())
+        with open(path, 'a') as f:
+            f.write(line + '\n')
+
+    @classmethod
+    def startPeriodicDump(cls, path, interval):
+        """Dump a snapshot to a file every interval seconds from a background thread, until
+        `stopPeriodicDump` is called. A running periodic dump to another file or with another interval is
+        stopped first.
+
+        Parameters
+        ----------
+        path : string
+            The file to append snapshots to, see `dump`.
+        interval : float
+            Seconds between snapshots.
+        """
+        if cls._dumpArgs == (path, interval):
+            return
+        cls.stopPeriodicDump()
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                cls.dump(path)
+
+        cls._dumpStop = stop
+        cls._dumpArgs = (path, interval)
+        cls._dumpThread = threading.Thread(target=run, name='S3StatsDump', daemon=True)
+        cls._dumpThread.start()
+
+    @classmethod
+    def stopPeriodicDump(cls):
+        """Stop the periodic dump, if any."""
+        if cls._dumpThread is not None:
+            cls._dumpStop.set()
+            cls._dumpThread.join()
+            cls._dumpThread = cls._dumpStop = cls._dumpArgs = None
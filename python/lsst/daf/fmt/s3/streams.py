@@ -0,0 +1,203 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import io
+
+__all__ = ['S3ReadStream', 'RangeReadStream', 'AsyncReadStream', 'AsyncWriteStream']
+
+
+class S3ReadStream(io.RawIOBase):
+    """A raw, read-only file object over the body of a get_object response.
+
+    Bytes are read directly from the HTTP connection as they are requested, so the object is never held in
+    memory or on disk as a whole, and `readinto` fills the caller's buffer straight from the connection, so a
+    formatter can read an image into a preallocated array without intermediate copies. Wrap it in
+    `io.BufferedReader` (and `io.TextIOWrapper` for text) to give it to code that expects a regular file.
+
+    Parameters
+    ----------
+    body : botocore.response.StreamingBody
+        The 'Body' of a get_object response.
+    size : int, optional
+        The number of bytes in the body, e.g. the response's 'ContentLength'.
+    """
+
+    CHUNK_SIZE = 1024**2
+
+    def __init__(self, body, size=None):
+        self._body = body
+        self.size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # at most CHUNK_SIZE bytes are asked for at once, so filling a large buffer (e.g. a whole image
+        # array) never makes a temporary copy of it.
+        with memoryview(buffer) as view, view.cast('B') as raw:
+            chunk = raw[:self.CHUNK_SIZE]
+            if hasattr(self._body, 'readinto'):
+                count = self._body.readinto(chunk)
+            else:
+                data = self._body.read(len(chunk))
+                count = len(data)
+                chunk[:count] = data
+            chunk.release()
+        self._position += count
+        return count
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._body.close()
+        super().close()
+
+
+class RangeReadStream(io.RawIOBase):
+    """A raw, read-only, seekable file object that reads an object with a ranged GET per read.
+
+    Only the bytes asked for are transferred, so a reader that seeks to the parts it needs, e.g. the column
+    chunks of a Parquet file located from its footer, fetches no others. Every read costs a request, so it
+    suits readers that read large ranges; wrap it in `io.BufferedReader` for one that makes many small reads.
+
+    Parameters
+    ----------
+    readRange : callable
+        ``readRange(start, end)`` must return the bytes of the object from start to end (exclusive), e.g.
+        `TransferEngine.readRange` bound to a key and ETag.
+    size : int
+        The size of the object.
+    """
+
+    def __init__(self, readRange, size):
+        self._readRange = readRange
+        self.size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def readinto(self, buffer):
+        with memoryview(buffer) as view, view.cast('B') as raw:
+            end = min(self._position + len(raw), self.size)
+            if end <= self._position:
+                return 0
+            data = self._readRange(self._position, end)
+            raw[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def readall(self):
+        # the rest of the object in one request, rather than one per default buffer size.
+        if self._position >= self.size:
+            return b''
+        data = self._readRange(self._position, self.size)
+        self._position += len(data)
+        return data
+
+
+class AsyncReadStream:
+    """An asyncio stream over a readable binary file object whose reads block, e.g. an `S3ReadStream`.
+
+    Each read runs on an executor so the event loop is never blocked on the network.
+
+    Parameters
+    ----------
+    stream : file-like object
+        The blocking, readable binary stream.
+    loop : asyncio.AbstractEventLoop
+        The event loop of the reader.
+    executor : concurrent.futures.Executor
+        The executor to run blocking reads on.
+    """
+
+    def __init__(self, stream, loop, executor):
+        self._stream = stream
+        self._loop = loop
+        self._executor = executor
+
+    async def read(self, size=-1):
+        """Read up to size bytes, or everything that is left if size is negative.
+
+        Parameters
+        ----------
+        size : int
+            The maximum number of bytes to read.
+
+        Returns
+        -------
+        bytes
+            The bytes read; empty at the end of the stream.
+        """
+        return await self._loop.run_in_executor(self._executor, self._stream.read, size)
+
+
+class AsyncWriteStream:
+    """An asyncio stream that collects bytes into a writable binary file object.
+
+    Writes go to a local buffer (see `S3Storage.registerAsyncFormatters`) and do not touch the network, so
+    they complete immediately.
+
+    Parameters
+    ----------
+    buffer : file-like object
+        The writable binary buffer.
+    """
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+
+    async def write(self, data):
+        """Write bytes to the buffer.
+
+        Parameters
+        ----------
+        data : bytes-like object
+            The bytes to write.
+
+        Returns
+        -------
+        int
+            The number of bytes written.
+        """
+        return self._buffer.write(data)
@@ -0,0 +1,135 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import threading
+import time
+
+__all__ = ['AdaptiveConcurrency']
+
+# Error codes S3 and S3-compatible services answer with when requests come in too fast.
+THROTTLE_CODES = frozenset(['SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                            'RequestThrottled', 'TooManyRequests', 'TooManyRequestsException'])
+
+
+class AdaptiveConcurrency:
+    """Limits the number of requests of a client in flight, adapting the limit to throttling by the server.
+
+    The limit follows additive increase / multiplicative decrease: each request answered without throttling
+    raises it by 1/limit (so by about one per round of requests), up to ``maxConcurrency``; a throttled
+    request (a 503 or 429 status, or one of `THROTTLE_CODES`) multiplies it by ``decrease``, down to
+    ``minConcurrency``, at most once per ``cooldown`` seconds so that a burst of throttled requests in flight
+    counts as one signal. Threads sending a request while the limit is reached wait for a slot.
+
+    Slots are taken per attempt, when botocore sends a request, and given back when botocore decides whether
+    to retry it, so attempts waiting out their retry backoff (see the maxAttempts setting) do not hold one.
+
+    Parameters
+    ----------
+    maxConcurrency : int
+        The limit when there is no throttling, and its starting value.
+    minConcurrency : int
+        The lowest the limit goes.
+    decrease : float
+        The factor the limit is multiplied by on throttling.
+    cooldown : float
+        Seconds after a decrease during which throttled requests do not decrease the limit again.
+    """
+
+    def __init__(self, maxConcurrency, minConcurrency=1, decrease=0.5, cooldown=1.):
+        self.maxConcurrency = maxConcurrency
+        self.minConcurrency = minConcurrency
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._condition = threading.Condition()
+        self._limit = float(maxConcurrency)
+        self._inFlight = 0
+        self._lastDecrease = None
+        self._stats = dict(requests=0, throttled=0, decreases=0, waits=0)
+
+    @property
+    def limit(self):
+        """The current maximum number of requests in flight."""
+        with self._condition:
+            return int(self._limit)
+
+    def stats(self):
+        """Get the counters.
+
+        Returns
+        -------
+        dict
+            ``requests`` counts the attempts sent, ``throttled`` those the server throttled, ``decreases``
+            the times the limit was lowered and ``waits`` the attempts that had to wait for a slot.
+            ``limit`` and ``inFlight`` are the current limit and number of attempts in flight.
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats['limit'] = int(self._limit)
+            stats['inFlight'] = self._inFlight
+        return stats
+
+    def register(self, client):
+        """Install the event handlers that limit the requests of a botocore client.
+
+        Parameters
+        ----------
+        client : botocore.client.BaseClient
+            The client.
+        """
+        client.meta.events.register('before-send.s3', self._beforeSend)
+        client.meta.events.register('needs-retry.s3', self._needsRetry)
+
+    def _beforeSend(self, request=None, **kwargs):
+        with self._condition:
+            if self._inFlight >= int(self._limit):
+                self._stats['waits'] += 1
+                while self._inFlight >= int(self._limit):
+                    self._condition.wait()
+            self._inFlight += 1
+            self._stats['requests'] += 1
+        return None
+
+    @staticmethod
+    def _isThrottled(response):
+        if response is None:
+            return False
+        httpResponse, parsed = response
+        if httpResponse.status_code in (429, 503):
+            return True
+        return (parsed or {}).get('Error', {}).get('Code') in THROTTLE_CODES
+
+    def _needsRetry(self, response=None, **kwargs):
+        throttled = self._isThrottled(response)
+        with self._condition:
+            self._inFlight = max(0, self._inFlight - 1)
+            if throttled:
+                self._stats['throttled'] += 1
+                now = time.monotonic()
+                if self._lastDecrease is None or now - self._lastDecrease >= self.cooldown:
+                    self._lastDecrease = now
+                    self._limit = max(float(self.minConcurrency), self._limit * self.decrease)
+                    self._stats['decreases'] += 1
+            elif response is not None:
+                self._limit = min(float(self.maxConcurrency), self._limit + 1. / self._limit)
+            self._condition.notify_all()
+        # leave the decision to retry to botocore's retry handler.
+        return None
@@ -0,0 +1,556 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import botocore.exceptions
+import concurrent.futures
+import io
+import mmap
+import shutil
+import threading
+
+from .stats import S3Stats
+
+__all__ = ['TransferEngine', 'UploadStream']
+
+# S3 limits for multipart uploads.
+MIN_PART_SIZE = 5 * 1024**2
+MAX_PARTS = 10000
+MAX_SINGLE_COPY = 5 * 1024**3
+
+# The S3 user metadata key that holds the ETag of the source of a multipart copy, whose own ETag differs.
+COPY_SOURCE_ETAG_KEY = 'lsst-copy-source-etag'
+
+
+class TransferEngine:
+    """Moves objects between S3 and local files or streams, in parallel for large objects.
+
+    Objects smaller than the threshold are transferred with a single request. Larger uploads become multipart
+    uploads whose parts are sent concurrently, and larger downloads are split into ranged GETs that run
+    concurrently and write straight into a preallocated, memory-mapped local file or a caller's buffer.
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+        A thread-safe S3 client.
+    bucketName : string
+        The bucket to transfer to and from.
+    threshold : int
+        Objects of at least this many bytes are transferred in parts.
+    chunkSize : int
+        The size in bytes of each part or range. Raised if needed to respect the S3 part limits.
+    threads : int
+        The maximum number of parts or ranges transferred at the same time.
+    copyThreshold : int
+        Objects of at least this many bytes are copied in parts.
+    copyChunkSize : int
+        The size in bytes of each part of a multipart copy.
+    """
+
+    def __init__(self, client, bucketName, threshold, chunkSize, threads, copyThreshold=5 * 1024**3,
+                 copyChunkSize=256 * 1024**2):
+        self.client = client
+        self.bucketName = bucketName
+        self.threshold = threshold
+        self.chunkSize = chunkSize
+        self.threads = threads
+        self.copyThreshold = min(copyThreshold, MAX_SINGLE_COPY)
+        self.copyChunkSize = copyChunkSize
+        self._pool = None
+        self._poolLock = threading.Lock()
+
+    def _getPool(self):
+        with self._poolLock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        return self._pool
+
+    def _partSize(self, size):
+        """Get the part size to use for an object of size bytes."""
+        partSize = max(self.chunkSize, MIN_PART_SIZE)
+        if size > partSize * MAX_PARTS:
+            partSize = -(-size // MAX_PARTS)
+        return partSize
+
+    def upload(self, fileobj, key, size, extraArgs=None):
+        """Upload the contents of a readable binary file object.
+
+        Parameters
+        ----------
+        fileobj : file-like object
+            The data to upload, read from its current position. Must be seekable if size is below the
+            threshold.
+        key : string
+            The key to write.
+        size : int
+            The number of bytes to upload.
+        extraArgs : dict, optional
+            Additional arguments for put_object/create_multipart_upload, e.g. ``Metadata``.
+
+        Returns
+        -------
+        string
+            The ETag of the new object.
+        """
+        extraArgs = extraArgs or {}
+        if size < self.threshold:
+            response = self.client.put_object(Bucket=self.bucketName, Key=key, Body=fileobj, **extraArgs)
+            return response['ETag']
+        uploadId = self.client.create_multipart_upload(Bucket=self.bucketName, Key=key,
+                                                       **extraArgs)['UploadId']
+        futures = []
+        try:
+            partSize = self._partSize(size)
+            # at most `threads` parts are read into memory and waiting or being uploaded at a time.
+            inFlight = threading.BoundedSemaphore(self.threads)
+            partNumber = 1
+            while True:
+                inFlight.acquire()
+                data = fileobj.read(partSize)
+                if not data and partNumber > 1:
+                    inFlight.release()
+                    break
+                future = self._getPool().submit(S3Stats.bind(self._uploadPart), key, uploadId, partNumber,
+                                                data)
+                future.add_done_callback(lambda f: inFlight.release())
+                futures.append(future)
+                partNumber += 1
+                if len(data) < partSize:
+                    break
+            parts = [future.result() for future in futures]
+            response = self.client.complete_multipart_upload(Bucket=self.bucketName, Key=key,
+                                                             UploadId=uploadId,
+                                                             MultipartUpload={'Parts': parts})
+        except BaseException:
+            self._cancelParts(futures)
+            self.client.abort_multipart_upload(Bucket=self.bucketName, Key=key, UploadId=uploadId)
+            raise
+        return response['ETag']
+
+    def openUpload(self, key, buffers, extraArgs=None):
+        """Open a stream that uploads what is written to it while it is being written.
+
+        See `UploadStream`.
+
+        Parameters
+        ----------
+        key : string
+            The key to write.
+        buffers : int
+            The number of part buffers, each of the part size, that are filled or uploaded at the same time.
+        extraArgs : dict, optional
+            Additional arguments for put_object/create_multipart_upload, e.g. ``Metadata``.
+
+        Returns
+        -------
+        UploadStream
+            The writable stream; use it as a context manager, or call its close (or abort) method.
+        """
+        return UploadStream(self, key, buffers, extraArgs)
+
+    def copy(self, sourceKey, destKey, size, etag=None, sourceBucketName=None):
+        """Copy an object on the server side.
+
+        Objects smaller than copyThreshold are copied with one request, larger ones (including those beyond
+        the 5 GB limit of a single copy) with a multipart upload whose parts are copied concurrently. Either
+        way the copy gets the user metadata and content type of the source. The ETag of a copy can differ from
+        that of its source (multipart copies have their own, and so do single copies of multipart uploads), so
+        the ETag of the source is added to its metadata, under COPY_SOURCE_ETAG_KEY.
+
+        Parameters
+        ----------
+        sourceKey : string
+            The key to copy.
+        destKey : string
+            The key to create in this engine's bucket.
+        size : int
+            The size of the source object.
+        etag : string, optional
+            If given, the copy fails if the source object does not have this ETag.
+        sourceBucketName : string, optional
+            The bucket of the source object; this engine's bucket if None.
+
+        Returns
+        -------
+        string
+            The ETag of the new object.
+        """
+        copySource = {'Bucket': sourceBucketName or self.bucketName, 'Key': sourceKey}
+        head = self.client.head_object(Bucket=copySource['Bucket'], Key=sourceKey, **(
+            {} if etag is None else {'IfMatch': etag}))
+        # the copy must be of the version whose metadata was read.
+        conditions = {'CopySourceIfMatch': head['ETag']}
+        extraArgs = {'Metadata': dict(head.get('Metadata', {}), **{COPY_SOURCE_ETAG_KEY: head['ETag']})}
+        if head.get('ContentType'):
+            extraArgs['ContentType'] = head['ContentType']
+        if size < self.copyThreshold:
+            response = self.client.copy_object(Bucket=self.bucketName, Key=destKey, CopySource=copySource,
+                                               MetadataDirective='REPLACE', **conditions, **extraArgs)
+            return response['CopyObjectResult']['ETag']
+        uploadId = self.client.create_multipart_upload(Bucket=self.bucketName, Key=destKey,
+                                                       **extraArgs)['UploadId']
+        futures = []
+        try:
+            partSize = max(self.copyChunkSize, self._partSize(size))
+            for partNumber, start in enumerate(range(0, size, partSize), 1):
+                end = min(start + partSize, size)
+                futures.append(self._getPool().submit(
+                    S3Stats.bind(self.client.upload_part_copy), Bucket=self.bucketName, Key=destKey,
+                    UploadId=uploadId, PartNumber=partNumber, CopySource=copySource,
+                    CopySourceRange='bytes={}-{}'.format(start, end - 1), **conditions))
+            parts = [{'ETag': future.result()['CopyPartResult']['ETag'], 'PartNumber': partNumber}
+                     for partNumber, future in enumerate(futures, 1)]
+            response = self.client.complete_multipart_upload(Bucket=self.bucketName, Key=destKey,
+                                                             UploadId=uploadId,
+                                                             MultipartUpload={'Parts': parts})
+        except BaseException:
+            self._cancelParts(futures)
+            self.client.abort_multipart_upload(Bucket=self.bucketName, Key=destKey, UploadId=uploadId)
+            raise
+        return response['ETag']
+
+    @staticmethod
+    def _cancelParts(futures):
+        """Cancel the parts of a failed multipart upload that have not started and wait for the others, so
+        that none is uploaded after the upload is aborted (and the storage of it kept by the server)."""
+        for future in futures:
+            future.cancel()
+        concurrent.futures.wait(futures)
+
+    def _uploadPart(self, key, uploadId, partNumber, data):
+        response = self.client.upload_part(Bucket=self.bucketName, Key=key, UploadId=uploadId,
+                                           PartNumber=partNumber, Body=data)
+        return {'ETag': response['ETag'], 'PartNumber': partNumber}
+
+    def download(self, key, path):
+        """Download an object to a local file.
+
+        Parameters
+        ----------
+        key : string
+            The key to read.
+        path : string
+            The local file to write; it is created or truncated.
+
+        Returns
+        -------
+        dict
+            The response of the first request for the object, with 'ETag', 'LastModified' and 'Metadata'.
+        """
+        try:
+            response = self.client.get_object(Bucket=self.bucketName, Key=key,
+                                              Range='bytes=0-{}'.format(self.threshold - 1))
+        except botocore.exceptions.ClientError as err:
+            # an empty object has no byte range to ask for.
+            if err.response['Error']['Code'] != 'InvalidRange':
+                raise
+            response = self.client.get_object(Bucket=self.bucketName, Key=key)
+        size = int(response.get('ContentRange', '/{}'.format(response['ContentLength'])).split('/')[-1])
+        with open(path, 'wb') as f:
+            if size <= self.threshold:
+                shutil.copyfileobj(response['Body'], f)
+                return response
+            f.truncate(size)
+        self._fill(key, response['ETag'], path, size, [(self.threshold, size)],
+                   firstBody=response['Body'], firstSize=self.threshold)
+        return response
+
+    def readRange(self, key, start, end, etag=None):
+        """Read a byte range of an object into memory.
+
+        Parameters
+        ----------
+        key : string
+            The key to read.
+        start : int
+            The first byte to read.
+        end : int
+            The end of the range (exclusive); must not be past the end of the object.
+        etag : string, optional
+            If given, the read fails if the object does not have this ETag.
+
+        Returns
+        -------
+        bytes
+            The bytes of the range.
+        """
+        kwargs = {} if etag is None else {'IfMatch': etag}
+        response = self.client.get_object(Bucket=self.bucketName, Key=key,
+                                          Range='bytes={}-{}'.format(start, end - 1), **kwargs)
+        return response['Body'].read()
+
+    def readInto(self, key, view, start, etag):
+        """Read a byte range of an object into a writable buffer, without intermediate copies.
+
+        Ranges of at least the threshold are split into ranged GETs that run concurrently, each reading its
+        response into its own slice of the buffer.
+
+        Parameters
+        ----------
+        key : string
+            The key to read.
+        view : memoryview
+            A writable, byte formatted view; it is filled with the len(view) bytes of the object from start.
+        start : int
+            The offset in the object of the first byte to read.
+        etag : string
+            The ETag of the version of the object to read; the read fails if the object changed.
+        """
+        size = len(view)
+        if size == 0:
+            return
+        if size < self.threshold:
+            self._downloadRange(key, etag, view, start, start + size)
+            return
+        partSize = self._partSize(size)
+        futures = []
+        try:
+            for offset in range(0, size, partSize):
+                end = min(offset + partSize, size)
+                futures.append(self._getPool().submit(S3Stats.bind(self._downloadRange), key, etag,
+                                                      view[offset:end], start + offset, start + end))
+            for future in futures:
+                future.result()
+        finally:
+            # the caller may release the buffer once this returns, so no range may still be writing to it.
+            concurrent.futures.wait(futures)
+
+    def downloadRanges(self, key, etag, path, size, ranges):
+        """Download byte ranges of an object into the same places of a sparse local file.
+
+        The file gets the size of the whole object, but only the requested ranges are fetched and the rest of
+        the file is left as a hole that reads as zeros and takes no disk space.
+
+        Parameters
+        ----------
+        key : string
+            The key to read.
+        etag : string
+            The ETag of the version of the object to read; the download fails if the object changed.
+        path : string
+            The local file to write; it is created or truncated.
+        size : int
+            The size of the object.
+        ranges : list of tuple
+            (start, end) byte ranges to download; end is exclusive.
+        """
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        if size > 0:
+            self._fill(key, etag, path, size, ranges)
+
+    def _fill(self, key, etag, path, size, ranges, firstBody=None, firstSize=0):
+        """Download ranges of an object concurrently into a memory map of a local file of the same size.
+
+        Parameters
+        ----------
+        key : string
+            The key to read.
+        etag : string
+            The ETag of the version of the object to read.
+        path : string
+            An existing local file of size bytes.
+        size : int
+            The size of the object and the file.
+        ranges : list of tuple
+            (start, end) byte ranges to download; end is exclusive. Each is split into chunks.
+        firstBody : botocore.response.StreamingBody, optional
+            The body of an already issued request for the first firstSize bytes of the object, read in the
+            calling thread while the ranges download.
+        firstSize : int
+            The size of firstBody.
+        """
+        partSize = self._partSize(size)
+        with open(path, 'r+b') as f, mmap.mmap(f.fileno(), size) as mm:
+            view = memoryview(mm)
+            futures = []
+            try:
+                for rangeStart, rangeEnd in ranges:
+                    for start in range(rangeStart, rangeEnd, partSize):
+                        end = min(start + partSize, rangeEnd)
+                        futures.append(self._getPool().submit(S3Stats.bind(self._downloadRange), key, etag,
+                                                              view[start:end], start, end))
+                if firstBody is not None:
+                    self._readBody(firstBody, view[:firstSize])
+                for future in futures:
+                    future.result()
+            finally:
+                # the map can not be closed while any range is still writing into it.
+                concurrent.futures.wait(futures)
+                view.release()
+
+    def _downloadRange(self, key, etag, view, start, end):
+        # IfMatch makes the request fail rather than mix two versions if the object changes meanwhile.
+        response = self.client.get_object(Bucket=self.bucketName, Key=key, IfMatch=etag,
+                                          Range='bytes={}-{}'.format(start, end - 1))
+        self._readBody(response['Body'], view)
+
+    @staticmethod
+    def _readBody(body, view):
+        """Read a response body into a memoryview, which must be exactly the size of the body."""
+        offset = 0
+        while offset < len(view):
+            chunk = view[offset:offset + 1024**2]
+            if hasattr(body, 'readinto'):
+                count = body.readinto(chunk)
+            else:
+                data = body.read(len(chunk))
+                count = len(data)
+                chunk[:count] = data
+            if not count:
+                raise IOError("Response body ended after {} of {} bytes".format(offset, len(view)))
+            offset += count
+
+
+class UploadStream(io.RawIOBase):
+    """A write-only file object that uploads the bytes written to it as parts of a multipart upload.
+
+    The bytes are collected in part buffers of the engine's part size. Each full buffer is uploaded on the
+    engine's threads while the writer goes on filling the next one, so serializing an object and uploading
+    it overlap, and at most ``buffers`` part buffers exist at a time: a write that needs a new buffer waits
+    until the upload of an earlier one is finished. Objects that end before the first part is full are
+    uploaded with a single put_object when the stream is closed.
+
+    The object is created when the stream is closed. If the stream is left by an exception in a ``with``
+    block, or `abort` is called, the multipart upload is aborted and no object is created. The stream can not
+    seek, so writers must write the object from its start to its end.
+
+    Parameters
+    ----------
+    engine : TransferEngine
+        The engine whose client, bucket, part size and threads are used.
+    key : string
+        The key to write.
+    buffers : int
+        The number of part buffers filled or uploaded at the same time.
+    extraArgs : dict, optional
+        Additional arguments for put_object/create_multipart_upload, e.g. ``Metadata``.
+    """
+
+    def __init__(self, engine, key, buffers, extraArgs=None):
+        self._engine = engine
+        self.key = key
+        self._extraArgs = extraArgs or {}
+        self._partSize = engine._partSize(0)
+        self._buffers = threading.BoundedSemaphore(max(buffers, 1))
+        self._buffers.acquire()
+        self._part = bytearray(self._partSize)
+        self._fill = 0
+        self._uploadId = None
+        self._futures = []
+        #: The number of bytes written.
+        self.size = 0
+        #: The ETag of the new object, once the stream is closed.
+        self.etag = None
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.size
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        with memoryview(data) as view, view.cast('B') as raw:
+            offset = 0
+            while offset < len(raw):
+                if self._part is None:
+                    # waits until an upload frees a buffer.
+                    self._buffers.acquire()
+                    self._part = bytearray(self._partSize)
+                count = min(len(raw) - offset, self._partSize - self._fill)
+                self._part[self._fill:self._fill + count] = raw[offset:offset + count]
+                self._fill += count
+                offset += count
+                if self._fill == self._partSize:
+                    self._uploadPart()
+        self.size += offset
+        return offset
+
+    def _uploadPart(self):
+        """Start uploading the current part buffer."""
+        for future in self._futures:
+            # a failed part fails the object, so stop serializing as soon as it is known.
+            if future.done():
+                future.result()
+        if self._uploadId is None:
+            self._uploadId = self._engine.client.create_multipart_upload(
+                Bucket=self._engine.bucketName, Key=self.key, **self._extraArgs)['UploadId']
+        part, self._part = self._part, None
+        del part[self._fill:]
+        self._fill = 0
+        future = self._engine._getPool().submit(S3Stats.bind(self._engine._uploadPart), self.key,
+                                                self._uploadId, len(self._futures) + 1, part)
+        future.add_done_callback(lambda f: self._buffers.release())
+        self._futures.append(future)
+
+    def close(self):
+        """Upload what is left and create the object."""
+        if self.closed:
+            return
+        try:
+            client = self._engine.client
+            if self._uploadId is None:
+                del self._part[self._fill:]
+                response = client.put_object(Bucket=self._engine.bucketName, Key=self.key, Body=self._part,
+                                             **self._extraArgs)
+            else:
+                if self._fill:
+                    self._uploadPart()
+                parts = [future.result() for future in self._futures]
+                response = client.complete_multipart_upload(Bucket=self._engine.bucketName, Key=self.key,
+                                                            UploadId=self._uploadId,
+                                                            MultipartUpload={'Parts': parts})
+            self.etag = response['ETag']
+        except BaseException:
+            self._abort()
+            raise
+        finally:
+            self._part = None
+            super().close()
+
+    def abort(self):
+        """Discard what was written without creating the object."""
+        if not self.closed:
+            try:
+                self._abort()
+            finally:
+                self._part = None
+                super().close()
+
+    def _abort(self):
+        self._engine._cancelParts(self._futures)
+        if self._uploadId is not None:
+            self._engine.client.abort_multipart_upload(Bucket=self._engine.bucketName, Key=self.key,
+                                                       UploadId=self._uploadId)
+            self._uploadId = None
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        # unlike other files, a stream that was never closed is discarded rather than completed.
+        if not self.closed:
+            self.abort()
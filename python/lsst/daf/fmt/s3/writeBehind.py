@@ -0,0 +1,231 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import concurrent.futures
+import io
+import os
+import shutil
+import tempfile
+import threading
+import warnings
+
+from .bulk import BulkOperationError, BulkResult
+from .stats import S3Stats
+
+__all__ = ['WriteBehindQueue']
+
+
+class _PendingUpload:
+    """A serialized object waiting to be uploaded, held in memory or in a local file."""
+
+    __slots__ = ('key', 'data', 'path', 'size', 'extraArgs')
+
+    def __init__(self, key, data, path, size, extraArgs):
+        self.key = key
+        self.data = data
+        self.path = path
+        self.size = size
+        self.extraArgs = extraArgs
+
+    def open(self):
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.path, 'rb')
+
+    def release(self):
+        self.data = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class WriteBehindQueue:
+    """Uploads serialized objects in the background.
+
+    `put` takes a buffer holding a serialized object and returns as soon as the upload is queued. Objects up
+    to ``spillThreshold`` bytes are held in memory, larger ones in a file in ``spoolDir``, until they are
+    uploaded. When the queued objects add up to more than ``maxBytes``, `put` blocks until enough of them
+    are uploaded, so a producer that is faster than the network does not fill memory or disk.
+
+    Errors of background uploads are kept and raised by the next `flush`.
+
+    Parameters
+    ----------
+    upload : callable
+        ``upload(fileobj, key, size, extraArgs)`` must upload the object read from fileobj to key, passing
+        extraArgs (a dict or None, see `TransferEngine.upload`) with the request.
+    maxBytes : int
+        The high-water mark of queued bytes.
+    threads : int
+        The number of uploads run at the same time.
+    spillThreshold : int
+        Objects larger than this are spooled to a local file.
+    spoolDir : string, optional
+        The directory for spooled objects; the system temporary directory if None.
+    onError : callable, optional
+        ``onError(key, error)`` is called from the upload thread when an upload fails.
+    """
+
+    def __init__(self, upload, maxBytes, threads, spillThreshold, spoolDir=None, onError=None):
+        self.upload = upload
+        self.maxBytes = maxBytes
+        self.spillThreshold = spillThreshold
+        self.spoolDir = spoolDir
+        self.onError = onError
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._condition = threading.Condition()
+        # key -> the latest _PendingUpload of that key.
+        self._pending = {}
+        self._queuedBytes = 0
+        self._failures = {}
+
+    @property
+    def queuedBytes(self):
+        """The number of bytes waiting to be uploaded."""
+        with self._condition:
+            return self._queuedBytes
+
+    def put(self, buffer, key, size, extraArgs=None):
+        """Queue an upload.
+
+        Parameters
+        ----------
+        buffer : file-like object
+            The serialized object, positioned at its start. It is copied, so the caller may close it when
+            put returns.
+        key : string
+            The key to upload to.
+        size : int
+            The number of bytes to upload.
+        extraArgs : dict, optional
+            Passed to the upload function, e.g. ``{'Metadata': {...}}``.
+        """
+        if size <= self.spillThreshold:
+            entry = _PendingUpload(key, buffer.read(size), None, size, extraArgs)
+        else:
+            with tempfile.NamedTemporaryFile('wb', dir=self.spoolDir, prefix='.upload-', delete=False) as f:
+                entry = _PendingUpload(key, None, f.name, size, extraArgs)
+                shutil.copyfileobj(buffer, f)
+        with self._condition:
+            # an earlier upload of the same key must not finish after this one and overwrite it.
+            previous = self._pending.get(key)
+            while previous is not None or (self._queuedBytes and self._queuedBytes + size > self.maxBytes):
+                self._condition.wait()
+                previous = self._pending.get(key)
+            self._pending[key] = entry
+            self._queuedBytes += size
+            self._pool.submit(S3Stats.bind(self._upload), entry)
+
+    def _upload(self, entry):
+        try:
+            with entry.open() as fileobj:
+                self.upload(fileobj, entry.key, entry.size, entry.extraArgs)
+        except Exception as err:
+            with self._condition:
+                self._failures[entry.key] = err
+            if self.onError is not None:
+                self.onError(entry.key, err)
+        finally:
+            with self._condition:
+                if self._pending.get(entry.key) is entry:
+                    del self._pending[entry.key]
+                self._queuedBytes -= entry.size
+                entry.release()
+                self._condition.notify_all()
+
+    def isPending(self, key):
+        """Test if an upload of a key is queued or running.
+
+        Parameters
+        ----------
+        key : string
+            The key.
+
+        Returns
+        -------
+        bool
+            True if the key is waiting to be uploaded.
+        """
+        with self._condition:
+            return key in self._pending
+
+    def open(self, key):
+        """Open the queued content of a key for reading.
+
+        Parameters
+        ----------
+        key : string
+            The key.
+
+        Returns
+        -------
+        tuple or None
+            A binary file holding what will be uploaded to key and the extraArgs of the upload, or None if no
+            upload of key is queued.
+        """
+        with self._condition:
+            entry = self._pending.get(key)
+            if entry is None:
+                return None
+            # opened under the lock so the upload can not release the data first.
+            return entry.open(), entry.extraArgs or {}
+
+    def wait(self, key=None):
+        """Wait until a queued upload of a key, if any, is finished. Errors are left for `flush`.
+
+        Parameters
+        ----------
+        key : string, optional
+            The key. If None wait for all queued uploads.
+        """
+        with self._condition:
+            while (key in self._pending) if key is not None else self._pending:
+                self._condition.wait()
+
+    def flush(self):
+        """Wait until all queued uploads are finished, and raise the errors of the ones that failed.
+
+        Raises
+        ------
+        BulkOperationError
+            If uploads failed since the last flush; the result's failures holds key -> exception.
+        """
+        self.wait()
+        with self._condition:
+            failures, self._failures = self._failures, {}
+        if failures:
+            result = BulkResult(total=len(failures))
+            for key, error in failures.items():
+                result._record(key, 0, error)
+            raise BulkOperationError("{} deferred upload(s) failed, first: {}: {}".format(
+                len(failures), *next(iter(failures.items()))), result)
+
+    def close(self):
+        """Flush the queue and stop its threads. Errors are reported as warnings, since close is called from
+        finalizers where they could not be handled."""
+        try:
+            self.flush()
+        except BulkOperationError as err:
+            warnings.warn(str(err))
+        self._pool.shutdown(wait=True)
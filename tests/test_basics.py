@@ -21,22 +21,36 @@
 #
 
 
+import asyncio
 import boto3
 import botocore
+import botocore.awsrequest
+import concurrent.futures
+import gc
+import io
 try:
     from moto import mock_s3
+    from moto.core.botocore_stubber import MockRawResponse
     HAS_MOTO = True
 except ImportError:
     HAS_MOTO = False
+import json
+import numpy as np
 import os
 import pickle
 import tempfile
+import threading
+import time
 import unittest
+import weakref
 import yaml
 
 import lsst.utils.tests
-from lsst.daf.fmt.s3 import S3Storage
+from lsst.daf.fmt.s3 import (S3Storage, S3Stats, AdaptiveConcurrency, ClientPool, ExistenceCache, KeyIndex,
+                             LocalFileCache, RepositoryCfgCache, RepositoryManifest)
+import lsst.daf.fmt.s3.manifest
 import lsst.daf.fmt.s3.fmtRepositoryCfg
+from lsst.daf.fmt.s3 import benchmark
 import lsst.daf.persistence as dafPersist
 from lsst.obs.base import CameraMapper
 from lsst.utils import getPackageDir
@@ -89,6 +103,58 @@ def readMyTestObject(bucket, butlerLocation):
 S3Storage.registerFormatters(MyTestObject, readFormatter=readMyTestObject, writeFormatter=writeMyTestObject)
 
 
+class MyStreamTestObject(MyTestObject):
+    pass
+
+
+def writeMyStreamTestObject(stream, butlerLocation, obj):
+    pickle.dump(obj, stream)
+
+
+def readMyStreamTestObject(stream, butlerLocation):
+    return pickle.load(stream)
+
+
+S3Storage.registerStreamFormatters(MyStreamTestObject, readFormatter=readMyStreamTestObject,
+                                   writeFormatter=writeMyStreamTestObject)
+
+
+def makeFitsBytes(dataSizes):
+    """Make a FITS file with an empty primary HDU and one 8-bit image extension for each of dataSizes. The
+    data of extension i is filled with the byte i."""
+    def header(cards):
+        text = ''.join(card.ljust(80) for card in cards + ['END'])
+        return text.ljust(-(-len(text) // 2880) * 2880).encode('ascii')
+
+    def pad(data):
+        return data + b'\0' * (-len(data) % 2880)
+
+    fits = header(['SIMPLE  =                    T', 'BITPIX  =                    8',
+                   'NAXIS   =                    0', 'EXTEND  =                    T'])
+    for i, size in enumerate(dataSizes, 1):
+        fits += header(["XTENSION= 'IMAGE   '", 'BITPIX  =                    8',
+                        'NAXIS   =                    1', 'NAXIS1  = {:20d}'.format(size),
+                        'PCOUNT  =                    0', 'GCOUNT  =                    1'])
+        fits += pad(bytes([i]) * size)
+    return fits
+
+
+class MyAsyncTestObject(MyTestObject):
+    pass
+
+
+async def writeMyAsyncTestObject(stream, butlerLocation, obj):
+    await stream.write(pickle.dumps(obj))
+
+
+async def readMyAsyncTestObject(stream, butlerLocation):
+    return pickle.loads(await stream.read())
+
+
+S3Storage.registerAsyncFormatters(MyAsyncTestObject, readFormatter=readMyAsyncTestObject,
+                                  writeFormatter=writeMyAsyncTestObject)
+
+
 class MyMapper(dafPersist.Mapper):
 
     def __init__(self, root, *args, **kwargs):
@@ -171,11 +237,12 @@ class BasicTestCase(unittest.TestCase):
         for bucketName in self.cleanupBucketNames:
             try:
                 bucket = boto3.resource('s3').Bucket(bucketName)
-                for key in bucket.objects.all():
-                    key.delete()
+                # deletes up to 1000 keys per request.
+                bucket.objects.all().delete()
                 bucket.delete()
             except s3client.exceptions.NoSuchBucket:
                 pass
+        S3Storage.clearSharedState()
         if not LSST_USE_REAL_S3:
             self.mock.stop()
 
@@ -206,6 +273,863 @@ class BasicTestCase(unittest.TestCase):
         reloadedCfg = storage.getRepositoryCfg(repoLocation)
         self.assertEqual(cfg, reloadedCfg)
 
+    def test_largeObjectTransfer(self):
+        """Test that objects above multipartThreshold are written as multipart uploads and downloaded by
+        getLocalFile with ranged requests."""
+        repoLocation = self._getS3URI('test_largeObjectTransfer')
+        storage = S3Storage(uri=repoLocation, create=True)
+        storage.config.update(multipartThreshold=5 * 1024**2, multipartChunkSize=5 * 1024**2,
+                              transferThreads=3)
+        testObj = MyStreamTestObject(os.urandom(13 * 1024**2))
+        loc = dafPersist.ButlerLocation(pythonType=MyStreamTestObject,
+                                        cppType=None,
+                                        storageName=None,
+                                        locationList=['testname'],
+                                        dataId={},
+                                        mapper=self,
+                                        storage=storage)
+        storage.write(loc, testObj)
+        # the ETag of a multipart upload ends with the number of parts.
+        self.assertTrue(storage.bucket.Object('testname').e_tag.endswith('-3"'))
+        self.assertEqual(storage.read(loc), [testObj])
+        with tempfile.TemporaryDirectory() as cacheDir:
+            storage.config.update(cacheDir=cacheDir)
+            with storage.getLocalFile('testname') as f:
+                self.assertEqual(pickle.load(f), testObj)
+
+        # a failed upload is aborted only when none of its parts is being uploaded any more.
+        uploadPart = storage.transfer._uploadPart
+        uploading = []
+
+        def failingUploadPart(key, uploadId, partNumber, data):
+            if partNumber == 1:
+                raise RuntimeError("upload failed")
+            uploading.append(partNumber)
+            time.sleep(0.2)
+            try:
+                return uploadPart(key, uploadId, partNumber, data)
+            finally:
+                uploading.remove(partNumber)
+
+        storage.transfer._uploadPart = failingUploadPart
+        with self.assertRaises(RuntimeError):
+            storage.transfer.upload(io.BytesIO(bytes(13 * 1024**2)), 'failed', 13 * 1024**2)
+        self.assertEqual(uploading, [])
+        del storage.transfer._uploadPart
+        self.assertEqual(storage.s3.meta.client.list_multipart_uploads(Bucket=storage.bucketName)
+                         .get('Uploads', []), [])
+
+    def test_pipelinedWrite(self):
+        """Test that pipelined writes upload parts while the formatter writes, with a bounded number of part
+        buffers, and that a failing formatter leaves neither an object nor an upload behind."""
+        repoLocation = self._getS3URI('test_pipelinedWrite')
+        storage = S3Storage(uri=repoLocation, create=True)
+        storage.config.update(pipelinedWrites=True, pipelinedWriteBuffers=2, multipartChunkSize=5 * 1024**2)
+        client = storage.s3.meta.client
+        loc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['testname'], {}, self, storage)
+        testObj = MyStreamTestObject(os.urandom(12 * 1024**2))
+        storage.write(loc, testObj)
+        self.assertTrue(storage.bucket.Object('testname').e_tag.endswith('-3"'))
+        self.assertEqual(storage.read(loc), [testObj])
+        storage.write(loc, MyStreamTestObject('foo'))
+        self.assertNotIn('-', storage.bucket.Object('testname').e_tag)
+        self.assertEqual(storage.read(loc), [MyStreamTestObject('foo')])
+
+        # the third part can not be filled before the upload of the first is finished.
+        uploadPart = storage.transfer._uploadPart
+        release = threading.Event()
+
+        def gatedUploadPart(*args):
+            release.wait()
+            return uploadPart(*args)
+
+        storage.transfer._uploadPart = gatedUploadPart
+        with storage.transfer.openUpload('gated', 2) as stream:
+            stream.write(bytes(10 * 1024**2))
+            writer = threading.Thread(target=stream.write, args=(b'x',))
+            writer.start()
+            writer.join(0.2)
+            self.assertTrue(writer.is_alive())
+            release.set()
+            writer.join()
+        self.assertEqual(storage.bucket.Object('gated').content_length, 10 * 1024**2 + 1)
+        del storage.transfer._uploadPart
+
+        class FailingObject(MyTestObject):
+            pass
+
+        def failingWriter(stream, butlerLocation, obj):
+            stream.write(bytes(6 * 1024**2))
+            raise RuntimeError("serialization failed")
+
+        S3Storage.registerStreamFormatters(FailingObject, writeFormatter=failingWriter)
+        with self.assertRaises(RuntimeError):
+            storage.write(dafPersist.ButlerLocation(FailingObject, None, None, ['failed'], {}, self, storage),
+                          FailingObject('foo'))
+        self.assertNotIn('Uploads', client.list_multipart_uploads(Bucket=storage.bucketName))
+        self.assertFalse(storage.exists('failed'))
+
+    def test_copyTree(self):
+        """Test copying a prefix, including a multipart copy, and resuming a partial copy."""
+        repoLocation = self._getS3URI('test_copyTree')
+        storage = S3Storage(uri=repoLocation, create=True)
+        storage.config.update(multipartCopyThreshold=6 * 1024**2, multipartCopyChunkSize=5 * 1024**2)
+        contents = {'rerun/a/obj{}'.format(i): 'obj{}'.format(i).encode() for i in range(20)}
+        contents['rerun/a/big'] = os.urandom(11 * 1024**2)
+        contents['rerun/ab/notCopied'] = b'foo'
+        for key, data in contents.items():
+            storage.bucket.put_object(Key=key, Body=data)
+
+        progress = []
+        result = storage.copyTree('rerun/a/', 'rerun/b/', progress=lambda r: progress.append(r.finished))
+        self.assertEqual((result.total, result.done, result.skipped), (21, 21, 0))
+        self.assertEqual(sorted(progress), list(range(1, 22)))
+        for key, data in contents.items():
+            if key.startswith('rerun/a/'):
+                copiedKey = key.replace('rerun/a/', 'rerun/b/')
+                self.assertEqual(storage.bucket.Object(copiedKey).get()['Body'].read(), data)
+                self.assertTrue(storage.exists(copiedKey))
+        self.assertFalse(storage.exists('rerun/b/notCopied'))
+
+        storage.bucket.Object('rerun/b/obj3').delete()
+        # an object of the same size that was not copied from the source is replaced, however recent it is.
+        storage.bucket.put_object(Key='rerun/b/obj4', Body=b'xxxx')
+        result = storage.copyTree('rerun/a/', 'rerun/b/')
+        self.assertEqual((result.done, result.skipped), (2, 19))
+        self.assertEqual(storage.bucket.Object('rerun/b/obj4').get()['Body'].read(), b'obj4')
+        self.assertIn('-', storage.bucket.Object('rerun/b/big').e_tag)
+
+        # a multipart upload below the copy threshold is copied with one request, which on S3 gives the copy
+        # an ETag of its own; the copy is still recognised by the ETag of its source in its metadata.
+        storage.config.update(multipartThreshold=5 * 1024**2)
+        storage._transfer = None
+        medium = os.urandom(5 * 1024**2 + 1)
+        storage.transfer.upload(io.BytesIO(medium), 'rerun/c/medium', len(medium))
+        sourceEtag = storage.bucket.Object('rerun/c/medium').e_tag
+        self.assertIn('-', sourceEtag)
+        self.assertEqual(storage.copyTree('rerun/c/', 'rerun/d/').done, 1)
+        copied = storage.bucket.Object('rerun/d/medium')
+        storage.bucket.put_object(Key='rerun/d/medium', Body=medium, Metadata=copied.metadata)
+        self.assertNotEqual(storage.bucket.Object('rerun/d/medium').e_tag, sourceEtag)
+        result = storage.copyTree('rerun/c/', 'rerun/d/')
+        self.assertEqual((result.done, result.skipped), (0, 1))
+
+    def test_delete(self):
+        """Test deleting objects and purging prefixes in batches, and dry runs of both."""
+        repoLocation = self._getS3URI('test_delete')
+        storage = S3Storage(uri=repoLocation, create=True)
+        client = storage.s3.meta.client
+        keys = ['rerun/a/obj{:04d}'.format(i) for i in range(1005)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(lambda key: client.put_object(Bucket=storage.bucketName, Key=key, Body=b'12'),
+                          keys))
+        for key in ('rerun/b/obj', 'rerun/ab', 'repositoryCfg.yaml'):
+            storage.bucket.put_object(Key=key, Body=b'x')
+        self.assertTrue(storage.exists('rerun/a/obj0000'))
+
+        result = storage.purge('rerun/a/', dryRun=True)
+        self.assertEqual((result.total, result.totalBytes, result.done), (1005, 2010, 0))
+        result = storage.delete(['rerun/b/obj', 'doesNotExist'], dryRun=True)
+        self.assertEqual((result.total, result.totalBytes, result.done), (1, 1, 0))
+        self.assertTrue(storage.exists('rerun/b/obj'))
+
+        progress = []
+        result = storage.purge('rerun/a/', progress=lambda r: progress.append(r.finished))
+        self.assertEqual((result.total, result.done, result.doneBytes), (1005, 1005, 2010))
+        self.assertEqual((len(progress), max(progress)), (2, 1005))
+        self.assertFalse(storage.exists('rerun/a/obj0000'))
+        self.assertEqual(list(storage.bucket.objects.filter(Prefix='rerun/a/')), [])
+        # the RepositoryCfg is kept by a purge, but can be deleted explicitly.
+        self.assertEqual(storage.purge('').done, 2)
+        self.assertEqual([obj.key for obj in storage.bucket.objects.all()], ['repositoryCfg.yaml'])
+        self.assertEqual(storage.delete(['repositoryCfg.yaml', 'doesNotExist']).done, 2)
+        self.assertEqual(list(storage.bucket.objects.all()), [])
+
+    def test_fitsHdus(self):
+        """Test the HDU index of a FITS object and reading single HDUs of it."""
+        repoLocation = self._getS3URI('test_fitsHdus')
+        storage = S3Storage(uri=repoLocation, create=True)
+        storage.config.update(hduIndexSidecar=True)
+        fits = makeFitsBytes([100, 10000, 3000])
+        storage.bucket.put_object(Key='foo.fits', Body=fits)
+
+        index = storage.getHduIndex('foo.fits[2]')
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.size, len(fits))
+        self.assertEqual(index.hduRange(0), (0, 2880))
+        self.assertEqual(index.hduRange(2), (2880 * 3, 2880 * 8))
+        self.assertTrue(storage.exists('foo.fits' + S3Storage.hduIndexSuffix))
+
+        start, end = index.hduRange(2)
+        self.assertEqual(storage.readHdu('foo.fits[2]'), fits[start:end])
+        with tempfile.TemporaryDirectory() as cacheDir:
+            storage.config.update(cacheDir=cacheDir, cacheTtl=60.)
+            with storage.getLocalFile('foo.fits[2]') as f:
+                self.assertTrue(f.name.endswith('.fits'))
+                localFits = f.read()
+            # the copies of HDUs are dropped when this process overwrites the object, however long they are
+            # trusted.
+            newFits = makeFitsBytes([100, 20000, 3000])
+            storage.bucket.put_object(Key='new.fits', Body=newFits)
+            storage.copyFile('new.fits', 'foo.fits')
+            newStart, newEnd = storage.getHduIndex('foo.fits').hduRange(2)
+            with storage.getLocalFile('foo.fits[2]') as f:
+                newLocalFits = f.read()
+            self.assertEqual(len(newLocalFits), len(newFits))
+            self.assertEqual(newLocalFits[newStart:newEnd], newFits[newStart:newEnd])
+        self.assertEqual(len(localFits), len(fits))
+        self.assertEqual(localFits[start:end], fits[start:end])
+        for start, end in index.headerRanges():
+            self.assertEqual(localFits[start:end], fits[start:end])
+        # the data of the other extensions is not fetched
+        start, end = index.hduRange(3)
+        self.assertNotEqual(localFits[start:end], fits[start:end])
+
+    def test_readInto(self):
+        """Test reading objects and HDUs straight into preallocated buffers, in one request and in ranges."""
+        repoLocation = self._getS3URI('test_readInto')
+        storage = S3Storage(uri=repoLocation, create=True)
+        storage.config.update(multipartThreshold=5 * 1024**2, multipartChunkSize=5 * 1024**2,
+                              transferThreads=3)
+        image = np.random.random((1200, 1200)).astype(np.float32)
+        storage.bucket.put_object(Key='image', Body=image.tobytes())
+        small = np.arange(100, dtype=np.int64)
+        storage.bucket.put_object(Key='small', Body=small.tobytes())
+
+        for key, expected in (('image', image), ('small', small)):
+            array = np.empty_like(expected)
+            self.assertIs(storage.readInto(key, array), array)
+            np.testing.assert_array_equal(array, expected)
+        array = storage.readInto('image', lambda size: np.empty(size // 4, dtype=np.float32))
+        np.testing.assert_array_equal(array.reshape(image.shape), image)
+        self.assertEqual(storage.readInto('small'), small.tobytes())
+        self.assertIsNone(storage.readInto('doesNotExist', bytearray(10)))
+        with self.assertRaises(RuntimeError):
+            storage.readInto('small', bytearray(10))
+
+        fits = makeFitsBytes([100, 10000])
+        storage.bucket.put_object(Key='foo.fits', Body=fits)
+        start, end = storage.getHduIndex('foo.fits').hduRange(2)
+        self.assertEqual(storage.readInto('foo.fits[2]'), fits[start:end])
+
+    def test_arrayFormatters(self):
+        """Test that NumPy arrays are written as raw buffers, and that reading rows fetches only their
+        bytes."""
+        repoLocation = self._getS3URI('test_arrayFormatters')
+        storage = S3Storage(uri=repoLocation, create=True)
+        array = np.arange(200000, dtype='>f8').reshape(2000, 100)
+        loc = dafPersist.ButlerLocation(np.ndarray, None, None, ['array.npy'], {}, self, storage)
+        # the formatters are registered when the first array is written.
+        storage.write(loc, array)
+        from lsst.daf.fmt.s3 import fmtArrays
+        with storage.getLocalFile('array.npy') as f:
+            np.testing.assert_array_equal(np.load(f), array)
+        read = storage.read(loc)[0]
+        self.assertEqual(read.dtype, array.dtype)
+        np.testing.assert_array_equal(read, array)
+        fortran = np.asfortranarray(np.arange(12).reshape(3, 4))
+        fmtArrays.writeArray(storage, 'fortran.npy', fortran)
+        np.testing.assert_array_equal(fmtArrays.readArray(storage, 'fortran.npy'), fortran)
+        with self.assertRaises(RuntimeError):
+            fmtArrays.readArray(storage, 'fortran.npy', rows=1)
+        with self.assertRaises(RuntimeError):
+            fmtArrays.writeArray(storage, 'objects.npy', np.array([None, 'a']))
+        self.assertIsNone(fmtArrays.readArray(storage, 'doesNotExist.npy'))
+
+        readInto = storage.transfer.readInto
+        fetched = []
+
+        def recordingReadInto(key, view, start, etag):
+            fetched.append(len(view))
+            readInto(key, view, start, etag)
+
+        storage.transfer.readInto = recordingReadInto
+        for rows in (slice(500, 510), slice(1990, None, 3), slice(20, 5, -4), -1, slice(5, 5)):
+            np.testing.assert_array_equal(fmtArrays.readArray(storage, 'array.npy', rows), array[rows])
+        self.assertEqual(sum(fetched), (10 + 10 + 13 + 1) * 800)
+        with self.assertRaises(IndexError):
+            fmtArrays.readArray(storage, 'array.npy', 2000)
+
+    def test_tableFormatters(self):
+        """Test that Arrow tables are written as Parquet and that reading columns fetches only theirs."""
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest("pyarrow is not available")
+        repoLocation = self._getS3URI('test_tableFormatters')
+        storage = S3Storage(uri=repoLocation, create=True)
+        table = pyarrow.table({'col{}'.format(i): np.random.random(20000) for i in range(40)})
+        loc = dafPersist.ButlerLocation(pyarrow.Table, None, None, ['sources.parq'], {}, self, storage)
+        storage.write(loc, table)
+        from lsst.daf.fmt.s3 import fmtTables
+        self.assertTrue(storage.read(loc)[0].equals(table))
+        self.assertIsNone(fmtTables.readTable(storage, 'doesNotExist.parq'))
+
+        readRange = storage.transfer.readRange
+        fetched = []
+
+        def recordingReadRange(key, start, end, etag=None):
+            fetched.append(end - start)
+            return readRange(key, start, end, etag)
+
+        storage.transfer.readRange = recordingReadRange
+        columns = fmtTables.readTable(storage, 'sources.parq', columns=['col3', 'col17'])
+        self.assertTrue(columns.equals(table.select(['col3', 'col17'])))
+        # the two columns and the footer, of the 40 columns.
+        size = storage.bucket.Object('sources.parq').content_length
+        self.assertLess(sum(fetched), size / 10)
+
+    def test_repositorySettings(self):
+        """Test that S3Storage settings in the policy of a RepositoryCfg are applied to the repository's
+        storages."""
+        repoLocation = self._getS3URI('test_repositorySettings')
+        cfg = dafPersist.RepositoryCfg.makeFromArgs(
+            dafPersist.RepositoryArgs(root=repoLocation, policy={'s3': {'transferThreads': 3}}))
+        S3Storage.putRepositoryCfg(cfg)
+        self.assertEqual(S3Storage._getStorage(repoLocation).config.transferThreads, 3)
+        self.assertEqual(S3Storage(uri=repoLocation, create=True).config.transferThreads, 3)
+
+    def test_shardedLayout(self):
+        """Test that a repository whose RepositoryCfg asks for a sharded layout stores objects under hashed
+        prefixes and that its storages read, find and copy them by their usual names."""
+        repoLocation = self._getS3URI('test_shardedLayout')
+        cfg = dafPersist.RepositoryCfg.makeFromArgs(
+            dafPersist.RepositoryArgs(root=repoLocation, policy={'s3': {'shardPrefixLength': 1}}))
+        S3Storage.putRepositoryCfg(cfg)
+        # the layout is the repository's, whatever the environment says.
+        os.environ['LSST_S3_SHARD_PREFIX_LENGTH'] = '2'
+        try:
+            storage = S3Storage(uri=repoLocation, create=True)
+            self.assertEqual(lsst.daf.fmt.s3.S3StorageConfig().shardPrefixLength, 0)
+        finally:
+            del os.environ['LSST_S3_SHARD_PREFIX_LENGTH']
+        self.assertEqual(storage.config.shardPrefixLength, 1)
+        with self.assertRaises(RuntimeError):
+            lsst.daf.fmt.s3.S3StorageConfig.setDefaults(shardPrefixLength=2)
+        client = storage.s3.meta.client
+        keys = sorted(entry['Key'] for entry in storage._listObjects(''))
+        self.assertEqual(keys, [S3Storage.repositoryCfgName])
+
+        testObj = MyStreamTestObject('foo')
+        loc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['calexp/v1/a.pickle'], {}, self,
+                                        storage)
+        storage.write(loc, testObj)
+        legacyLoc = dafPersist.ButlerLocation(MyTestObject, None, None, ['calexp/v1/b.pickle'], {}, self,
+                                              storage)
+        storage.write(legacyLoc, MyTestObject('bar'))
+        keys = sorted(entry['Key'] for entry in storage._listObjects(''))
+        self.assertEqual(keys, ['6/calexp/v1/a.pickle', '6/calexp/v1/b.pickle', S3Storage.repositoryCfgName])
+
+        self.assertEqual(storage.read(loc), [testObj])
+        self.assertEqual(storage.read(legacyLoc), [MyTestObject('bar')])
+        self.assertTrue(storage.exists('calexp/v1/a.pickle'))
+        self.assertEqual(storage.instanceSearch('calexp/v1/a.pickle'), ['calexp/v1/a.pickle'])
+        with storage.getLocalFile('calexp/v1/a.pickle') as f:
+            self.assertEqual(pickle.load(f), testObj)
+        storage.copyFile('calexp/v1/a.pickle', 'calexp/v2/a.pickle')
+        self.assertEqual(storage.copyTree('calexp/', 'rerun/calexp/').done, 3)
+        client.head_object(Bucket=storage.bucketName, Key=storage._shardKey('rerun/calexp/v2/a.pickle'))
+        loc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['rerun/calexp/v2/a.pickle'], {},
+                                        self, storage)
+        self.assertEqual(storage.read(loc), [testObj])
+
+    def test_adaptiveConcurrency(self):
+        """Test that throttled requests are retried and lower the number of requests in flight, and that
+        successful ones raise it back."""
+        class Response:
+            def __init__(self, status):
+                self.status_code = status
+
+        limiter = AdaptiveConcurrency(8, cooldown=60.)
+        for i in range(3):
+            limiter._beforeSend()
+        self.assertEqual(limiter.stats()['inFlight'], 3)
+        # throttled requests in flight at the same time lower the limit once.
+        limiter._needsRetry(response=(Response(503), {'Error': {'Code': 'SlowDown'}}))
+        limiter._needsRetry(response=(Response(503), {'Error': {'Code': 'SlowDown'}}))
+        self.assertEqual(limiter.limit, 4)
+        limiter._needsRetry(response=(Response(200), {}))
+        self.assertEqual(limiter.stats()['inFlight'], 0)
+        for i in range(40):
+            limiter._beforeSend()
+            limiter._needsRetry(response=(Response(200), {}))
+        self.assertEqual(limiter.limit, 8)
+
+        # a slot is waited for while the limit is reached.
+        limiter = AdaptiveConcurrency(1)
+        limiter._beforeSend()
+        thread = threading.Thread(target=limiter._beforeSend)
+        thread.start()
+        time.sleep(0.1)
+        self.assertTrue(thread.is_alive())
+        limiter._needsRetry(response=(Response(200), {}))
+        thread.join()
+        self.assertEqual(limiter.stats()['waits'], 1)
+
+        # a SlowDown from the server is retried by the pooled client.
+        repoLocation = self._getS3URI('test_adaptiveConcurrency')
+        storage = S3Storage(uri=repoLocation, create=True)
+        config = storage.config
+        concurrency = ClientPool.getConcurrency(config.endpointUrl, config.profile, config.maxPoolConnections,
+                                                config.maxAttempts, config.adaptiveConcurrency)
+        storage.write(dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['hot'], {}, self, storage),
+                      MyStreamTestObject('foo'))
+        storage.config.update(existsCacheTtl=0.)
+        throttled = concurrency.stats()['throttled']
+        slowDowns = []
+
+        def slowDown(request=None, **kwargs):
+            if not slowDowns:
+                slowDowns.append(request.url)
+                body = b'<Error><Code>SlowDown</Code><Message>Reduce your request rate.</Message></Error>'
+                return botocore.awsrequest.AWSResponse(request.url, 503, {}, MockRawResponse(body))
+
+        events = storage.s3.meta.client.meta.events
+        events.register_first('before-send.s3.HeadObject', slowDown)
+        try:
+            self.assertTrue(storage.exists('hot'))
+        finally:
+            events.unregister('before-send.s3.HeadObject', slowDown)
+        self.assertEqual(len(slowDowns), 1)
+        self.assertEqual(concurrency.stats()['throttled'], throttled + 1)
+
+    def test_repositoryCfgCache(self):
+        """Test that RepositoryCfgs are revalidated by ETag instead of downloaded again, and that putting a
+        cfg invalidates the cache."""
+        RepositoryCfgCache.clear()
+        repoLocation = self._getS3URI('test_repositoryCfgCache')
+        cfg = dafPersist.RepositoryCfg.makeFromArgs(dafPersist.RepositoryArgs(root=repoLocation,
+                                                                              mapper=MyMapper))
+        S3Storage.putRepositoryCfg(cfg)
+        self.assertEqual(S3Storage.getMapperClass(repoLocation), MyMapper)
+        reloadedCfg = S3Storage.getRepositoryCfg(repoLocation)
+        self.assertEqual(cfg, reloadedCfg)
+        self.assertEqual(RepositoryCfgCache.stats(), dict(hits=0, revalidations=1, misses=1))
+
+        # callers get their own copy
+        self.assertIsNot(S3Storage.getRepositoryCfg(repoLocation), reloadedCfg)
+
+        cfg = dafPersist.RepositoryCfg.makeFromArgs(dafPersist.RepositoryArgs(root=repoLocation,
+                                                                              mapper=CameraMapper))
+        S3Storage.putRepositoryCfg(cfg)
+        self.assertEqual(S3Storage.getMapperClass(repoLocation), CameraMapper)
+        self.assertEqual(RepositoryCfgCache.stats()['misses'], 2)
+
+        S3Storage._getStorage(repoLocation).config.update(repositoryCfgTtl=60.)
+        self.assertEqual(S3Storage.getMapperClass(repoLocation), CameraMapper)
+        self.assertEqual(RepositoryCfgCache.stats()['hits'], 1)
+        S3Storage._getStorage(repoLocation).config.update(repositoryCfgTtl=0.)
+
+    def test_noRepositoryCfg(self):
+        """Test that getRepositoryCfg returns None and getMapperClass raises when there is no RepositoryCfg in
+        the bucket."""
+        repoLocation = self._getS3URI('test_noRepositoryCfg')
+        S3Storage(uri=repoLocation, create=True)
+        self.assertIsNone(S3Storage.getRepositoryCfg(repoLocation))
+        with self.assertRaises(dafPersist.NoRepositroyAtRoot):
+            S3Storage.getMapperClass(repoLocation)
+
+    def test_streamFormatters(self):
+        """Test writing and reading an object with stream formatters, for one and several locations."""
+        repoLocation = self._getS3URI('test_streamFormatters')
+        storage = S3Storage(uri=repoLocation, create=True)
+        # make the write buffer spill to disk for the second object.
+        storage.config.update(spillThreshold=100)
+        testObjs = [MyStreamTestObject('foo'), MyStreamTestObject('bar' * 100)]
+        loc = dafPersist.ButlerLocation(pythonType=MyStreamTestObject,
+                                        cppType=None,
+                                        storageName=None,
+                                        locationList=None,
+                                        dataId={},
+                                        mapper=self,
+                                        storage=storage)
+        for i, testObj in enumerate(testObjs):
+            loc.locationList = ['testname{}'.format(i)]
+            storage.write(loc, testObj)
+            self.assertEqual(storage.read(loc), [testObj])
+        loc.locationList = ['testname0', 'testname1', 'doesNotExist']
+        self.assertEqual(storage.read(loc), testObjs + [None])
+
+    def test_compression(self):
+        """Test that objects are compressed according to their type and size, that the codec is recorded in
+        their metadata, and that compressed, uncompressed and queued objects all read back."""
+        repoLocation = self._getS3URI('test_compression')
+        storage = S3Storage(uri=repoLocation, create=True)
+        client = storage.s3.meta.client
+        S3Storage.registerCompression(MyStreamTestObject, 'gzip')
+        try:
+            storage.config.update(compressionMinBytes=1000)
+            testObjs = [MyStreamTestObject('foo'), MyStreamTestObject('bar' * 1000),
+                        MyStreamTestObject(os.urandom(10000))]
+            for i, testObj in enumerate(testObjs):
+                loc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['obj{}'.format(i)], {}, self,
+                                                storage)
+                storage.write(loc, testObj)
+                self.assertEqual(storage.read(loc), [testObj])
+            # too small, compressed, and incompressible.
+            metadata = [client.head_object(Bucket=storage.bucketName, Key='obj{}'.format(i))['Metadata']
+                        for i in range(len(testObjs))]
+            self.assertEqual(metadata, [{}, {'lsst-encoding': 'gzip'}, {}])
+            self.assertLess(client.head_object(Bucket=storage.bucketName, Key='obj1')['ContentLength'], 1000)
+
+            # local copies and server-side copies are decompressed or keep their codec.
+            with storage.getLocalFile('obj1') as f:
+                self.assertEqual(pickle.load(f), testObjs[1])
+            storage.copyFile('obj1', 'obj1copy')
+            loc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['obj1copy'], {}, self, storage)
+            self.assertEqual(storage.read(loc), [testObjs[1]])
+
+            # objects queued for upload are decoded too.
+            storage.config.update(writeBehind=True)
+            loc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['queued'], {}, self, storage)
+            storage._getWriteBehind().upload = lambda *args: threading.Event().wait(0.2)
+            storage.write(loc, testObjs[1])
+            self.assertEqual(storage.read(loc), [testObjs[1]])
+            storage.flush()
+
+            with self.assertRaises(RuntimeError):
+                S3Storage.registerCompression(MyStreamTestObject, 'noSuchCodec')
+        finally:
+            del S3Storage._compressionCodecs[MyStreamTestObject]
+
+    def test_objectCache(self):
+        """Test that objects of registered types are served from the in-memory cache, that this process's
+        writes and copies invalidate it, and that other writers are noticed when the ETag is revalidated."""
+        repoLocation = self._getS3URI('test_objectCache')
+        storage = S3Storage(uri=repoLocation, create=True)
+        client = storage.s3.meta.client
+        cache = storage.objectCache
+        S3Storage.registerObjectCache(MyStreamTestObject)
+        try:
+            loc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['bias'], {}, self, storage)
+            storage.write(loc, MyStreamTestObject('foo'))
+            cache.resetStats()
+            first = storage.read(loc)[0]
+            self.assertEqual(first, MyStreamTestObject('foo'))
+            self.assertIs(storage.read(loc)[0], first)
+            self.assertEqual(cache.stats()['misses'], 1)
+            self.assertEqual(cache.stats()['hits'], 1)
+
+            # this storage's writes and copies replace the cached object.
+            storage.write(loc, MyStreamTestObject('bar'))
+            self.assertEqual(storage.read(loc), [MyStreamTestObject('bar')])
+            storage.write(dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['flat'], {}, self,
+                                                    storage), MyStreamTestObject('baz'))
+            storage.copyFile('flat', 'bias')
+            self.assertEqual(storage.read(loc), [MyStreamTestObject('baz')])
+
+            # other writers are only noticed when the ETag is revalidated.
+            client.put_object(Bucket=storage.bucketName, Key='bias',
+                              Body=pickle.dumps(MyStreamTestObject('qux')))
+            self.assertEqual(storage.read(loc), [MyStreamTestObject('baz')])
+            storage.config.update(objectCacheTtl=0.)
+            self.assertEqual(storage.read(loc), [MyStreamTestObject('qux')])
+            revalidations = cache.stats()['revalidations']
+            self.assertEqual(storage.read(loc), [MyStreamTestObject('qux')])
+            self.assertEqual(cache.stats()['revalidations'], revalidations + 1)
+
+            # in bytes mode each read deserializes a new object.
+            S3Storage.registerObjectCache(MyStreamTestObject, 'bytes')
+            storage.config.update(objectCacheTtl=float('inf'))
+            self.assertIsNot(storage.read(loc)[0], storage.read(loc)[0])
+            missing = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['missing'], {}, self,
+                                                storage)
+            self.assertEqual(storage.read(missing), [None])
+
+            # objects larger than the budget are not kept.
+            storage.config.update(objectCacheMaxBytes=10)
+            storage.read(loc)
+            self.assertEqual(cache.stats()['bytes'], 0)
+            with self.assertRaises(RuntimeError):
+                S3Storage.registerObjectCache(MyStreamTestObject, 'noSuchMode')
+        finally:
+            S3Storage.registerObjectCache(MyStreamTestObject, None)
+
+    def test_singleFlight(self):
+        """Test that concurrent reads, exists checks and getLocalFile calls of the same key share one request,
+        and that all the callers get its error."""
+        repoLocation = self._getS3URI('test_singleFlight')
+        storage = S3Storage(uri=repoLocation, create=True)
+        cacheDir = tempfile.TemporaryDirectory()
+        self.addCleanup(cacheDir.cleanup)
+        storage.config.update(cacheDir=cacheDir.name, existsCacheTtl=0., existsNegativeCacheTtl=0.)
+        loc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['calib'], {}, self, storage)
+        storage.write(loc, MyStreamTestObject('foo'))
+        requests = []
+
+        def slowRequest(model=None, **kwargs):
+            requests.append(model.name)
+            time.sleep(0.2)
+
+        def runConcurrently(func, count=8):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=count) as pool:
+                futures = [pool.submit(func) for i in range(count)]
+                return [future.result() for future in futures]
+
+        events = storage.s3.meta.client.meta.events
+        events.register('before-call.s3', slowRequest)
+        try:
+            results = runConcurrently(lambda: storage.read(loc)[0])
+            self.assertEqual(requests, ['GetObject'])
+            self.assertEqual(results, [MyStreamTestObject('foo')] * 8)
+            # each reader deserialized its own object.
+            self.assertEqual(len(set(id(result) for result in results)), 8)
+
+            del requests[:]
+            self.assertEqual(runConcurrently(lambda: storage.exists('calib')), [True] * 8)
+            self.assertEqual(requests, ['HeadObject'])
+
+            del requests[:]
+
+            def getLocalFile():
+                with storage.getLocalFile('calib') as f:
+                    return f.name
+
+            self.assertEqual(len(set(runConcurrently(getLocalFile))), 1)
+            self.assertEqual(requests, ['GetObject'])
+
+            # objects too large to share are fetched by each reader.
+            del requests[:]
+            storage.config.update(readCoalesceMaxBytes=1)
+            self.assertEqual(runConcurrently(lambda: storage.read(loc)[0], 2),
+                             [MyStreamTestObject('foo')] * 2)
+            self.assertEqual(requests, ['GetObject'] * 2)
+        finally:
+            events.unregister('before-call.s3', slowRequest)
+
+        def failingRequest(**kwargs):
+            time.sleep(0.2)
+            raise RuntimeError("request failed")
+
+        events.register('before-call.s3.HeadObject', failingRequest)
+        try:
+            errors = []
+
+            def exists():
+                try:
+                    storage.exists('calib')
+                except RuntimeError as err:
+                    errors.append(err)
+
+            flights = storage._flights.stats()
+            runConcurrently(exists, 4)
+            self.assertEqual(len(errors), 4)
+            self.assertEqual(storage._flights.stats()['calls'], flights['calls'] + 1)
+        finally:
+            events.unregister('before-call.s3.HeadObject', failingRequest)
+
+    def test_prefetch(self):
+        """Test that reads use prefetched objects, that prefetches no longer needed are dropped, and that
+        prefetching stays within its byte budget."""
+        repoLocation = self._getS3URI('test_prefetch')
+        storage = S3Storage(uri=repoLocation, create=True)
+        locs = [dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['obj{}'.format(i)], {}, self,
+                                          storage) for i in range(6)]
+        for i, loc in enumerate(locs):
+            storage.write(loc, MyStreamTestObject(i))
+        gets = []
+        client = storage.s3.meta.client
+
+        def countGet(event_name, **kwargs):
+            gets.append(event_name)
+
+        client.meta.events.register('before-call.s3.GetObject', countGet)
+        self.addCleanup(client.meta.events.unregister, 'before-call.s3.GetObject', countGet)
+
+        def waitForPrefetches(storage):
+            for entry in list(storage._prefetcher._entries.values()):
+                entry.future.result()
+
+        # locations of types without stream formatters are ignored.
+        otherLoc = dafPersist.ButlerLocation(MyTestObject, None, None, ['other'], {}, self, storage)
+        storage.prefetch(locs[:4] + [otherLoc, 'doesNotExist'])
+        waitForPrefetches(storage)
+        self.assertEqual(len(gets), 5)
+        self.assertEqual(storage.read(locs[0]), [MyStreamTestObject(0)])
+        self.assertEqual(storage.read(locs[1]), [MyStreamTestObject(1)])
+        self.assertEqual(storage.read(dafPersist.ButlerLocation(MyStreamTestObject, None, None,
+                                                                ['doesNotExist'], {}, self, storage)), [None])
+        self.assertEqual(len(gets), 5)
+        # obj3 is no longer needed, and obj2 is changed before it is read.
+        storage.prefetch(locs[2:3])
+        storage.write(locs[2], MyStreamTestObject('new'))
+        self.assertEqual(storage.read(locs[2]), [MyStreamTestObject('new')])
+        self.assertEqual(storage.read(locs[3]), [MyStreamTestObject(3)])
+        stats = storage.prefetchStats()
+        self.assertEqual((stats['requested'], stats['hits'], stats['wasted'], stats['pending']), (5, 3, 2, 0))
+        self.assertEqual(stats['hitRate'], 0.6)
+        self.assertEqual(stats['heldBytes'], 0)
+        self.assertGreater(stats['wastedBytes'], 0)
+
+        # with a budget of one byte only one object is held at a time.
+        storage = S3Storage(uri=repoLocation, create=True)
+        self.assertEqual(storage.prefetchStats()['requested'], 0)
+        self.assertIsNone(storage._prefetcher)
+        storage.config.update(prefetchMaxBytes=1)
+        storage.prefetch(locs[3:])
+        time.sleep(0.2)
+        self.assertEqual(storage.prefetchStats()['heldBytes'], storage.bucket.Object('obj3').content_length)
+        for i, loc in enumerate(locs[3:], 3):
+            self.assertEqual(storage.read(loc), [MyStreamTestObject(i)])
+        self.assertEqual(storage.prefetchStats()['hits'], 3)
+        # the prefetcher does not keep the storage alive.
+        storageRef = weakref.ref(storage)
+        del storage
+        gc.collect()
+        self.assertIsNone(storageRef())
+
+    def test_writeBehind(self):
+        """Test that in write-behind mode writes are served from the queue until uploaded, and that flush
+        waits for the uploads and raises their errors."""
+        repoLocation = self._getS3URI('test_writeBehind')
+        storage = S3Storage(uri=repoLocation, create=True)
+        storage.config.update(writeBehind=True, spillThreshold=100)
+        testObjs = [MyStreamTestObject('foo'), MyStreamTestObject('bar' * 100)]
+        loc = dafPersist.ButlerLocation(pythonType=MyStreamTestObject,
+                                        cppType=None,
+                                        storageName=None,
+                                        locationList=['testname0', 'testname1'],
+                                        dataId={},
+                                        mapper=self,
+                                        storage=storage)
+        queue = storage._getWriteBehind()
+        upload = queue.upload
+        release = threading.Event()
+
+        def gatedUpload(*args):
+            release.wait()
+            upload(*args)
+
+        queue.upload = gatedUpload
+        for i, testObj in enumerate(testObjs):
+            storage.write(dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['testname{}'.format(i)],
+                                                    {}, self, storage), testObj)
+        self.assertTrue(storage.exists('testname1'))
+        self.assertEqual(storage.read(loc), testObjs)
+        self.assertEqual(storage.s3.meta.client.list_objects_v2(Bucket=storage.bucketName)['KeyCount'], 0)
+        release.set()
+        storage.flush()
+        self.assertEqual(queue.queuedBytes, 0)
+        self.assertEqual(storage.s3.meta.client.list_objects_v2(Bucket=storage.bucketName)['KeyCount'], 2)
+
+        def failingUpload(*args):
+            raise RuntimeError("upload failed")
+
+        queue.upload = failingUpload
+        failedLoc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['failed'], {}, self, storage)
+        storage.write(failedLoc, testObjs[0])
+        with self.assertRaises(lsst.daf.fmt.s3.BulkOperationError) as cm:
+            storage.flush()
+        self.assertEqual(list(cm.exception.result.failures), ['failed'])
+        storage.config.update(existsNegativeCacheTtl=0.)
+        self.assertFalse(storage.exists('failed'))
+        # errors are raised once.
+        storage.flush()
+        # the queue does not keep the storage alive.
+        storageRef = weakref.ref(storage)
+        del storage, loc, failedLoc
+        gc.collect()
+        self.assertIsNone(storageRef())
+
+    def test_stats(self):
+        """Test that S3Stats counts operations and the requests they make only while enabled."""
+        repoLocation = self._getS3URI('test_stats')
+        storage = S3Storage(uri=repoLocation, create=True)
+        loc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['testname'], {}, self, storage)
+        S3Stats.reset()
+        storage.write(loc, MyStreamTestObject('foo'))
+        self.assertEqual(S3Stats.snapshot()['operations'], {})
+        S3Stats.enable()
+        try:
+            storage.write(loc, MyStreamTestObject('foo'))
+            storage.read(loc)
+            storage.config.update(existsNegativeCacheTtl=0.)
+            self.assertFalse(storage.exists('doesNotExist'))
+            with tempfile.NamedTemporaryFile('w') as dumpFile:
+                S3Stats.dump(dumpFile.name)
+                with open(dumpFile.name) as f:
+                    snapshot = json.loads(f.readline())
+        finally:
+            S3Stats.disable()
+            S3Stats.reset()
+        operations = snapshot['operations']
+        self.assertEqual(operations['write:MyStreamTestObject']['calls'], 1)
+        self.assertEqual(operations['write:MyStreamTestObject']['requests'], 1)
+        self.assertGreater(operations['write:MyStreamTestObject']['bytesOut'], 0)
+        self.assertEqual(operations['read:MyStreamTestObject']['requests'], 1)
+        self.assertGreater(operations['read:MyStreamTestObject']['bytesIn'], 0)
+        self.assertEqual(operations['exists']['calls'], 1)
+        self.assertEqual(sum(operations['exists']['histogram']), 1)
+        requests = snapshot['requests']
+        self.assertEqual(requests['PutObject']['requests'], 1)
+        self.assertEqual(requests['GetObject']['requests'], 1)
+        self.assertEqual(requests['HeadObject']['errors'], 1)
+
+    def test_benchmark(self):
+        """Run the benchmarks on a small scale and compare their results to a baseline."""
+        repoLocation = self._getS3URI('test_benchmark')
+        report = benchmark.runBenchmarks(repoLocation, sizes=[1024], concurrencies=[1, 2], totalBytes=4096,
+                                         numKeys=20, numLookups=10, mapperRepeats=1, startupRepeats=1,
+                                         latency=0.001)
+        names = {result['name'] for result in report['results']}
+        self.assertEqual(names, {'write', 'writeObjects', 'read', 'readObjects', 'populate', 'exists',
+                                 'instanceSearch', 'purge', 'getMapperClassCold', 'getMapperClassWarm',
+                                 'import', 'constructCold', 'firstExistsCold', 'constructWarm',
+                                 'firstExistsWarm'})
+        self.assertTrue(all(result['value'] > 0 for result in report['results']))
+        json.dumps(report)
+
+        baseline = json.loads(json.dumps(report))
+        for result in baseline['results']:
+            if result['name'] == 'read':
+                result['value'] *= 2
+        regressions = [comparison for comparison in benchmark.compareToBaseline(report, baseline)
+                       if comparison['regression']]
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(comparison['name'] == 'read' for comparison in regressions))
+
+        # the objects of a measurement make up at most totalBytes, whatever the concurrency.
+        storage = S3Storage(uri=repoLocation, create=False)
+        with self.assertWarns(UserWarning):
+            results = benchmark.benchmarkReadWrite(storage, [4096], [1, 2, 8], totalBytes=8192)
+        self.assertEqual([result['params'] for result in results if result['name'] == 'write'],
+                         [dict(size=4096, concurrency=1), dict(size=4096, concurrency=2)])
+        self.assertEqual(len(list(storage.bucket.objects.filter(Prefix='readWrite/4096/'))), 4)
+
+    def test_deferredBucketCheck(self):
+        """Test that the bucket is checked on first use, once per process, and that a missing repository is
+        still reported by the constructor."""
+        repoLocation = self._getS3URI('test_deferredBucketCheck')
+        with self.assertRaises(dafPersist.NoRepositroyAtRoot):
+            S3Storage(uri=repoLocation, create=False)
+        storage = S3Storage(uri=repoLocation, create=True)
+        client = storage.s3.meta.client
+        client.head_bucket(Bucket=storage.bucketName)
+        headBuckets = []
+
+        def countHeadBucket(**kwargs):
+            headBuckets.append(kwargs)
+
+        client.meta.events.register('before-call.s3.HeadBucket', countHeadBucket)
+        try:
+            S3Storage(uri=repoLocation, create=False)
+            self.assertFalse(S3Storage(uri=repoLocation, create=True).exists(S3Storage.repositoryCfgName))
+            self.assertEqual(headBuckets, [])
+            S3Storage.clearSharedState()
+            S3Storage(uri=repoLocation, create=False)
+            self.assertEqual(len(headBuckets), 1)
+        finally:
+            client.meta.events.unregister('before-call.s3.HeadBucket', countHeadBucket)
+
+    def test_sharedClients(self):
+        """Test that storages share pooled clients and that RepositoryCfg access reuses storages."""
+        repoLocation = self._getS3URI('test_sharedClients')
+        storage1 = S3Storage(uri=repoLocation, create=True)
+        storage2 = S3Storage(uri=repoLocation, create=True)
+        self.assertIs(storage1.s3.meta.client, storage2.s3.meta.client)
+        self.assertIs(storage1.bucket.meta.client, storage1.s3.meta.client)
+        self.assertIs(S3Storage._getStorage(repoLocation), S3Storage._getStorage(repoLocation))
+
     def test_Butler(self):
         """A test that uses a Butler to create an S3 storage, put an object in it, reload the repo in a new
         butler, and get the object.
@@ -249,6 +1173,333 @@ class BasicTestCase(unittest.TestCase):
         copiedObj = storage.read(loc)
         self.assertEqual(testObj, copiedObj[0])
 
+    def test_readMultipleLocations(self):
+        """Test that reading a ButlerLocation with several locations returns one object per location, in
+        order."""
+        repoLocation = self._getS3URI('test_readMultipleLocations')
+        storage = S3Storage(uri=repoLocation, create=True)
+        storage.config.update(readConcurrency=4)
+        names = ['testname{}'.format(i) for i in range(10)]
+        for name in names:
+            loc = dafPersist.ButlerLocation(pythonType=MyTestObject,
+                                            cppType=None,
+                                            storageName=None,
+                                            locationList=[name],
+                                            dataId={},
+                                            mapper=self,
+                                            storage=storage)
+            storage.write(loc, MyTestObject(name))
+        loc.locationList = list(reversed(names))
+        reloadedObjs = storage.read(loc)
+        self.assertEqual(reloadedObjs, [MyTestObject(name) for name in reversed(names)])
+
+    def test_async(self):
+        """Test the async methods with async formatters and with regular formatters."""
+        repoLocation = self._getS3URI('test_async')
+        storage = S3Storage(uri=repoLocation, create=True)
+        storage.config.update(asyncConcurrency=4)
+
+        def makeLocation(pythonType, locationList):
+            return dafPersist.ButlerLocation(pythonType=pythonType,
+                                             cppType=None,
+                                             storageName=None,
+                                             locationList=locationList,
+                                             dataId={},
+                                             mapper=self,
+                                             storage=storage)
+
+        async def run():
+            names = ['async{}'.format(i) for i in range(10)]
+            await asyncio.gather(*[storage.awrite(makeLocation(MyAsyncTestObject, [name]),
+                                                  MyAsyncTestObject(name)) for name in names])
+            objs = await storage.aread(makeLocation(MyAsyncTestObject, names))
+            self.assertEqual(objs, [MyAsyncTestObject(name) for name in names])
+
+            testObj = MyTestObject('foo')
+            await storage.awrite(makeLocation(MyTestObject, ['testname']), testObj)
+            await storage.acopyFile('testname', 'testname_copy')
+            self.assertTrue(await storage.aexists('testname_copy'))
+            self.assertFalse(await storage.aexists('doesNotExist'))
+            self.assertEqual(await storage.aread(makeLocation(MyTestObject, ['testname_copy'])), [testObj])
+
+            # async writes are recorded in the manifest like the others.
+            storage.config.update(manifest=True)
+            # with the manifest setting, aexists answers from it like exists, not from the existence cache.
+            self.assertFalse(storage.exists('testname_copy'))
+            self.assertFalse(await storage.aexists('testname_copy'))
+            location = makeLocation(MyAsyncTestObject, ['recorded'])
+            location.datasetType = 'calexp'
+            await storage.awrite(location, MyAsyncTestObject('foo'))
+            size, etag, datasetType = storage.manifest.get('recorded')
+            self.assertEqual((size, etag, datasetType), (storage.bucket.Object('recorded').content_length,
+                                                         storage.bucket.Object('recorded').e_tag, 'calexp'))
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_exists(self):
+        """Test exists with strings and ButlerLocations, and that it is updated by write and copyFile."""
+        repoLocation = self._getS3URI('test_exists')
+        storage = S3Storage(uri=repoLocation, create=True)
+        loc = dafPersist.ButlerLocation(pythonType=MyTestObject,
+                                        cppType=None,
+                                        storageName=None,
+                                        locationList=['testname'],
+                                        dataId={},
+                                        mapper=self,
+                                        storage=storage)
+        self.assertFalse(storage.exists(loc))
+        self.assertFalse(storage.exists('testname_copy'))
+        storage.write(loc, MyTestObject('foo'))
+        self.assertTrue(storage.exists(loc))
+        storage.copyFile('testname', 'testname_copy')
+        self.assertTrue(storage.exists('testname_copy'))
+        # a key that is only a prefix of an existing key does not exist.
+        storage.config.update(existsNegativeCacheTtl=0.)
+        self.assertFalse(storage.exists('testna'))
+        self.assertTrue(storage.instanceSearch('testname[1]'))
+
+        # the answer of a request sent before this process wrote the object does not replace the write's.
+        storage.config.update(existsNegativeCacheTtl=60.)
+        client = storage.s3.meta.client
+        headObject = client.head_object
+        answered, written = threading.Event(), threading.Event()
+
+        def slowHeadObject(**kwargs):
+            try:
+                return headObject(**kwargs)
+            finally:
+                if kwargs['Key'] == 'late' and not answered.is_set():
+                    answered.set()
+                    written.wait()
+
+        client.head_object = slowHeadObject
+        try:
+            with concurrent.futures.ThreadPoolExecutor(1) as pool:
+                future = pool.submit(storage.exists, 'late')
+                answered.wait()
+                lateLoc = dafPersist.ButlerLocation(MyTestObject, None, None, ['late'], {}, self, storage)
+                storage.write(lateLoc, MyTestObject('foo'))
+                written.set()
+                self.assertFalse(future.result())
+        finally:
+            del client.head_object
+        self.assertTrue(storage.exists('late'))
+        # a bucket of the same name on another endpoint has a cache of its own.
+        self.assertIs(ExistenceCache.forBucket(storage.config.endpointUrl, storage.bucketName),
+                      storage._existenceCache)
+        otherCache = ExistenceCache.forBucket('http://other.invalid', storage.bucketName)
+        self.assertIsNone(otherCache.get('late', 60., 60.))
+
+    def test_search(self):
+        """Test that search and instanceSearch are answered from the key index, which lists each directory
+        once and picks up new keys incrementally."""
+        repoLocation = self._getS3URI('test_search')
+        storage = S3Storage(uri=repoLocation, create=True)
+        for key in ('raw/a.fits', 'raw/c.fits', 'raw/sub/b.fits', 'top.yaml'):
+            storage.bucket.put_object(Key=key, Body=b'x')
+        self.assertEqual(S3Storage.search(repoLocation, 'raw/c.fits'), ['raw/c.fits'])
+        self.assertEqual(storage.instanceSearch('raw/a.fits[1]'), ['raw/a.fits[1]'])
+        self.assertIsNone(storage.instanceSearch('raw/b.fits'))
+        self.assertIsNone(storage.instanceSearch('raw/a.fit'))
+        self.assertEqual(storage.instanceSearch('raw/sub/b.fits'), ['raw/sub/b.fits'])
+        self.assertEqual(storage.instanceSearch('top.yaml'), ['top.yaml'])
+        self.assertEqual(storage._keyIndex.keysWithPrefix('raw/'), ['raw/a.fits', 'raw/c.fits'])
+        stats = storage._keyIndex.stats()
+        self.assertEqual(stats['listings'], 3)
+        self.assertEqual(stats['keys'], 4)
+
+        # keys written by other processes, that the index does not know yet, are found by confirming misses...
+        storage.config.update(existsNegativeCacheTtl=0.)
+        storage.bucket.put_object(Key='raw/0.fits', Body=b'x')
+        self.assertEqual(storage.instanceSearch('raw/0.fits'), ['raw/0.fits'])
+        self.assertTrue(storage._keyIndex.contains('raw/0.fits'))
+        # ...the listing picks them up once it expires...
+        storage.bucket.put_object(Key='raw/d.fits', Body=b'x')
+        storage._keyIndex.ttl = 0.
+        self.assertTrue(storage._keyIndex.contains('raw/d.fits'))
+        self.assertEqual(storage._keyIndex.stats()['listings'], 3)
+        # ...and keys written by this process are added immediately.
+        storage._keyIndex.ttl = 60.
+        storage.copyFile('raw/a.fits', 'raw/b.fits')
+        self.assertTrue(storage._keyIndex.contains('raw/b.fits'))
+        self.assertEqual(storage.instanceSearch('raw/b.fits'), ['raw/b.fits'])
+        # a bucket of the same name on another endpoint has an index of its own.
+        index = KeyIndex.forBucket(storage.config.endpointUrl, storage.bucketName, None, 60., 600.)
+        self.assertIs(index, storage._keyIndex)
+        self.assertIsNot(KeyIndex.forBucket('http://other.invalid', storage.bucketName, None, 60., 600.),
+                         index)
+        # the index is shared by the storages of the bucket, but does not keep them alive.
+        storageRef = weakref.ref(storage)
+        del storage
+        gc.collect()
+        self.assertIsNone(storageRef())
+
+    def test_manifest(self):
+        """Test that the manifest answers exists and searches without requests, picks up the segments written
+        by other processes, and can be rebuilt from a listing and compacted."""
+        repoLocation = self._getS3URI('test_manifest')
+        storage = S3Storage(uri=repoLocation, create=True)
+        storage.config.update(manifest=True)
+        loc = dafPersist.ButlerLocation(MyStreamTestObject, None, None, ['a/obj'], {}, self, storage,
+                                        datasetType='calexp')
+        storage.write(loc, MyStreamTestObject('foo'))
+        storage.copyFile('a/obj', 'b/obj')
+        storage.flush()
+        size, etag, datasetType = storage.manifest.get('b/obj')
+        self.assertEqual((size, etag, datasetType), (storage.bucket.Object('b/obj').content_length,
+                                                     storage.bucket.Object('b/obj').e_tag, 'calexp'))
+
+        # a new process loads the manifest with one listing, and answers from memory from then on.
+        RepositoryManifest.clearAll()
+        storage.bucket.put_object(Key='a/notRecorded', Body=b'foo')
+        requests = []
+        client = storage.s3.meta.client
+
+        def countRequest(event_name, **kwargs):
+            requests.append(event_name.rsplit('.', 1)[-1])
+
+        client.meta.events.register('before-call.s3', countRequest)
+        self.addCleanup(client.meta.events.unregister, 'before-call.s3', countRequest)
+        self.assertTrue(storage.exists('a/obj'))
+        self.assertEqual(storage.instanceSearch('b/obj[1]'), ['b/obj[1]'])
+        self.assertFalse(storage.exists('a/notRecorded'))
+        self.assertIsNone(storage.instanceSearch('a/missing'))
+        self.assertEqual(sorted(requests), ['GetObject', 'GetObject', 'ListObjectsV2'])
+
+        # records of other processes are seen when the manifest is refreshed.
+        other = RepositoryManifest(lambda: client, storage.bucketName, 60., 1000, 100)
+        other.record('c/obj', 3, '"0"', 'raw')
+        other.flush()
+        self.assertFalse(storage.exists('c/obj'))
+        storage.config.update(manifestRefreshInterval=0.)
+        self.assertTrue(storage.exists('c/obj'))
+        self.assertEqual(storage.manifest.get('c/obj'), (3, '"0"', 'raw'))
+
+        # a rebuild lists what is really there and keeps the dataset types.
+        self.assertEqual(storage.manifest.rebuild(), 3)
+        self.assertTrue(storage.exists('a/notRecorded'))
+        self.assertFalse(storage.exists('c/obj'))
+        self.assertEqual(storage.manifest.get('a/obj')[2], 'calexp')
+        self.assertEqual(list(storage.bucket.objects.filter(Prefix='repositoryManifest/segments/')), [])
+
+        # settled segments are merged into the base.
+        settle = lsst.daf.fmt.s3.manifest.SETTLE_SECONDS
+        lsst.daf.fmt.s3.manifest.SETTLE_SECONDS = -1.
+        self.addCleanup(setattr, lsst.daf.fmt.s3.manifest, 'SETTLE_SECONDS', settle)
+        for i in range(3):
+            loc.locationList = ['d/obj{}'.format(i)]
+            storage.write(loc, MyStreamTestObject(i))
+            storage.flush()
+        self.assertTrue(storage.manifest.compact())
+        self.assertEqual(list(storage.bucket.objects.filter(Prefix='repositoryManifest/segments/')), [])
+        RepositoryManifest.clearAll()
+        self.assertEqual(len(storage.manifest), 6)
+        self.assertEqual(storage.manifest.get('d/obj2')[2], 'calexp')
+
+        # the manifest is not compacted on servers that ignore the conditions of writes.
+        def ignoreConditions(params, **kwargs):
+            params.pop('IfNoneMatch', None)
+            params.pop('IfMatch', None)
+
+        loc.locationList = ['d/obj3']
+        storage.write(loc, MyStreamTestObject(3))
+        storage.flush()
+        client.meta.events.register('before-parameter-build.s3.PutObject', ignoreConditions)
+        try:
+            unconditional = RepositoryManifest(lambda: client, storage.bucketName, 60., 1000, 100)
+            with self.assertWarns(UserWarning):
+                self.assertFalse(unconditional.compact())
+            self.assertFalse(unconditional.compact())
+        finally:
+            client.meta.events.unregister('before-parameter-build.s3.PutObject', ignoreConditions)
+        self.assertEqual(len(list(storage.bucket.objects.filter(Prefix='repositoryManifest/segments/'))), 1)
+        self.assertTrue(storage.manifest.compact())
+        # a bucket of the same name on another endpoint has a manifest of its own.
+        self.assertIsNot(RepositoryManifest.forBucket(None, 'http://other.invalid', storage.bucketName, 60.,
+                                                      1000, 100), storage.manifest)
+
+        # the process-wide manifest does not keep the storage alive.
+        storageRef = weakref.ref(storage)
+        del storage, loc
+        gc.collect()
+        self.assertIsNone(storageRef())
+
+    def test_getLocalFile(self):
+        """Test that getLocalFile downloads an object once and then serves it from the local cache until the
+        object is changed."""
+        repoLocation = self._getS3URI('test_getLocalFile')
+        storage = S3Storage(uri=repoLocation, create=True)
+        with tempfile.TemporaryDirectory() as cacheDir:
+            storage.config.update(cacheDir=cacheDir)
+            storage.bucket.put_object(Key='foo.txt', Body=b'foo')
+            with storage.getLocalFile('foo.txt') as f:
+                self.assertEqual(f.read(), b'foo')
+                self.assertTrue(f.name.endswith('.txt'))
+            with storage.getLocalFile('foo.txt') as f:
+                self.assertEqual(f.read(), b'foo')
+            stats = storage.localCache.stats()
+            self.assertEqual(stats['misses'], 1)
+            self.assertEqual(stats['hits'], 1)
+
+            storage.bucket.put_object(Key='foo.txt', Body=b'bar')
+            with storage.getLocalFile('foo.txt') as f:
+                self.assertEqual(f.read(), b'bar')
+            self.assertEqual(storage.localCache.stats()['misses'], 2)
+            self.assertIsNone(storage.getLocalFile('doesNotExist.txt'))
+
+    def test_localFileCacheEviction(self):
+        """Test that the local file cache stays within its byte budget by evicting least recently used files
+        and that its contents are reloaded from the cache directory."""
+        with tempfile.TemporaryDirectory() as cacheDir:
+            cache = LocalFileCache(cacheDir, maxBytes=10)
+
+            def fetcher(data):
+                def fetch(localPath):
+                    with open(localPath, 'wb') as f:
+                        f.write(data)
+                    return 'etag', 'lastModified'
+                return fetch
+
+            def validate(etag, lastModified):
+                return True
+
+            cache.getFile('bucket', 'a', fetcher(b'12345'), validate)
+            cache.getFile('bucket', 'b', fetcher(b'12345'), validate)
+            cache.getFile('bucket', 'a', fetcher(b'12345'), validate)
+            cache.getFile('bucket', 'c', fetcher(b'12345'), validate)
+            stats = cache.stats()
+            self.assertEqual(stats['evictions'], 1)
+            self.assertEqual(stats['bytes'], 10)
+
+            reopened = LocalFileCache(cacheDir, maxBytes=10)
+            self.assertEqual(reopened.stats()['files'], 2)
+            reopened.getFile('bucket', 'a', fetcher(b'12345'), validate)
+            self.assertEqual(reopened.stats()['hits'], 1)
+
+    def test_localFileCacheSharedDirectory(self):
+        """Test that caches in several processes can fill the same directory with the same object."""
+        with tempfile.TemporaryDirectory() as cacheDir:
+            caches = [LocalFileCache(cacheDir, maxBytes=10**6) for i in range(8)]
+            barrier = threading.Barrier(len(caches))
+
+            def fetch(localPath):
+                with open(localPath, 'wb') as f:
+                    f.write(b'12345')
+                barrier.wait()
+                return 'etag', 'lastModified'
+
+            with concurrent.futures.ThreadPoolExecutor(len(caches)) as pool:
+                futures = [pool.submit(cache.getFile, 'bucket', 'a', fetch, lambda *args: True)
+                           for cache in caches]
+                paths = [future.result() for future in futures]
+            self.assertEqual(len(set(paths)), 1)
+            self.assertEqual(LocalFileCache(cacheDir, maxBytes=10**6).stats()['files'], 1)
+            self.assertEqual(len(os.listdir(os.path.join(cacheDir, 'meta'))), 1)
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass